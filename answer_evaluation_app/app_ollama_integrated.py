@@ -11,6 +11,7 @@ from pdf_processor import PDFProcessor
 from vector_db_manager import VectorDBManager
 from ollama_evaluator import OllamaEvaluator
 from pdf_generator import ResultPDFGenerator, OCRtoPDFConverter
+from grounding_parser import strip_grounding
 import traceback
 
 app = Flask(__name__)
@@ -82,7 +83,13 @@ def upload_question_paper():
             
             # Store in vector DB
             vector_db.store_question_paper(questions_data)
-            
+
+            # Answer sheets copy question wording; speculative OCR decoding drafts from it
+            if hasattr(pdf_processor.deepseek_ocr, 'set_reference_text'):
+                pdf_processor.deepseek_ocr.set_reference_text(
+                    "\n".join(q['question_text'] for q in questions_data)
+                )
+
             print(f"✅ Question paper processed successfully")
             print(f"   Total questions: {len(questions_data)}")
             print(f"   Total marks: {sum(q['max_marks'] for q in questions_data)}")
@@ -192,10 +199,10 @@ def evaluate_student_paper():
             print("🔍 Step 1: Extracting handwritten text using DeepSeek-OCR...")
             extracted_text = pdf_processor.deepseek_ocr.extract_text_from_pdf(filepath)
 
-            # Clean the extracted text and check actual content (remove XML tags, normalize whitespace)
+            # Clean the extracted text and check actual content (remove grounding tags, normalize whitespace)
             import re
-            cleaned_text = re.sub(r'<[^>]+>', '', extracted_text) if extracted_text else ""
-            cleaned_text = re.sub(r'\s+', ' ', cleaned_text).strip()
+            cleaned_ocr_text = strip_grounding(extracted_text)
+            cleaned_text = re.sub(r'\s+', ' ', cleaned_ocr_text).strip()
             
             print(f"📝 OCR extracted {len(cleaned_text)} characters of text")
             print(f"📝 Preview: {cleaned_text[:300]}...")
@@ -214,7 +221,7 @@ def evaluate_student_paper():
                 f'student_ocr_{filename}'
             )
             ocr_pdf_converter.create_text_pdf(
-                extracted_text=extracted_text,
+                extracted_text=cleaned_ocr_text,
                 output_path=ocr_pdf_path,
                 title=f"Student Answer Sheet - {student_name} (OCR Extracted)"
             )
@@ -0,0 +1,673 @@
+"""
+OCR performance benchmarks
+
+Usage:
+    python benchmark_ocr.py <benchmark> [args...]
+
+Benchmarks:
+    handoff [images...]            Per-page cost of the JPEG temp-file round-trip vs in-memory hand-off
+    batch [batch_size] [images...] DeepSeek-OCR pages/sec, sequential loop vs batched inference
+    pipeline <pdf>                 Booklet wall time, serial rasterize+OCR vs producer/consumer pipeline
+    int8 [images...]               CPU speed and text agreement, default bf16 profile vs cpu_int8 profile
+    moe [token_counts...]          Per-layer MoE expert time, per-expert loop vs grouped bmm
+    compile [images...]            Decode tokens/sec, eager vs torch.compile'd MoE layers
+    rotary [steps] [prompt_tokens] Rotary embedding time per decode step, hub tables vs shared precomputed tables
+    offload [resident] [images...] Cold start, RSS and expert hit rate with experts paged in from the checkpoint
+    routing [out.json|out.csv] [images...]
+                                   Tokens per expert, routing entropy and moe_infer vs attention time per layer
+    speculative [tokens] [images...]
+                                   Decode tokens/sec and draft acceptance, greedy vs n-gram prompt lookup
+    concurrent [clients] [images...]
+                                   Tokens/sec under concurrent requests, model lock vs continuous batching
+"""
+
+import os
+import sys
+import time
+import tempfile
+import difflib
+import threading
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+# Sample handwriting/equation images shipped in the repository root
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SAMPLE_IMAGES = ["math.jpeg", "math1.jpeg", "math12.jpeg", "matheq.jpeg", "image1.jpeg", "im.jpeg", "imagegood.jpeg"]
+
+
+def sample_image_paths(args):
+    """Image paths from the command line, or the repository sample images"""
+    if args:
+        return [p for p in args if os.path.exists(p)]
+    return [str(REPO_ROOT / name) for name in SAMPLE_IMAGES if (REPO_ROOT / name).exists()]
+
+
+def load_sample_pages(args):
+    """Load benchmark pages as RGB PIL images"""
+    pages = []
+    for path in sample_image_paths(args):
+        with Image.open(path) as img:
+            pages.append(ImageOps.exif_transpose(img).convert("RGB"))
+    return pages
+
+
+def time_per_page(func, pages, repeat=5):
+    """Best-of-`repeat` average milliseconds per page"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for page in pages:
+            func(page)
+        best = min(best, time.perf_counter() - start)
+    return best / max(len(pages), 1) * 1000
+
+
+def benchmark_handoff(args):
+    """
+    Measure what DeepSeekOCR saves per page by not writing pages to disk
+    
+    The old path created a TemporaryDirectory, encoded the page as JPEG, wrote
+    it, and the model re-opened and decoded it. The in-memory path hands the
+    PIL image straight to the model's loader, which only converts to RGB.
+    """
+    pages = load_sample_pages(args)
+    if not pages:
+        print("❌ No benchmark images found")
+        return
+    
+    def jpeg_round_trip(page):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            temp_image_path = os.path.join(temp_dir, "page.jpg")
+            page.save(temp_image_path, 'JPEG')
+            with Image.open(temp_image_path) as reloaded:
+                ImageOps.exif_transpose(reloaded).convert("RGB")
+    
+    def in_memory(page):
+        page.convert("RGB")
+    
+    print(f"📊 Page hand-off benchmark ({len(pages)} pages)")
+    round_trip_ms = time_per_page(jpeg_round_trip, pages)
+    in_memory_ms = time_per_page(in_memory, pages)
+    
+    print(f"   JPEG temp-file round-trip: {round_trip_ms:8.2f} ms/page")
+    print(f"   In-memory hand-off:        {in_memory_ms:8.2f} ms/page")
+    print(f"   ✅ Saved:                  {round_trip_ms - in_memory_ms:8.2f} ms/page")
+
+
+def load_ocr_model(**kwargs):
+    """Load DeepSeek-OCR with the result cache disabled so every page hits the model"""
+    from deepseek_ocr import DeepSeekOCR
+    
+    ocr = DeepSeekOCR(use_cache=False, **kwargs)
+    if not ocr.initialize():
+        return None
+    return ocr
+
+
+def benchmark_batch(args):
+    """
+    Compare DeepSeek-OCR throughput of the sequential page loop and batched inference
+    """
+    batch_size = int(args[0]) if args and args[0].isdigit() else 4
+    pages = load_sample_pages(args[1:] if args and args[0].isdigit() else args)
+    if not pages:
+        print("❌ No benchmark images found")
+        return
+    
+    ocr = load_ocr_model(batch_size=batch_size)
+    if ocr is None:
+        print("❌ Could not load DeepSeek-OCR")
+        return
+    
+    # Warm-up (kernel selection, allocator growth)
+    ocr.extract_text_from_image(pages[0])
+    
+    start = time.perf_counter()
+    for page in pages:
+        ocr.extract_text_from_image(page)
+    sequential_s = time.perf_counter() - start
+    
+    start = time.perf_counter()
+    ocr.extract_text_from_images_batch(pages, batch_size=batch_size)
+    batched_s = time.perf_counter() - start
+    
+    print(f"\n📊 Batched inference benchmark ({len(pages)} pages, batch size {batch_size})")
+    print(f"   Sequential loop: {len(pages) / sequential_s:6.3f} pages/s ({sequential_s:.1f}s)")
+    print(f"   Batched:         {len(pages) / batched_s:6.3f} pages/s ({batched_s:.1f}s)")
+    print(f"   ✅ Speed-up:     {sequential_s / batched_s:6.2f}x")
+
+
+def benchmark_pipeline(args):
+    """
+    Compare serial rasterize-then-OCR with the prefetching page pipeline
+    
+    Pipelined wall time should approach max(rasterize, infer) rather than their sum.
+    """
+    if not args or not os.path.exists(args[0]):
+        print("Usage: python benchmark_ocr.py pipeline <pdf>")
+        return
+    pdf_path = args[0]
+    
+    ocr = load_ocr_model(skip_blank_pages=False)
+    if ocr is None:
+        print("❌ Could not load DeepSeek-OCR")
+        return
+    
+    # Rasterization alone
+    start = time.perf_counter()
+    page_count = sum(1 for _ in ocr.iter_pdf_pages(pdf_path))
+    rasterize_s = time.perf_counter() - start
+    
+    ocr.prefetch_pages = 0
+    start = time.perf_counter()
+    ocr.extract_text_from_pdf(pdf_path)
+    serial_s = time.perf_counter() - start
+    infer_s = serial_s - rasterize_s
+    
+    ocr.prefetch_pages = 2
+    start = time.perf_counter()
+    ocr.extract_text_from_pdf(pdf_path)
+    pipelined_s = time.perf_counter() - start
+    
+    print(f"\n📊 Page pipeline benchmark ({page_count} pages)")
+    print(f"   Rasterize only:      {rasterize_s:8.1f}s")
+    print(f"   Inference (approx.): {infer_s:8.1f}s")
+    print(f"   Serial:              {serial_s:8.1f}s")
+    print(f"   Pipelined:           {pipelined_s:8.1f}s (ideal {max(rasterize_s, infer_s):.1f}s)")
+
+
+def benchmark_int8(args):
+    """
+    Compare the default bf16 profile with the cpu_int8 profile on the sample images
+    
+    Accuracy is reported as character-level agreement (difflib ratio) of the
+    int8 transcription with the bf16 transcription of the same page.
+    """
+    pages = load_sample_pages(args)
+    if not pages:
+        print("❌ No benchmark images found")
+        return
+    
+    results = {}
+    for profile in ("default", "cpu_int8"):
+        ocr = load_ocr_model(inference_profile=profile)
+        if ocr is None:
+            print(f"❌ Could not load DeepSeek-OCR ({profile} profile)")
+            return
+        
+        # Warm-up (kernel selection, allocator growth)
+        ocr.extract_text_from_image(pages[0])
+        
+        texts, seconds = [], []
+        for page in pages:
+            start = time.perf_counter()
+            texts.append(ocr.extract_text_from_image(page))
+            seconds.append(time.perf_counter() - start)
+        results[profile] = (texts, seconds)
+        
+        # Free the weights before loading the next profile
+        ocr.cleanup()
+    
+    names = [Path(p).name for p in sample_image_paths(args)]
+    base_texts, base_seconds = results["default"]
+    int8_texts, int8_seconds = results["cpu_int8"]
+    
+    print(f"\n📊 CPU int8 profile benchmark ({len(pages)} pages)")
+    print(f"   {'page':<16}{'bf16 s':>9}{'int8 s':>9}{'speed-up':>10}{'agreement':>11}")
+    agreements = []
+    for name, base_text, int8_text, base_s, int8_s in zip(names, base_texts, int8_texts, base_seconds, int8_seconds):
+        agreement = difflib.SequenceMatcher(None, base_text, int8_text).ratio()
+        agreements.append(agreement)
+        print(f"   {name:<16}{base_s:9.1f}{int8_s:9.1f}{base_s / int8_s:9.2f}x{agreement:10.1%}")
+    
+    print(f"   ✅ Total: {sum(base_seconds):.1f}s bf16 vs {sum(int8_seconds):.1f}s int8 "
+          f"({sum(base_seconds) / sum(int8_seconds):.2f}x), "
+          f"mean agreement {sum(agreements) / len(agreements):.1%}")
+
+
+def benchmark_moe(args):
+    """
+    Time each MoE layer's expert computation, per-expert loop vs grouped bmm
+    
+    Every DeepseekV2MoE layer of the loaded model is rebuilt from the repository
+    modeling code (see deepseek_ocr.load_repo_modeling) with the same weights. Random hidden states are routed by the
+    layer's own gate, then moe_infer runs once per path. Small token counts are
+    decode steps, large ones prefill.
+    """
+    import torch
+    from deepseek_ocr import load_repo_modeling
+    
+    token_counts = [int(a) for a in args if a.isdigit()] or [1, 4, 16, 256]
+    
+    ocr = load_ocr_model()
+    if ocr is None:
+        print("❌ Could not load DeepSeek-OCR")
+        return
+    
+    hub_layers = [m for m in ocr.model.modules() if type(m).__name__ == "DeepseekV2MoE"]
+    if not hub_layers:
+        print("❌ No DeepseekV2MoE layers in the loaded model")
+        return
+    modeling = load_repo_modeling(type(hub_layers[0]))
+    weight = next(hub_layers[0].experts[0].parameters())
+    device, dtype = weight.device, weight.dtype
+    
+    def time_ms(func, repeat=20):
+        func()
+        best = float("inf")
+        for _ in range(repeat):
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+            func()
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            best = min(best, time.perf_counter() - start)
+        return best * 1000
+    
+    print(f"\n📊 MoE expert benchmark ({len(hub_layers)} layers, {device.type} {dtype})")
+    print(f"   {'layer':<7}{'tokens':>7}{'loop ms':>10}{'grouped ms':>12}{'speed-up':>10}{'max diff':>11}")
+    totals = {}
+    with torch.no_grad():
+        for index, hub_layer in enumerate(hub_layers):
+            layer = modeling.DeepseekV2MoE(hub_layer.config).to(device=device, dtype=dtype).eval()
+            layer.load_state_dict(hub_layer.state_dict())
+            
+            for tokens in token_counts:
+                hidden = torch.randn(1, tokens, layer.config.hidden_size, device=device, dtype=dtype)
+                topk_idx, topk_weight, _ = layer.gate(hidden)
+                x = hidden.view(tokens, -1)
+                
+                layer.grouped_experts = False
+                loop_out = layer.moe_infer(x, topk_idx, topk_weight)
+                loop_ms = time_ms(lambda: layer.moe_infer(x, topk_idx, topk_weight))
+                layer.grouped_experts = True
+                grouped_out = layer.moe_infer(x, topk_idx, topk_weight)
+                grouped_ms = time_ms(lambda: layer.moe_infer(x, topk_idx, topk_weight))
+                
+                max_diff = (loop_out.float() - grouped_out.float()).abs().max().item()
+                loop_total, grouped_total = totals.get(tokens, (0.0, 0.0))
+                totals[tokens] = (loop_total + loop_ms, grouped_total + grouped_ms)
+                print(f"   {index:<7}{tokens:>7}{loop_ms:10.3f}{grouped_ms:12.3f}"
+                      f"{loop_ms / grouped_ms:9.2f}x{max_diff:11.2e}")
+            
+            del layer
+    
+    for tokens, (loop_total, grouped_total) in totals.items():
+        print(f"   ✅ {tokens} tokens, all layers: {loop_total:.2f} ms loop vs {grouped_total:.2f} ms grouped "
+              f"({loop_total / grouped_total:.2f}x)")
+
+
+def benchmark_compile(args):
+    """
+    Compare generated tokens/sec with eager and compiled MoE layers
+    
+    The same model reads every page eagerly, then again after each MoE layer
+    is compiled for decode steps (one warm-up page absorbs compilation).
+    Tokens are counted from the decoding guard's per-page report.
+    """
+    pages = load_sample_pages(args)
+    if not pages:
+        print("❌ No benchmark images found")
+        return
+    
+    ocr = load_ocr_model()
+    if ocr is None:
+        print("❌ Could not load DeepSeek-OCR")
+        return
+    layers = [m for m in ocr.model.modules() if hasattr(m, "compile_decode")]
+    if not layers:
+        print("❌ MoE layers are not running the repository modeling code")
+        return
+    
+    def tokens_per_second():
+        tokens, seconds = 0, 0.0
+        for page in pages:
+            start = time.perf_counter()
+            ocr.extract_text_from_image(page)
+            seconds += time.perf_counter() - start
+            tokens += sum(entry['generated_tokens'] for entry in ocr.last_decode_report)
+        return tokens / seconds, tokens, seconds
+    
+    # Warm-up (kernel selection, allocator growth)
+    ocr.extract_text_from_image(pages[0])
+    eager = tokens_per_second()
+    
+    compiled_layers = sum(1 for layer in layers if layer.compile_decode())
+    start = time.perf_counter()
+    ocr.extract_text_from_image(pages[0])
+    warmup_s = time.perf_counter() - start
+    compiled = tokens_per_second()
+    
+    print(f"\n📊 Compiled decode benchmark ({len(pages)} pages, {compiled_layers}/{len(layers)} MoE layers compiled)")
+    print(f"   Eager:    {eager[0]:7.2f} tokens/s ({eager[1]} tokens in {eager[2]:.1f}s)")
+    print(f"   Compiled: {compiled[0]:7.2f} tokens/s ({compiled[1]} tokens in {compiled[2]:.1f}s, "
+          f"first page {warmup_s:.1f}s incl. compilation)")
+    print(f"   ✅ Speed-up: {compiled[0] / eager[0]:.2f}x")
+
+
+def benchmark_rotary(args):
+    """
+    Time the rotary embedding part of decode steps, hub code vs repository code
+    
+    Each attention layer's rotary embedding is copied twice, once with the hub
+    class (tables rebuilt whenever the sequence grows, i.e. every decode step)
+    and once with the repository class (shared tables built at load, only
+    sliced). A decode step asks every layer for cos/sin at the current length
+    and rotates one query and one key position, as the attention layers do.
+    """
+    import copy
+    import torch
+    from deepseek_ocr import load_repo_modeling
+    
+    numbers = [int(a) for a in args if a.isdigit()]
+    steps = numbers[0] if numbers else 256
+    prompt_tokens = numbers[1] if len(numbers) > 1 else 1024
+    
+    ocr = load_ocr_model()
+    if ocr is None:
+        print("❌ Could not load DeepSeek-OCR")
+        return
+    
+    attention_layers = [m for m in ocr.model.modules()
+                        if type(m).__name__.startswith("DeepseekV2") and hasattr(m, "rotary_emb")]
+    decoder_layers = [m for m in ocr.model.modules() if type(m).__name__ == "DeepseekV2DecoderLayer"]
+    if not attention_layers or not decoder_layers:
+        print("❌ No DeepseekV2 attention layers with rotary embeddings in the loaded model")
+        return
+    hub = sys.modules[type(decoder_layers[0]).__module__]
+    modeling = load_repo_modeling(type(decoder_layers[0]))
+    device = attention_layers[0].rotary_emb.inv_freq.device
+    dtype = next(p.dtype for p in ocr.model.parameters() if p.is_floating_point())
+    
+    def copies(module_source):
+        rotaries = []
+        for layer in attention_layers:
+            rotary = copy.copy(layer.rotary_emb)
+            rotary._buffers = {"inv_freq": layer.rotary_emb.inv_freq}
+            rotary.__dict__.pop("cos_cached", None)
+            rotary.__dict__.pop("sin_cached", None)
+            rotary.__class__ = getattr(module_source, type(layer.rotary_emb).__name__)
+            rotary.max_seq_len_cached = None
+            rotaries.append((rotary, layer.num_heads))
+        return rotaries
+    
+    hub_rotaries = copies(hub)
+    repo_rotaries = copies(modeling)
+    modeling.precompute_rotary_tables(torch.nn.ModuleList([r for r, _ in repo_rotaries]), dtype=dtype)
+    rope_dim = attention_layers[0].qk_rope_head_dim
+    
+    def decode_steps(rotaries, apply_rotary_pos_emb):
+        outputs = []
+        for position in range(prompt_tokens, prompt_tokens + steps):
+            position_ids = torch.tensor([[position]], device=device)
+            for rotary, num_heads in rotaries:
+                q_pe = torch.ones(1, num_heads, 1, rope_dim, device=device, dtype=dtype)
+                k_pe = torch.ones(1, 1, 1, rope_dim, device=device, dtype=dtype)
+                cos, sin = rotary(q_pe, seq_len=position + 1)
+                outputs.append(apply_rotary_pos_emb(q_pe, k_pe, cos, sin, position_ids)[1])
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        return outputs
+    
+    results = {}
+    with torch.no_grad():
+        for name, rotaries, apply in (("hub", hub_rotaries, hub.apply_rotary_pos_emb),
+                                      ("repository", repo_rotaries, modeling.apply_rotary_pos_emb)):
+            decode_steps(rotaries[:1], apply)
+            start = time.perf_counter()
+            outputs = decode_steps(rotaries, apply)
+            results[name] = ((time.perf_counter() - start) / steps * 1000, outputs)
+    
+    max_diff = max((a.float() - b.float()).abs().max().item()
+                   for a, b in zip(results["hub"][1], results["repository"][1]))
+    hub_ms, repo_ms = results["hub"][0], results["repository"][0]
+    print(f"\n📊 Rotary decode-step benchmark ({len(attention_layers)} layers, {steps} steps after "
+          f"{prompt_tokens} prompt tokens, {device.type} {dtype})")
+    print(f"   Hub tables:         {hub_ms:8.3f} ms/step")
+    print(f"   Precomputed tables: {repo_ms:8.3f} ms/step")
+    print(f"   ✅ Speed-up: {hub_ms / repo_ms:.2f}x, max diff {max_diff:.2e}")
+
+
+def benchmark_offload(args):
+    """
+    Measure DeepSeek-OCR with its MoE experts offloaded to the checkpoint
+    
+    Reports load time and process RSS after loading, then reads every page
+    and reports decode tokens/sec, the expert hit rate of the resident set and
+    RSS again. Run it in a fresh process: RSS is the whole process, so a
+    fully resident model loaded alongside would hide the saving.
+    """
+    resident = int(args[0]) if args and args[0].isdigit() else None
+    pages = load_sample_pages(args[1:] if resident is not None else args)
+    if not pages:
+        print("❌ No benchmark images found")
+        return
+    
+    from deepseek_ocr import process_rss_bytes
+    kwargs = {'expert_offload': True}
+    if resident is not None:
+        kwargs['resident_experts'] = resident
+    start = time.perf_counter()
+    ocr = load_ocr_model(**kwargs)
+    load_s = time.perf_counter() - start
+    if ocr is None:
+        print("❌ Could not load DeepSeek-OCR")
+        return
+    if ocr.expert_offload_report() is None:
+        print("❌ Experts are not offloaded (see the load messages above)")
+        return
+    rss_loaded = process_rss_bytes() or 0
+    
+    tokens, start = 0, time.perf_counter()
+    for page in pages:
+        ocr.extract_text_from_image(page)
+        tokens += sum(entry['generated_tokens'] for entry in ocr.last_decode_report)
+    seconds = time.perf_counter() - start
+    report = ocr.expert_offload_report()
+    expert_mib = report['resident_bytes'] / max(report['resident_experts'], 1) / 2**20
+    
+    print(f"\n📊 Expert offload benchmark ({len(pages)} pages, up to {ocr.resident_experts} resident experts "
+          f"of ~{expert_mib:.1f} MiB)")
+    print(f"   Load:   {load_s:7.1f}s, RSS {rss_loaded / 2**30:.2f} GiB")
+    print(f"   Decode: {tokens / seconds:7.2f} tokens/s ({tokens} tokens in {seconds:.1f}s)")
+    print(f"   Experts: {report['hit_rate']:.1%} hit rate ({report['hits']} hits, {report['misses']} misses, "
+          f"{report['evictions']} evictions), {report['resident_bytes'] / 2**30:.2f} GiB resident")
+    print(f"   ✅ RSS after {len(pages)} pages: {(report['rss_bytes'] or 0) / 2**30:.2f} GiB")
+
+
+def benchmark_routing(args):
+    """
+    Profile how DeepSeek-OCR's MoE layers route the sample pages
+    
+    A DeepseekV2RoutingProfiler is attached for the whole run. Prints, per
+    MoE layer, the routing entropy against uniform routing, the share of
+    tokens taken by the busiest experts and the experts never used, then
+    moe_infer vs attention time. A .json or .csv first argument receives the
+    full per-expert data.
+    """
+    output = args[0] if args and args[0].endswith((".json", ".csv")) else None
+    pages = load_sample_pages(args[1:] if output else args)
+    if not pages:
+        print("❌ No benchmark images found")
+        return
+    
+    from deepseek_ocr import load_repo_modeling
+    ocr = load_ocr_model()
+    if ocr is None:
+        print("❌ Could not load DeepSeek-OCR")
+        return
+    layers = [m for m in ocr.model.modules() if hasattr(m, "moe_infer")]
+    if not layers:
+        print("❌ MoE layers are not running the repository modeling code")
+        return
+    
+    modeling = load_repo_modeling(type(layers[0]))
+    profiler = modeling.DeepseekV2RoutingProfiler()
+    profiler.attach(ocr.model)
+    start = time.perf_counter()
+    for page in pages:
+        ocr.extract_text_from_image(page)
+    seconds = time.perf_counter() - start
+    profiler.detach()
+    summary = profiler.summary()
+    
+    print(f"\n📊 MoE routing profile ({len(pages)} pages, {seconds:.1f}s)")
+    for layer in summary['moe_layers']:
+        counts = sorted(layer['tokens_per_expert'], reverse=True)
+        routed = max(sum(counts), 1)
+        top_share = sum(counts[:max(1, len(counts) // 8)]) / routed
+        print(f"   {layer['layer']}: {layer['tokens']} tokens, entropy {layer['routing_entropy']:.2f}/"
+              f"{layer['uniform_entropy']:.2f} nats, top 1/8 experts take {top_share:.0%}, "
+              f"{counts.count(0)} unused, moe_infer {layer['moe_infer_seconds']:.2f}s")
+    moe_s, attention_s = summary['total_moe_infer_seconds'], summary['total_attention_seconds']
+    print(f"   ⏱️ moe_infer {moe_s:.2f}s vs attention {attention_s:.2f}s "
+          f"({moe_s / max(moe_s + attention_s, 1e-9):.0%} MoE)")
+    
+    if output:
+        (profiler.to_csv if output.endswith(".csv") else profiler.to_json)(output)
+        print(f"   ✅ Routing data written to {output}")
+
+
+def benchmark_speculative(args):
+    """
+    Compare plain greedy decoding with n-gram prompt-lookup decoding
+    
+    The same model reads every page with drafting switched off, then with up
+    to `tokens` drafted tokens per step. The first page's text is used as the
+    reference text, standing in for the question paper. Greedy verification
+    should give the same text; pages that differ are listed.
+    """
+    draft_tokens = int(args[0]) if args and args[0].isdigit() else 10
+    pages = load_sample_pages(args[1:] if args and args[0].isdigit() else args)
+    if not pages:
+        print("❌ No benchmark images found")
+        return
+    
+    ocr = load_ocr_model(prompt_lookup_tokens=draft_tokens)
+    if ocr is None:
+        print("❌ Could not load DeepSeek-OCR")
+        return
+    
+    def read_pages():
+        texts, tokens, seconds, stats = [], 0, 0.0, []
+        for page in pages:
+            start = time.perf_counter()
+            texts.append(ocr.extract_text_from_image(page))
+            seconds += time.perf_counter() - start
+            tokens += sum(entry['generated_tokens'] for entry in ocr.last_decode_report)
+            if ocr.last_prompt_lookup_stats:
+                stats.append(ocr.last_prompt_lookup_stats)
+        return texts, tokens, seconds, stats
+    
+    # Warm-up (kernel selection, allocator growth)
+    ocr.prompt_lookup_tokens = 0
+    reference = ocr.extract_text_from_image(pages[0])
+    greedy = read_pages()
+    
+    ocr.prompt_lookup_tokens = draft_tokens
+    ocr.set_reference_text(reference)
+    speculative = read_pages()
+    
+    steps = sum(s['steps'] for s in speculative[3])
+    drafted = sum(s['drafted_tokens'] for s in speculative[3])
+    accepted = sum(s['accepted_tokens'] for s in speculative[3])
+    print(f"\n📊 Prompt-lookup decoding benchmark ({len(pages)} pages, up to {draft_tokens} drafted tokens)")
+    print(f"   Greedy:      {greedy[1] / greedy[2]:7.2f} tokens/s ({greedy[1]} tokens in {greedy[2]:.1f}s)")
+    print(f"   Speculative: {speculative[1] / speculative[2]:7.2f} tokens/s ({speculative[1]} tokens in "
+          f"{speculative[2]:.1f}s, {(accepted + steps) / max(steps, 1):.2f} tokens per forward, "
+          f"{accepted}/{drafted} drafted tokens accepted)")
+    print(f"   ✅ Speed-up: {speculative[1] / speculative[2] / (greedy[1] / greedy[2]):.2f}x")
+    differing = [i for i, (a, b) in enumerate(zip(greedy[0], speculative[0])) if a != b]
+    if differing:
+        print(f"   ⚠️ Text differs on page(s) {differing} (multi-token verification rounds differently)")
+    else:
+        print("   ✅ Identical text on every page")
+
+
+def benchmark_concurrent(args):
+    """
+    Compare throughput under concurrent requests with and without continuous batching
+    
+    `clients` threads each read every sample page, as concurrent uploads
+    would. Without continuous batching the pages take turns on the model
+    lock; with it their decode steps share forward passes (up to
+    OCR_DECODE_SLOTS pages at a time). Tokens are counted from each thread's
+    decode report.
+    """
+    clients = int(args[0]) if args and args[0].isdigit() else 4
+    pages = load_sample_pages(args[1:] if args and args[0].isdigit() else args)
+    if not pages:
+        print("❌ No benchmark images found")
+        return
+    
+    ocr = load_ocr_model(continuous_batching=True)
+    if ocr is None:
+        print("❌ Could not load DeepSeek-OCR")
+        return
+    if ocr.decode_scheduler_report() is None:
+        print("❌ Continuous batching is not available for this model")
+        return
+    
+    def serve_clients():
+        tokens = [0] * clients
+        
+        def client(index):
+            for page in pages:
+                ocr.extract_text_from_image(page)
+                tokens[index] += sum(entry['generated_tokens'] for entry in ocr.last_decode_report)
+        
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - start
+        return sum(tokens) / seconds, sum(tokens), seconds
+    
+    # Warm-up (kernel selection, allocator growth)
+    ocr.continuous_batching = False
+    ocr.extract_text_from_image(pages[0])
+    serial = serve_clients()
+    
+    ocr.continuous_batching = True
+    before = ocr.decode_scheduler_report()
+    batched = serve_clients()
+    after = ocr.decode_scheduler_report()
+    steps = after['steps'] - before['steps']
+    mean_batch = (after['decoded_tokens'] - before['decoded_tokens']) / max(steps, 1)
+    
+    print(f"\n📊 Concurrent requests benchmark ({clients} clients x {len(pages)} pages)")
+    print(f"   Model lock:          {serial[0]:7.2f} tokens/s ({serial[1]} tokens in {serial[2]:.1f}s)")
+    print(f"   Continuous batching: {batched[0]:7.2f} tokens/s ({batched[1]} tokens in {batched[2]:.1f}s, "
+          f"{mean_batch:.2f} pages per decode step)")
+    print(f"   ✅ Speed-up: {batched[0] / serial[0]:.2f}x")
+
+
+BENCHMARKS = {
+    "handoff": benchmark_handoff,
+    "batch": benchmark_batch,
+    "pipeline": benchmark_pipeline,
+    "int8": benchmark_int8,
+    "moe": benchmark_moe,
+    "compile": benchmark_compile,
+    "rotary": benchmark_rotary,
+    "offload": benchmark_offload,
+    "routing": benchmark_routing,
+    "speculative": benchmark_speculative,
+    "concurrent": benchmark_concurrent,
+}
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print(__doc__)
+        return
+    
+    BENCHMARKS[sys.argv[1]](sys.argv[2:])
+
+
+if __name__ == "__main__":
+    main()
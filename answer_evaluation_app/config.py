@@ -21,7 +21,47 @@ class Config:
     
     # OCR Settings
     OCR_DPI = 300  # DPI for PDF to image conversion
+    OCR_PAGE_WINDOW = 1  # Pages rasterized at once while streaming a PDF through OCR
+    OCR_PIPELINE_PREFETCH = 2  # Pages rasterized ahead on a background thread (0 = serial)
+    OCR_BATCH_SIZE = 1  # Pages decoded together by DeepSeek-OCR (1 = one page at a time)
+    OCR_SKIP_BLANK_PAGES = True  # Skip OCR for pages with no ink beyond ruling lines
+    BLANK_PAGE_INK_RATIO = 0.0015  # Residual ink fraction below which a page counts as blank
+    OCR_ADAPTIVE_RESOLUTION = True  # Start each page at the cheapest readable resolution, escalate on bad output
+    OCR_CROP_TO_CONTENT = True  # Crop pages to the written region and deskew before OCR
+    OCR_CROP_MARGIN = 0.02  # Padding kept around the writing (fraction of page size)
+    OCR_MAX_SKEW_DEGREES = 5.0  # Largest rotation searched when deskewing (0 = no deskew)
+    OCR_MODEL_REVISION = 'main'  # DeepSeek-OCR hub revision (pin a commit hash in production)
+    OCR_INFERENCE_PROFILE = 'default'  # 'default' (bf16, device_map auto) or 'cpu_int8' (CPU-only nodes)
+    OCR_DECODE_GUARD = True  # Budget output tokens by page density and stop decoding on repetition loops
+    OCR_MIN_NEW_TOKENS = 512  # Output budget of a page with no detected text lines
+    OCR_TOKENS_PER_LINE = 48  # Extra output budget per detected text line
+    OCR_REPETITION_WINDOW = 256  # Recent output tokens checked for a repetition loop
+    OCR_REPETITION_MIN_UNIQUE = 0.5  # Distinct 4-gram ratio below which the window counts as a loop (prose is ~0.9)
+    OCR_TIER_TIME_BUDGETS = {'deepseek': 300, 'deepseek_small': 120, 'tesseract': 60}  # Seconds per page for each OCR fallback tier
+    OCR_COMPILE_DECODE = False  # torch.compile the MoE layers for decode steps on GPU (slow first page while compiling)
+    OCR_SDPA_ATTENTION = True  # Fused scaled_dot_product_attention instead of eager attention when flash-attn is missing
+    OCR_STATIC_KV_CACHE = False  # Decode into a KV cache preallocated for prompt + output budget (no per-step reallocation)
+    OCR_EXPERT_OFFLOAD = False  # Page MoE experts in from the memory-mapped checkpoint on use (low-RAM hosts, faster cold start)
+    OCR_RESIDENT_EXPERTS = 256  # Experts kept materialized by OCR_EXPERT_OFFLOAD (~7 MB each in bf16), least recently used evicted
+    OCR_PROMPT_LOOKUP_TOKENS = 0  # Speculative decoding: draft up to N tokens per step from n-grams of the page output / question paper (0 = off; output unchanged)
+    OCR_PROMPT_LOOKUP_NGRAM = 3  # Longest n-gram matched when drafting
+    OCR_CONTINUOUS_BATCHING = False  # Decode pages of concurrent requests in one running batch; pages join and leave it independently
+    OCR_DECODE_SLOTS = 4  # Pages the continuous-batching scheduler decodes together (each slot preallocates its KV cache)
+    OCR_DECODE_SLOT_TOKENS = 4096  # Prompt + output tokens per slot; longer pages decode on their own
+    TEXT_LAYER_MIN_CHARS = 30  # Pages with less extractable text than this are sent to OCR
+    
+    # OCR Result Cache (re-uploaded papers skip the OCR model entirely)
+    OCR_CACHE_ENABLED = True
+    OCR_CACHE_FOLDER = 'ocr_cache'
+    OCR_CACHE_MAX_MB = 512  # Least recently used entries are evicted beyond this size
+    
+    # Shared OCR Server (one model load for every web worker; empty = load in-process)
+    OCR_SERVER_URL = os.environ.get('OCR_SERVER_URL', '')  # e.g. http://127.0.0.1:8765
+    OCR_SERVER_HOST = '127.0.0.1'
+    OCR_SERVER_PORT = 8765
+    OCR_SERVER_TIMEOUT = 1800  # Seconds a web worker waits for an OCR job
     OCR_LANGUAGE = 'eng'  # Tesseract language (eng, hin, etc.)
+    TESSERACT_WORKERS = None  # Tesseract processes for scanned PDFs (None = one per CPU core)
     
     # Tesseract Path (Windows - uncomment and modify if needed)
     # TESSERACT_PATH = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
@@ -0,0 +1,185 @@
+"""
+Decoding guard for DeepSeek-OCR generation
+Bounds how long the model may decode a page: the output budget follows the
+number of text lines seen on the page, decoding stops as soon as the model
+starts looping on a phrase, and an optional deadline caps wall-clock time.
+"""
+
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from transformers import StoppingCriteria
+
+# Import decoding settings
+try:
+    from config import Config
+    OCR_MIN_NEW_TOKENS = Config.OCR_MIN_NEW_TOKENS
+    OCR_TOKENS_PER_LINE = Config.OCR_TOKENS_PER_LINE
+    OCR_REPETITION_WINDOW = Config.OCR_REPETITION_WINDOW
+    OCR_REPETITION_MIN_UNIQUE = Config.OCR_REPETITION_MIN_UNIQUE
+except ImportError:
+    OCR_MIN_NEW_TOKENS = 512
+    OCR_TOKENS_PER_LINE = 48
+    OCR_REPETITION_WINDOW = 256
+    OCR_REPETITION_MIN_UNIQUE = 0.5
+
+# N-gram size used to measure repetition
+REPETITION_NGRAM = 4
+
+# Generated tokens between repetition checks
+REPETITION_CHECK_EVERY = 16
+
+
+def estimate_token_budget(complexity: Optional[dict], min_tokens: int = OCR_MIN_NEW_TOKENS,
+                          tokens_per_line: int = OCR_TOKENS_PER_LINE) -> Optional[int]:
+    """
+    Output token budget for a page from its estimated text density
+
+    Args:
+        complexity: Stats from page_screening.estimate_page_complexity
+        min_tokens: Budget of a page with no detected text lines
+        tokens_per_line: Allowance per text line, markup and box tags included
+
+    Returns:
+        max_new_tokens for the page, or None if the density is unknown
+    """
+    if not complexity:
+        return None
+    return int(min_tokens + tokens_per_line * complexity['line_count'])
+
+
+def _repetitive(tokens: List[int], min_unique: float, ngram: int = REPETITION_NGRAM) -> bool:
+    """True if too few of the n-grams in `tokens` are distinct"""
+    ngrams = [tuple(tokens[k:k + ngram]) for k in range(len(tokens) - ngram + 1)]
+    return bool(ngrams) and len(set(ngrams)) < min_unique * len(ngrams)
+
+
+def _loop_cut(tokens: List[int], window: int, ngram: int = REPETITION_NGRAM) -> int:
+    """
+    Position to cut a looping sequence at
+
+    The loop is the most frequent n-gram of the final window; everything from
+    its second occurrence on is a repeat, so one copy of the phrase is kept.
+    """
+    start = max(0, len(tokens) - window)
+    tail = tokens[start:]
+    counts = Counter(tuple(tail[k:k + ngram]) for k in range(len(tail) - ngram + 1))
+    if not counts:
+        return len(tokens)
+    loop_ngram = counts.most_common(1)[0][0]
+    positions = [k for k in range(len(tail) - ngram + 1) if tuple(tail[k:k + ngram]) == loop_ngram]
+    return start + positions[1] if len(positions) > 1 else len(tokens)
+
+
+class RepetitionStoppingCriteria(StoppingCriteria):
+    """
+    Stop a sequence once its recent output is stuck repeating itself
+    
+    Every `check_every` generated tokens the last `window` tokens of each row
+    are checked; a row whose n-grams are mostly duplicates is finished. The hub
+    generate() already bans exact 20-gram repeats, so loops show up as
+    near-repeats, which the distinct n-gram ratio still catches.
+    
+    Speculative decoding adds several tokens per step, and first calls the
+    criterion on unverified draft tokens, then again on the accepted (never
+    longer) sequence. A check point jumped over is checked on arrival, and a
+    verdict reached on tokens that were not accepted is dropped.
+    """
+    def __init__(self, prompt_length: int, window: int = OCR_REPETITION_WINDOW,
+                 min_unique: float = OCR_REPETITION_MIN_UNIQUE, check_every: int = REPETITION_CHECK_EVERY):
+        self.prompt_length = prompt_length
+        self.window = window
+        self.min_unique = min_unique
+        self.check_every = check_every
+        # Rows stopped for repetition -> generated length of the check that stopped them
+        self._stopped_at = {}
+        self._last_checkpoint = None
+        self._last_length = 0
+    
+    @property
+    def stopped_rows(self) -> set:
+        """Rows stopped for repetition"""
+        return set(self._stopped_at)
+    
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        generated = input_ids.shape[1] - self.prompt_length
+        checkpoint = generated - generated % self.check_every
+        # A call no longer than the previous one follows a draft probe: re-check
+        recheck = checkpoint != self._last_checkpoint or input_ids.shape[1] <= self._last_length
+        self._last_checkpoint, self._last_length = checkpoint, input_ids.shape[1]
+        
+        if recheck:
+            # Verdicts of earlier check points stand, later ones came from rejected drafts
+            self._stopped_at = {row: at for row, at in self._stopped_at.items() if at < checkpoint}
+            if checkpoint >= self.window:
+                start = self.prompt_length + checkpoint - self.window
+                for row, tokens in enumerate(input_ids[:, start:start + self.window].tolist()):
+                    if row not in self._stopped_at and _repetitive(tokens, self.min_unique):
+                        self._stopped_at[row] = checkpoint
+        
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for row in self._stopped_at:
+            done[row] = True
+        return done
+
+
+class DeadlineStoppingCriteria(StoppingCriteria):
+    """Stop every sequence once a time.monotonic() deadline has passed"""
+    def __init__(self, deadline: float):
+        self.deadline = deadline
+        self.expired = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        self.expired = self.expired or time.monotonic() >= self.deadline
+        return torch.full((input_ids.shape[0],), self.expired, dtype=torch.bool, device=input_ids.device)
+
+
+def finish_generation(output_ids: torch.LongTensor, prompt_length: int, eos_token_id: int,
+                      max_new_tokens: Optional[int], repetition: RepetitionStoppingCriteria = None,
+                      timed_out: bool = False) -> Tuple[torch.LongTensor, List[Dict]]:
+    """
+    Trim looping rows and report why each row stopped
+
+    Args:
+        output_ids: generate() output (prompt + generated tokens)
+        prompt_length: Length of the (padded) prompt
+        eos_token_id: End-of-sequence token (also used to pad trimmed rows)
+        max_new_tokens: Output budget the rows were decoded under
+        repetition: Repetition criterion used during generation, if any
+        timed_out: True if a DeadlineStoppingCriteria fired
+
+    Returns:
+        (output_ids, report) where report has one
+        {'stop_reason', 'generated_tokens', 'max_new_tokens'} per row and
+        stop_reason is "eos", "repetition", "timeout" or "length"
+    """
+    stopped_rows = repetition.stopped_rows if repetition is not None else set()
+    report = []
+    cuts = []
+    rows = output_ids[:, prompt_length:].tolist()
+
+    for row, tokens in enumerate(rows):
+        length = tokens.index(eos_token_id) if eos_token_id in tokens else len(tokens)
+        if row in stopped_rows:
+            stop_reason = "repetition"
+            length = _loop_cut(tokens[:length], repetition.window)
+        elif length < len(tokens):
+            stop_reason = "eos"
+        elif timed_out:
+            stop_reason = "timeout"
+        elif max_new_tokens is not None and length >= max_new_tokens:
+            stop_reason = "length"
+        else:
+            stop_reason = "eos"
+        cuts.append(length)
+        report.append({'stop_reason': stop_reason, 'generated_tokens': length,
+                       'max_new_tokens': max_new_tokens})
+
+    if stopped_rows:
+        output_ids = output_ids[:, :prompt_length + max(cuts)].clone()
+        for row, length in enumerate(cuts):
+            output_ids[row, prompt_length + length:] = eos_token_id
+
+    return output_ids, report
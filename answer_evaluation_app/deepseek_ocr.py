@@ -1,9 +1,36 @@
 import torch
-from transformers import AutoTokenizer, AutoModel
-from PIL import Image
+from transformers import (AutoConfig, AutoTokenizer, AutoModel, StoppingCriteriaList, LogitsProcessorList,
+                          NoRepeatNGramLogitsProcessor)
+from transformers.utils import cached_file
+from PIL import Image, ImageOps
+import numpy as np
 import os
-from pdf2image import convert_from_path
+import copy
+import contextlib
+import sys
+import shutil
+import itertools
+import threading
+import queue
+import time
+import types
+import importlib.util
+from pathlib import Path
+from typing import Dict, List
+import torch.nn.functional as F
+from pdf2image import convert_from_path, pdfinfo_from_path
 import tempfile
+try:
+    import pytesseract
+    TESSERACT_AVAILABLE = True
+except ImportError:
+    TESSERACT_AVAILABLE = False
+
+from ocr_cache import OCRResultCache, hash_image_pixels, hash_file
+from page_screening import (is_blank_page, crop_to_content, estimate_page_complexity, BLANK_PAGE_MARKER,
+                            BLANK_PAGE_INK_RATIO)
+from decoding_guard import (RepetitionStoppingCriteria, DeadlineStoppingCriteria,
+                            estimate_token_budget, finish_generation)
 
 # Import poppler configuration
 try:
@@ -11,15 +38,301 @@ try:
 except ImportError:
     POPPLER_PATH = None
 
+# Import OCR settings
+try:
+    from config import Config
+    OCR_DPI = Config.OCR_DPI
+    OCR_PAGE_WINDOW = Config.OCR_PAGE_WINDOW
+    OCR_MODEL_REVISION = Config.OCR_MODEL_REVISION
+    OCR_CACHE_ENABLED = Config.OCR_CACHE_ENABLED
+    OCR_BATCH_SIZE = Config.OCR_BATCH_SIZE
+    OCR_SKIP_BLANK_PAGES = Config.OCR_SKIP_BLANK_PAGES
+    OCR_PIPELINE_PREFETCH = Config.OCR_PIPELINE_PREFETCH
+    OCR_SERVER_URL = Config.OCR_SERVER_URL
+    OCR_INFERENCE_PROFILE = Config.OCR_INFERENCE_PROFILE
+    OCR_CROP_TO_CONTENT = Config.OCR_CROP_TO_CONTENT
+    OCR_ADAPTIVE_RESOLUTION = Config.OCR_ADAPTIVE_RESOLUTION
+    OCR_DECODE_GUARD = Config.OCR_DECODE_GUARD
+    OCR_TIER_TIME_BUDGETS = Config.OCR_TIER_TIME_BUDGETS
+    OCR_LANGUAGE = Config.OCR_LANGUAGE
+    OCR_COMPILE_DECODE = Config.OCR_COMPILE_DECODE
+    OCR_SDPA_ATTENTION = Config.OCR_SDPA_ATTENTION
+    OCR_STATIC_KV_CACHE = Config.OCR_STATIC_KV_CACHE
+    OCR_EXPERT_OFFLOAD = Config.OCR_EXPERT_OFFLOAD
+    OCR_RESIDENT_EXPERTS = Config.OCR_RESIDENT_EXPERTS
+    OCR_PROMPT_LOOKUP_TOKENS = Config.OCR_PROMPT_LOOKUP_TOKENS
+    OCR_PROMPT_LOOKUP_NGRAM = Config.OCR_PROMPT_LOOKUP_NGRAM
+    OCR_CONTINUOUS_BATCHING = Config.OCR_CONTINUOUS_BATCHING
+    OCR_DECODE_SLOTS = Config.OCR_DECODE_SLOTS
+    OCR_DECODE_SLOT_TOKENS = Config.OCR_DECODE_SLOT_TOKENS
+except ImportError:
+    OCR_DPI = 300
+    OCR_PAGE_WINDOW = 1
+    OCR_MODEL_REVISION = "main"
+    OCR_CACHE_ENABLED = True
+    OCR_BATCH_SIZE = 1
+    OCR_SKIP_BLANK_PAGES = True
+    OCR_PIPELINE_PREFETCH = 2
+    OCR_SERVER_URL = os.environ.get('OCR_SERVER_URL', '')
+    OCR_INFERENCE_PROFILE = "default"
+    OCR_CROP_TO_CONTENT = True
+    OCR_ADAPTIVE_RESOLUTION = True
+    OCR_DECODE_GUARD = True
+    OCR_TIER_TIME_BUDGETS = {'deepseek': 300, 'deepseek_small': 120, 'tesseract': 60}
+    OCR_LANGUAGE = 'eng'
+    OCR_COMPILE_DECODE = False
+    OCR_SDPA_ATTENTION = True
+    OCR_STATIC_KV_CACHE = False
+    OCR_EXPERT_OFFLOAD = False
+    OCR_RESIDENT_EXPERTS = 256
+    OCR_PROMPT_LOOKUP_TOKENS = 0
+    OCR_PROMPT_LOOKUP_NGRAM = 3
+    OCR_CONTINUOUS_BATCHING = False
+    OCR_DECODE_SLOTS = 4
+    OCR_DECODE_SLOT_TOKENS = 4096
+
+OCR_PROMPT = "<image>\n<|grounding|>Convert the document to markdown."
+
+# Pseudo file names handed to model.infer for pages that only live in memory
+IN_MEMORY_IMAGE_PREFIX = "memory://page-"
+
+# Resolution/tiling modes of DeepSeek-OCR, cheapest first:
+# (name, infer parameters, smallest readable text line height in model pixels, most text lines)
+# Small and Base squash the page into one 640/1024 view (100/256 vision tokens);
+# Gundam adds 640px tiles of the full-resolution page on top of a 1024 overview.
+OCR_MODES = (
+    ("small", {'base_size': 640, 'image_size': 640, 'crop_mode': False}, 16, 20),
+    ("base", {'base_size': 1024, 'image_size': 1024, 'crop_mode': False}, 16, 40),
+    ("gundam", {'base_size': 1024, 'image_size': 640, 'crop_mode': True}, 0, None),
+)
+
+# Inference profiles: "default" loads bf16 with device_map="auto";
+# "cpu_int8" loads fp32 on CPU and dynamically quantizes the language model's Linear layers
+INFERENCE_PROFILES = ("default", "cpu_int8")
+
+# Attention projections quantized by the cpu_int8 profile. kv_b_proj stays in
+# fp32: MLA attention reads its weight matrix directly to absorb it into q/o.
+INT8_ATTENTION_PROJECTIONS = ("q_proj", "q_a_proj", "q_b_proj", "kv_a_proj_with_mqa", "k_proj", "v_proj", "o_proj")
+INT8_MLP_PROJECTIONS = ("gate_proj", "up_proj", "down_proj")
+
+# Vision encoders and projector of the DeepSeek-OCR model (kept in fp32 by cpu_int8)
+VISION_MODULES = ("sam_model", "vision_model", "projector")
+
+# Per-page OCR fallback chain, best (and most expensive) first:
+# full adaptive DeepSeek, DeepSeek at the small single-view mode, Tesseract
+OCR_TIERS = ("deepseek", "deepseek_small", "tesseract")
+
+# Failure classes of the previous tier after which a tier is worth trying.
+# A smaller input helps with OOM and model errors, but decoding time is set by
+# the amount of text, so a timeout (or empty output) goes straight to Tesseract.
+TIER_RECOVERS_FROM = {
+    "deepseek_small": ("oom", "error"),
+    "tesseract": ("oom", "error", "timeout", "empty"),
+}
+
+# Language model code of the repository (grouped, sync-free MoE experts, SDPA attention)
+REPO_MODELING_PATH = Path(__file__).resolve().parent.parent / "modeling_deepseekv2.py"
+
+# Keyword arguments of model.generate that carry per-page inputs (batched separately)
+PER_PAGE_GENERATE_KWARGS = ("images", "images_seq_mask", "images_spatial_crop", "attention_mask", "streamer")
+
+# Keyword arguments of model.generate the decode scheduler passes to a page's prefill forward call
+SCHEDULED_PREFILL_KWARGS = ("images", "images_seq_mask", "images_spatial_crop")
+
+
+def process_rss_bytes():
+    """Resident set size of this process, or None where /proc is unavailable"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def load_repo_modeling(hub_class):
+    """
+    Import the repository's modeling_deepseekv2.py into the package of a loaded hub class
+    
+    The hub model runs its own copy of the modeling code; placing the repository
+    file in the same package lets its relative imports (configuration_deepseek_v2)
+    resolve against the downloaded snapshot.
+    """
+    package = hub_class.__module__.rsplit(".", 1)[0]
+    name = f"{package}.modeling_deepseekv2_repo"
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(name, REPO_MODELING_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except Exception:
+        del sys.modules[name]
+        raise
+    return module
+
+
+class _GenerateCaptured(Exception):
+    """Raised from inside model.infer once it has prepared its generate() inputs"""
+    def __init__(self, args, kwargs):
+        super().__init__("generate inputs captured")
+        self.args = args
+        self.kwargs = kwargs
+
+
+class _PerThread:
+    """
+    Instance attribute holding a separate value for every thread
+    
+    The results of a call (last_page_report, last_decode_report, ...) are read
+    back by the thread that made it, and with continuous batching several
+    threads run pages on one instance at once. `default` is the initial value,
+    or a factory for it (list, dict).
+    """
+    def __init__(self, default=None):
+        self.default = default
+    
+    def __set_name__(self, owner, name):
+        self.name = name
+    
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        results = instance._thread_results
+        if not hasattr(results, self.name):
+            setattr(results, self.name, self.default() if callable(self.default) else self.default)
+        return getattr(results, self.name)
+    
+    def __set__(self, instance, value):
+        setattr(instance._thread_results, self.name, value)
+
+
 class DeepSeekOCR:
     """
     DeepSeek-OCR wrapper for extracting text from handwritten documents
     """
-    def __init__(self):
+    # Per-call results (see __init__), kept per calling thread
+    last_page_report = _PerThread(list)
+    _page_details = _PerThread(dict)
+    last_ocr_mode = _PerThread()
+    last_ocr_modes = _PerThread(list)
+    last_decode_stop = _PerThread()
+    last_decode_stops = _PerThread(list)
+    last_decode_report = _PerThread(list)
+    _max_new_tokens = _PerThread()
+    last_ocr_tier = _PerThread()
+    last_ocr_tiers = _PerThread(list)
+    last_prompt_lookup_stats = _PerThread()
+    
+    def __init__(
+        self,
+        page_window: int = OCR_PAGE_WINDOW,
+        dpi: int = OCR_DPI,
+        use_cache: bool = OCR_CACHE_ENABLED,
+        batch_size: int = OCR_BATCH_SIZE,
+        skip_blank_pages: bool = OCR_SKIP_BLANK_PAGES,
+        prefetch_pages: int = OCR_PIPELINE_PREFETCH,
+        inference_profile: str = OCR_INFERENCE_PROFILE,
+        crop_to_content: bool = OCR_CROP_TO_CONTENT,
+        adaptive_resolution: bool = OCR_ADAPTIVE_RESOLUTION,
+        decode_guard: bool = OCR_DECODE_GUARD,
+        compile_decode: bool = OCR_COMPILE_DECODE,
+        sdpa_attention: bool = OCR_SDPA_ATTENTION,
+        static_kv_cache: bool = OCR_STATIC_KV_CACHE,
+        expert_offload: bool = OCR_EXPERT_OFFLOAD,
+        resident_experts: int = OCR_RESIDENT_EXPERTS,
+        prompt_lookup_tokens: int = OCR_PROMPT_LOOKUP_TOKENS,
+        continuous_batching: bool = OCR_CONTINUOUS_BATCHING,
+        decode_slots: int = OCR_DECODE_SLOTS
+    ):
+        # Storage of the _PerThread attributes
+        self._thread_results = threading.local()
         self.model = None
         self.tokenizer = None
         self.model_name = "deepseek-ai/DeepSeek-OCR"
+        self.model_revision = OCR_MODEL_REVISION
         self.initialized = False
+        self.page_window = max(1, int(page_window))
+        self.dpi = dpi
+        self.batch_size = max(1, int(batch_size))
+        self.skip_blank_pages = skip_blank_pages
+        self.prefetch_pages = max(0, int(prefetch_pages))
+        self.crop_to_content = crop_to_content
+        self.adaptive_resolution = adaptive_resolution
+        self.decode_guard = decode_guard
+        self.compile_decode = compile_decode
+        self.sdpa_attention = sdpa_attention
+        self.static_kv_cache = static_kv_cache
+        self.expert_offload = expert_offload
+        self.resident_experts = max(1, int(resident_experts))
+        self.prompt_lookup_tokens = max(0, int(prompt_lookup_tokens))
+        self.continuous_batching = continuous_batching
+        self.decode_slots = max(1, int(decode_slots))
+        
+        if inference_profile not in INFERENCE_PROFILES:
+            raise ValueError(f"Unknown OCR inference profile '{inference_profile}' "
+                             f"(expected one of {', '.join(INFERENCE_PROFILES)})")
+        self.inference_profile = inference_profile
+        
+        # Per-page outcome of the last extract_text_from_pdf call
+        self.last_page_report = []
+        # Crop box / skew / OCR mode of pages, by page tag, until reported
+        self._page_details = {}
+        # OCR mode that produced the last extract_text_from_image result
+        # (last_ocr_modes: one per page of the last batch)
+        self.last_ocr_mode = None
+        self.last_ocr_modes = []
+        # Why decoding stopped ("eos", "repetition", "length") for the last
+        # image / each image of the last batch (None when served from cache)
+        self.last_decode_stop = None
+        self.last_decode_stops = []
+        # One entry per sequence of the last generate() call
+        self.last_decode_report = []
+        # Output budget applied by the decoding guard to the current generate() call
+        self._max_new_tokens = None
+        # Fallback tier that read the last image / each image of the last batch:
+        # {'tier', 'failures'} with the failure class of every tier tried before
+        self.last_ocr_tier = None
+        self.last_ocr_tiers = []
+        # KV cache memory per generated token ({'layers', 'bytes_per_token',
+        # 'expanded_bytes_per_token'}), filled in by initialize()
+        self.kv_cache_report = None
+        # Preallocated KV cache class handed to generate(), set by initialize()
+        # when static_kv_cache is on and the repository code is installed
+        self._static_cache_class = None
+        # DeepseekV2ExpertOffload serving the MoE experts, set by initialize()
+        # when expert_offload is on (see expert_offload_report)
+        self._expert_store = None
+        # Speculative decoding (prompt_lookup_tokens): True once generate() can
+        # verify drafts, the text drafts may also come from (see
+        # set_reference_text) and the draft statistics of the last
+        # generate() call ({'steps', 'drafted_tokens', 'accepted_tokens',
+        # 'acceptance_rate', 'tokens_per_step'}, None if it did not draft)
+        self._prompt_lookup_ready = False
+        self._reference_text = None
+        self._reference_ids = None
+        self.last_prompt_lookup_stats = None
+        # Continuous batching: the DeepseekV2DecodeScheduler decoding the
+        # single-page generate() calls of every thread, the queue its worker
+        # thread takes them from, and the worker (see _install_decode_scheduler)
+        self._decode_scheduler = None
+        self._decode_jobs = queue.Queue()
+        self._decode_worker = None
+        # Time left in the running fallback tier, per calling thread
+        self._tier_state = threading.local()
+        
+        # Serializes access to the model (generate hooks are per instance);
+        # with continuous batching only generate() calls and scheduler steps take it
+        self._model_lock = threading.RLock()
+        
+        # Results keyed by page pixels + inference parameters
+        self.cache = OCRResultCache() if use_cache else None
+        
+        # In-memory page hand-off (see _install_in_memory_image_loader)
+        self.in_memory_pages = False
+        self._pending_images = {}
+        self._image_ids = itertools.count(1)
+        self._output_dir = None
         
     def initialize(self):
         """Initialize the model (lazy loading)"""
@@ -35,26 +348,21 @@ class DeepSeekOCR:
             print("🔄 Loading DeepSeek-OCR tokenizer...")
             self.tokenizer = AutoTokenizer.from_pretrained(
                 self.model_name, 
+                revision=self.model_revision,
                 trust_remote_code=True
             )
             
             print("📦 Loading DeepSeek-OCR model...")
-            try:
-                self.model = AutoModel.from_pretrained(
-                    self.model_name,
-                    trust_remote_code=True,
-                    torch_dtype=torch.bfloat16,
-                    device_map="auto"
-                ).eval()
-            except Exception as e:
-                print(f"⚠️ Flash attention failed, using eager attention: {e}")
-                self.model = AutoModel.from_pretrained(
-                    self.model_name,
-                    _attn_implementation='eager',
-                    trust_remote_code=True,
-                    torch_dtype=torch.bfloat16,
-                    device_map="auto"
-                ).eval()
+            if self.inference_profile == "cpu_int8":
+                self._load_cpu_int8_model()
+            else:
+                self._load_default_model()
+            
+            # model.infer insists on an output_path; create it once per instance
+            self._output_dir = tempfile.mkdtemp(prefix="deepseek_ocr_")
+            self._install_in_memory_image_loader()
+            self._install_decoding_guard()
+            self._install_repo_modeling()
             
             self.initialized = True
             print("✅ DeepSeek-OCR initialized successfully!")
@@ -66,109 +374,1704 @@ class DeepSeekOCR:
             traceback.print_exc()
             return False
     
-    def extract_text_from_image(self, image_path: str) -> str:
+    def _load_default_model(self):
         """
-        Extract text from a single image using DeepSeek-OCR
+        Load bf16 weights and let accelerate place them (GPU when available)
+        
+        With expert_offload the routed MoE experts are not loaded at all (see
+        _expert_offload_device_map); _install_expert_offload serves them later.
+        """
+        device_map = self._expert_offload_device_map() if self.expert_offload else "auto"
+        try:
+            self.model = AutoModel.from_pretrained(
+                self.model_name,
+                revision=self.model_revision,
+                trust_remote_code=True,
+                torch_dtype=torch.bfloat16,
+                device_map=device_map
+            ).eval()
+        except Exception as e:
+            print(f"⚠️ Flash attention failed, using eager attention: {e}")
+            self.model = AutoModel.from_pretrained(
+                self.model_name,
+                revision=self.model_revision,
+                _attn_implementation='eager',
+                trust_remote_code=True,
+                torch_dtype=torch.bfloat16,
+                device_map=device_map
+            ).eval()
+    
+    def _expert_offload_device_map(self):
+        """
+        device_map that leaves the routed MoE experts on disk
+        
+        The experts are most of the checkpoint. Mapped to "disk", they are
+        never read by from_pretrained: accelerate points them at the
+        checkpoint's own safetensors files. Everything else goes to the GPU
+        (CPU without one). The map only splits the modules that contain
+        expert lists; accelerate needs every weight covered explicitly.
         
-        Args:
-            image_path: Path to the image file
-            
         Returns:
-            Extracted text as string
+            device_map for from_pretrained, or "auto" if the model cannot be
+            laid out without loading it
         """
-        if not self.initialized:
-            if not self.initialize():
-                return ""
+        try:
+            from accelerate import init_empty_weights
+            config = AutoConfig.from_pretrained(self.model_name, revision=self.model_revision,
+                                                trust_remote_code=True)
+            with init_empty_weights():
+                empty_model = AutoModel.from_config(config, trust_remote_code=True)
+        except Exception as e:
+            print(f"⚠️ Could not lay out the model for expert offload, loading every expert: {e}")
+            return "auto"
+        
+        expert_lists = {
+            f"{name}.experts" for name, module in empty_model.named_modules()
+            if type(module).__name__ == "DeepseekV2MoE"
+        }
+        device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        device_map = {}
+        
+        def place(prefix, module):
+            if prefix in expert_lists:
+                device_map[prefix] = "disk"
+            elif prefix and not any(name.startswith(prefix + ".") for name in expert_lists):
+                device_map[prefix] = device
+            else:
+                own_tensors = itertools.chain(module.named_parameters(recurse=False),
+                                              module.named_buffers(recurse=False))
+                for name, _ in own_tensors:
+                    device_map[f"{prefix}.{name}" if prefix else name] = device
+                for name, child in module.named_children():
+                    place(f"{prefix}.{name}" if prefix else name, child)
+        
+        place("", empty_model)
+        return device_map
+    
+    def _load_cpu_int8_model(self):
+        """
+        Load fp32 weights on CPU and quantize the language model to dynamic int8
+        
+        Many CPUs emulate bf16 matmuls; int8 dynamic quantization uses the
+        native VNNI/AVX2 integer kernels instead. Only the Linear layers of
+        DeepseekV2MLP (dense MLPs, routed and shared experts) and the attention
+        projections are quantized. The vision encoder, projector, MoE gate and
+        lm_head keep fp32 weights.
+        """
+        try:
+            self.model = AutoModel.from_pretrained(
+                self.model_name,
+                revision=self.model_revision,
+                trust_remote_code=True,
+                torch_dtype=torch.float32
+            ).eval()
+        except Exception as e:
+            print(f"⚠️ Flash attention failed, using eager attention: {e}")
+            self.model = AutoModel.from_pretrained(
+                self.model_name,
+                revision=self.model_revision,
+                _attn_implementation='eager',
+                trust_remote_code=True,
+                torch_dtype=torch.float32
+            ).eval()
+        
+        targets = self._int8_target_modules(self.model)
+        print(f"⚙️ Quantizing {len(targets)} Linear layers to int8 (CPU profile)...")
+        torch.ao.quantization.quantize_dynamic(
+            self.model, qconfig_spec=targets, dtype=torch.qint8, inplace=True
+        )
+        
+        # model.infer casts page tensors to bf16; the vision tower now runs in fp32
+        for name, module in self.model.named_modules():
+            if name.rsplit(".", 1)[-1] in VISION_MODULES:
+                module.register_forward_pre_hook(self._cast_inputs_to_float32)
+    
+    @staticmethod
+    def _int8_target_modules(model) -> set:
+        """Qualified names of the Linear layers the cpu_int8 profile quantizes"""
+        targets = set()
+        for name, module in model.named_modules():
+            class_name = type(module).__name__
+            if class_name == "DeepseekV2MLP":
+                projections = INT8_MLP_PROJECTIONS
+            elif class_name.startswith(("DeepseekV2", "Llama")) and "Attention" in class_name:
+                projections = INT8_ATTENTION_PROJECTIONS
+            else:
+                continue
+            for projection in projections:
+                if isinstance(getattr(module, projection, None), torch.nn.Linear):
+                    targets.add(f"{name}.{projection}")
+        return targets
+    
+    @staticmethod
+    def _cast_inputs_to_float32(module, args):
+        """Forward pre-hook: cast floating point inputs to fp32"""
+        return tuple(
+            arg.float() if torch.is_tensor(arg) and arg.is_floating_point() else arg
+            for arg in args
+        )
+    
+    def _install_repo_modeling(self):
+        """
+        Run the language model's hot layers on the repository's modeling_deepseekv2.py
         
+        The hub checkpoint ships its own copy of the modeling code. Its MoE and
+        eager attention layers are switched to the repository classes; the
+        weights are untouched.
+        """
+        hub_class = next(
+            (type(m) for m in self.model.modules() if type(m).__name__ == "DeepseekV2DecoderLayer"), None
+        )
+        if hub_class is None:
+            return
         try:
-            # Prepare prompt for OCR
-            prompt = "<image>\n<|grounding|>Convert the document to markdown."
+            modeling = load_repo_modeling(hub_class)
+        except Exception as e:
+            print(f"⚠️ Repository modeling code unavailable, using the hub layers: {e}")
+            return
+        
+        self._install_repo_moe(modeling)
+        self._install_rotary_tables(modeling)
+        if self.sdpa_attention:
+            self._install_sdpa_attention(modeling)
+        if self.static_kv_cache:
+            self._install_static_cache(modeling)
+        if self.prompt_lookup_tokens:
+            self._install_prompt_lookup(modeling)
+        if self.continuous_batching:
+            self._install_decode_scheduler(modeling)
+        
+        self.kv_cache_report = modeling.kv_cache_bytes_per_token(self.model)
+        if self.kv_cache_report['layers']:
+            per_token = self.kv_cache_report['bytes_per_token']
+            expanded = self.kv_cache_report['expanded_bytes_per_token']
+            print(f"🧠 KV cache: {per_token / 1024:.1f} KiB/token over {self.kv_cache_report['layers']} layers "
+                  f"({per_token * 8192 / 2**20:.0f} MiB at 8192 tokens; per-head K/V would be "
+                  f"{expanded / 1024:.1f} KiB/token)")
+    
+    def _install_repo_moe(self, modeling):
+        """
+        Switch the MoE layers (and their gates) to the repository classes
+        
+        It computes experts as grouped GEMMs and, for decode steps, without
+        host syncs. With compile_decode each layer is also compiled for
+        decode-sized inputs. With expert_offload the experts are served from
+        the checkpoint instead (see _install_expert_offload).
+        """
+        layers = [m for m in self.model.modules() if type(m).__name__ == "DeepseekV2MoE"]
+        for layer in layers:
+            layer.__class__ = modeling.DeepseekV2MoE
+            layer.gate.__class__ = modeling.MoEGate
+        if layers and self.expert_offload:
+            self._install_expert_offload(modeling)
+        
+        if layers and self.compile_decode:
+            compiled = sum(1 for layer in layers if layer.compile_decode())
+            print(f"⚙️ Compiled {compiled}/{len(layers)} MoE layers for decoding "
+                  f"(first pages run slower while graphs compile)")
+    
+    def _install_expert_offload(self, modeling):
+        """
+        Serve the routed MoE experts from the memory-mapped checkpoint
+        
+        An expert's weights are paged in the first time the router picks it;
+        at most resident_experts stay materialized, the least recently used
+        is released. Offloaded layers run their experts one by one (no grouped
+        GEMM or compiled decode), trading decode speed for memory.
+        """
+        try:
+            checkpoint_dir = os.path.dirname(
+                cached_file(self.model_name, "config.json", revision=self.model_revision)
+            )
+            store = modeling.DeepseekV2ExpertOffload.from_checkpoint(checkpoint_dir, self.resident_experts)
+            offloaded = store.attach(self.model)
+        except Exception as e:
+            print(f"⚠️ Expert offload unavailable, experts stay as loaded: {e}")
+            return
+        if not offloaded:
+            print("⚠️ Expert offload unavailable - the checkpoint's experts are not plain Linear layers")
+            return
+        
+        self._expert_store = store
+        rss = process_rss_bytes()
+        print(f"💾 {offloaded} MoE experts paged in from the checkpoint on use, "
+              f"up to {store.max_resident_experts} resident"
+              + (f" (process RSS {rss / 2**30:.2f} GiB)" if rss is not None else ""))
+    
+    def expert_offload_report(self):
+        """
+        Memory and hit rate of the expert offload
+        
+        Returns:
+            DeepseekV2ExpertOffload.stats() ('resident_experts',
+            'resident_bytes', 'hits', 'misses', 'evictions', 'hit_rate') plus
+            'rss_bytes' of the process, or None when experts are not offloaded
+        """
+        if self._expert_store is None:
+            return None
+        report = self._expert_store.stats()
+        report['rss_bytes'] = process_rss_bytes()
+        return report
+    
+    def _install_rotary_tables(self, modeling):
+        """
+        Switch rotary embeddings to the repository classes and build their tables
+        
+        The hub classes rebuild their cos/sin tables whenever the sequence
+        outgrows them, which during decoding is every step, in every layer.
+        The repository classes share one table per (device, dtype) across
+        layers; it is built here for the model's dtype so decode steps only
+        slice it.
+        """
+        rotary_modules = [
+            m for m in self.model.modules()
+            if type(m).__name__.startswith("DeepseekV2") and type(m).__name__.endswith("RotaryEmbedding")
+        ]
+        for module in rotary_modules:
+            # Tables become plain attributes shared between layers, not per-layer buffers
+            module._buffers.pop("cos_cached", None)
+            module._buffers.pop("sin_cached", None)
+            module.__class__ = getattr(modeling, type(module).__name__)
+        
+        if rotary_modules:
+            tables = modeling.precompute_rotary_tables(self.model)
+            print(f"🌀 Rotary embeddings of {len(rotary_modules)} layers share {tables} precomputed table(s)")
+    
+    def _install_sdpa_attention(self, modeling):
+        """
+        Switch eager attention layers to scaled_dot_product_attention
+        
+        The hub code only offers eager and flash-attn attention, and flash-attn
+        is never available on CPU. MLA layers move to DeepseekV2SdpaAttention,
+        plain multi-head layers to the transformers Llama SDPA class. Layers
+        already running flash attention are left alone.
+        """
+        sdpa_classes = {
+            "DeepseekV2Attention": modeling.DeepseekV2SdpaAttention,
+            "LlamaAttention": modeling.LlamaSdpaAttention,
+        }
+        switched = 0
+        for module in self.model.modules():
+            sdpa_class = sdpa_classes.get(type(module).__name__)
+            if sdpa_class is not None and sdpa_class is not type(module):
+                module.__class__ = sdpa_class
+                switched += 1
+        if switched:
+            print(f"⚙️ {switched} attention layers use scaled_dot_product_attention")
+    
+    def _install_static_cache(self, modeling):
+        """
+        Decode into a KV cache preallocated for the prompt plus the page's budget
+        
+        The default cache concatenates onto every layer's tensors at each step.
+        DeepseekV2StaticCache writes in place instead and keeps the attention
+        shapes fixed for the whole page.
+        """
+        if not self._install_preallocated_cache_support(modeling):
+            print("⚠️ Static KV cache unavailable - no DeepseekV2Model in the checkpoint")
+            return
+        
+        self._static_cache_class = modeling.DeepseekV2StaticCache
+        print("🧮 Static KV cache: each page decodes into a buffer sized to its output budget")
+    
+    def _install_preallocated_cache_support(self, modeling) -> bool:
+        """
+        Let the language model attend over a preallocated KV cache
+        
+        The hub DeepseekV2Model.forward and the MLA layers not already switched
+        to SDPA cannot use DeepseekV2StaticCache or DeepseekV2SlotCache, so
+        they are replaced by the repository versions. Only this model's
+        modules change class; the hub classes are left as they are. Returns
+        False if there is no DeepseekV2Model.
+        """
+        language_model = next(
+            (m for m in self.model.modules()
+             if any(cls.__name__ == "DeepseekV2Model" for cls in type(m).__mro__)), None
+        )
+        if language_model is None:
+            return False
+        model_class = type(language_model)
+        hub_model_class = next(cls for cls in model_class.__mro__ if cls.__name__ == "DeepseekV2Model")
+        if "_repo_text_forward" not in vars(hub_model_class):
+            # Sits between the OCR model and the hub DeepseekV2Model, so the OCR
+            # model's super().forward() reaches the repository forward
+            text_model_class = type(hub_model_class.__name__, (hub_model_class,), {
+                "__module__": hub_model_class.__module__,
+                "forward": modeling.DeepseekV2Model.forward,
+                "_repo_text_forward": True,
+            })
+            if model_class is hub_model_class:
+                language_model.__class__ = text_model_class
+            else:
+                language_model.__class__ = type(model_class.__name__, (model_class, text_model_class),
+                                                {"__module__": model_class.__module__})
+        
+        repo_classes = {
+            "DeepseekV2Attention": modeling.DeepseekV2Attention,
+            "DeepseekV2FlashAttention2": modeling.DeepseekV2FlashAttention2,
+        }
+        for module in self.model.modules():
+            repo_class = repo_classes.get(type(module).__name__)
+            if repo_class is not None:
+                module.__class__ = repo_class
+        return True
+    
+    def _add_static_cache(self, input_ids: torch.Tensor, kwargs: dict):
+        """Give a generate() call a cache for input_ids plus its max_new_tokens"""
+        max_new_tokens = kwargs.get("max_new_tokens")
+        if self._static_cache_class is None or not max_new_tokens or kwargs.get("past_key_values") is not None:
+            return
+        if kwargs.get("prompt_lookup_num_tokens"):
+            # Draft verification rolls the cache back, which generate() only does for dynamic caches
+            return
+        kwargs["past_key_values"] = self._static_cache_class(
+            self.model, input_ids.shape[0], input_ids.shape[1] + max_new_tokens
+        )
+    
+    def _install_prompt_lookup(self, modeling):
+        """
+        Decode speculatively: draft tokens by n-gram lookup, verify them in one forward
+        
+        generate() drafts up to prompt_lookup_tokens tokens from what followed
+        the last few tokens earlier in the page's output or in the reference
+        text (NgramCandidateGenerator), and keeps the ones the model agrees
+        with, so the text is the same as plain greedy decoding. The verifying
+        forward passes several tokens at once, so it goes through
+        _install_cached_text_forward.
+        """
+        is_causal_lm = any(cls.__name__ == "DeepseekV2ForCausalLM" for cls in type(self.model).__mro__)
+        if not is_causal_lm or not self._install_cached_text_forward():
+            print("⚠️ Speculative decoding unavailable - no DeepseekV2 language model in the checkpoint")
+            return
+        # generate() looks the method up on the model, so this instance is enough
+        self.model._get_candidate_generator = types.MethodType(
+            modeling.DeepseekV2ForCausalLM._get_candidate_generator, self.model
+        )
+        
+        self._prompt_lookup_ready = True
+        print(f"🔮 Speculative decoding: up to {self.prompt_lookup_tokens} n-gram drafted tokens "
+              f"verified per forward pass")
+    
+    def _install_cached_text_forward(self) -> bool:
+        """
+        Call the language model without image inputs once the prompt is cached
+        
+        The hub model takes any forward pass of more than one token for a
+        prompt and runs the vision encoder on it again, and its image handling
+        expects the page's image inputs at every step. Cached steps (draft
+        verification, decode scheduler steps) therefore go straight to
+        DeepseekV2Model.forward (the repository one once
+        _install_preallocated_cache_support has run). Returns False if there
+        is no DeepseekV2 language model.
+        """
+        language_model = getattr(self.model, "model", None)
+        text_model_class = next(
+            (cls for cls in type(language_model).__mro__ if cls.__name__ == "DeepseekV2Model"), None
+        )
+        if text_model_class is None:
+            return False
+        if type(language_model) is text_model_class or "forward" in vars(language_model):
+            return True
+        
+        page_forward = language_model.forward
+        
+        def forward(*args, **kwargs):
+            past_key_values = kwargs.get("past_key_values")
+            if args or past_key_values is None:
+                return page_forward(*args, **kwargs)
+            if hasattr(past_key_values, "get_seq_length"):
+                cached = past_key_values.get_seq_length()
+            else:
+                cached = past_key_values[0][0].shape[-2] if len(past_key_values) else 0
+            if not cached:
+                return page_forward(*args, **kwargs)
+            # Image features only ever enter through the prompt
+            for key in ("images", "images_seq_mask", "images_spatial_crop"):
+                kwargs.pop(key, None)
+            text_forward = next(
+                cls for cls in type(language_model).__mro__ if cls.__name__ == "DeepseekV2Model"
+            ).forward
+            return text_forward(language_model, **kwargs)
+        
+        language_model.forward = forward
+        return True
+    
+    def set_reference_text(self, text: str = None):
+        """
+        Text the pages are expected to repeat, e.g. the question paper
+        
+        With prompt_lookup_tokens, decoding also drafts from this text
+        (students copy question labels and equations). None clears it.
+        """
+        self._reference_text = text or None
+        self._reference_ids = None
+    
+    def _add_prompt_lookup(self, input_ids: torch.Tensor, kwargs: dict):
+        """Let a single-page greedy generate() call verify n-gram drafts"""
+        if (not self._prompt_lookup_ready or not self.prompt_lookup_tokens or input_ids.shape[0] != 1
+                or kwargs.get("do_sample") or kwargs.get("num_beams", 1) > 1):
+            return
+        if self._reference_text and self._reference_ids is None:
+            self._reference_ids = [self.tokenizer.encode(self._reference_text, add_special_tokens=False)]
+        generation_config = copy.deepcopy(kwargs.get("generation_config") or self.model.generation_config)
+        generation_config.prompt_lookup_reference_ids = self._reference_ids
+        kwargs.update(generation_config=generation_config, prompt_lookup_num_tokens=self.prompt_lookup_tokens,
+                      max_matching_ngram_size=OCR_PROMPT_LOOKUP_NGRAM)
+    
+    def _record_prompt_lookup(self, kwargs: dict):
+        """Keep the draft statistics of a generate() call that drafted"""
+        generator = getattr(self.model, "prompt_lookup_generator", None)
+        drafted = kwargs.get("prompt_lookup_num_tokens") and generator is not None
+        self.last_prompt_lookup_stats = generator.stats() if drafted else None
+    
+    def _install_decode_scheduler(self, modeling):
+        """
+        Decode the pages of concurrent requests together (continuous batching)
+        
+        Single-page generate() calls of every thread are handed to one
+        DeepseekV2DecodeScheduler, stepped by a worker thread. A page joins the
+        running decode batch as soon as a cache slot is free and leaves it as
+        soon as it is finished, so concurrent uploads share each forward pass
+        instead of taking turns on the model one page at a time. Pages that
+        would not fit a slot and batched generate() calls decode on their own.
+        """
+        if not self._install_preallocated_cache_support(modeling) or not self._install_cached_text_forward():
+            print("⚠️ Continuous batching unavailable - no DeepseekV2Model in the checkpoint")
+            return
+        self._decode_scheduler = modeling.DeepseekV2DecodeScheduler(
+            self.model, max_batch_size=self.decode_slots, max_cache_len=OCR_DECODE_SLOT_TOKENS
+        )
+        self._decode_worker = threading.Thread(target=self._decode_loop, name="ocr-decode-scheduler", daemon=True)
+        self._decode_worker.start()
+        
+        cache = self._decode_scheduler.cache
+        cache_bytes = sum(t.numel() * t.element_size() for t in cache.key_cache + cache.value_cache)
+        print(f"🚦 Continuous batching: up to {self.decode_slots} pages decode together "
+              f"({OCR_DECODE_SLOT_TOKENS} tokens per slot, {cache_bytes / 2**20:.0f} MiB KV cache)")
+    
+    def _scheduling(self) -> bool:
+        """True if single-page generate() calls go to the decode scheduler"""
+        return self.continuous_batching and self._decode_scheduler is not None
+    
+    def _schedulable(self, input_ids: torch.Tensor, kwargs: dict) -> bool:
+        """True if this generate() call can join the decode scheduler's batch"""
+        if (not self._scheduling() or input_ids is None or input_ids.shape[0] != 1 or kwargs.get("do_sample")
+                or kwargs.get("num_beams", 1) > 1 or kwargs.get("past_key_values") is not None):
+            return False
+        max_new_tokens = kwargs.get("max_new_tokens") or self.model.generation_config.max_new_tokens
+        # The last token is never written to the cache
+        return bool(max_new_tokens) and (
+            input_ids.shape[1] + max_new_tokens - 1 <= self._decode_scheduler.max_cache_len
+        )
+    
+    def _generate_scheduled(self, input_ids: torch.Tensor, stopping_criteria: StoppingCriteriaList,
+                            kwargs: dict) -> torch.Tensor:
+        """
+        Decode one page on the scheduler's worker thread and wait for it
+        
+        Returns:
+            Output ids (prompt + generated tokens) like generate()
+        """
+        logits_processor = LogitsProcessorList()
+        if kwargs.get("no_repeat_ngram_size"):
+            logits_processor.append(NoRepeatNGramLogitsProcessor(kwargs["no_repeat_ngram_size"]))
+        
+        job = {
+            'input_ids': input_ids,
+            'max_new_tokens': kwargs.get("max_new_tokens") or self.model.generation_config.max_new_tokens,
+            'eos_token_id': kwargs.get("eos_token_id", self.tokenizer.eos_token_id),
+            'logits_processor': logits_processor or None,
+            'stopping_criteria': stopping_criteria or None,
+            'model_kwargs': {key: kwargs[key] for key in SCHEDULED_PREFILL_KWARGS if key in kwargs},
+            'done': threading.Event(),
+            'output_ids': None,
+            'error': None,
+        }
+        self._decode_jobs.put(job)
+        job['done'].wait()
+        if job['error'] is not None:
+            raise job['error']
+        return job['output_ids'].to(input_ids.device)
+    
+    def _decode_loop(self):
+        """
+        Worker thread of the decode scheduler
+        
+        Submits queued pages, runs one scheduler step at a time under the
+        model lock (so other model users can interleave between steps) and
+        hands finished pages back. Blocks while there is nothing to decode; a
+        None job stops it. A failed step fails every page it was decoding.
+        """
+        scheduler = self._decode_scheduler
+        jobs = {}  # scheduler request id -> job
+        
+        def fail(error):
+            for request_id in scheduler.cancel():
+                job = jobs.pop(request_id)
+                job['error'] = error
+                job['done'].set()
+        
+        while True:
+            queued = []
+            if not scheduler.has_unfinished():
+                queued.append(self._decode_jobs.get())
+            while True:
+                try:
+                    queued.append(self._decode_jobs.get_nowait())
+                except queue.Empty:
+                    break
             
-            print(f"🚀 Running OCR on image: {os.path.basename(image_path)}")
+            for job in queued:
+                if job is None:
+                    fail(RuntimeError("DeepSeek-OCR was unloaded while the page was decoding"))
+                    return
+                try:
+                    request_id = scheduler.submit(
+                        job['input_ids'], job['max_new_tokens'], eos_token_id=job['eos_token_id'],
+                        logits_processor=job['logits_processor'], stopping_criteria=job['stopping_criteria'],
+                        **job['model_kwargs']
+                    )
+                except Exception as e:
+                    job['error'] = e
+                    job['done'].set()
+                    continue
+                jobs[request_id] = job
+            
+            try:
+                with self._model_lock, torch.no_grad(), self._autocast():
+                    finished = scheduler.step()
+            except Exception as e:
+                print(f"⚠️ Decode scheduler step failed, failing its {len(jobs)} page(s): {e}")
+                fail(e)
+                continue
             
-            # Create a temporary directory for output
-            with tempfile.TemporaryDirectory() as temp_output_dir:
-                # Run inference
+            for request_id, output_ids in finished:
+                job = jobs.pop(request_id)
+                job['output_ids'] = output_ids
+                job['done'].set()
+    
+    def decode_scheduler_report(self):
+        """
+        Continuous-batching statistics, None when it is off
+        
+        Returns:
+            {'steps', 'prefilled_sequences', 'decoded_tokens', 'mean_batch_size',
+            'running', 'waiting'} of the decode scheduler
+        """
+        if self._decode_scheduler is None:
+            return None
+        return self._decode_scheduler.stats()
+    
+    def _autocast(self):
+        """bf16 autocast for the default profile; int8 kernels need fp32 activations"""
+        return torch.autocast(
+            device_type=self.model.device.type,
+            dtype=torch.bfloat16,
+            enabled=self.inference_profile != "cpu_int8"
+        )
+    
+    def _install_in_memory_image_loader(self):
+        """
+        Let model.infer read pages straight from memory
+        
+        The remote DeepSeek-OCR code opens every image through its module-level
+        `load_image(path)`. We wrap that function so pseudo paths registered in
+        `self._pending_images` resolve to the PIL image we already hold, and any
+        real path still goes through the original loader.
+        """
+        module = sys.modules.get(type(self.model).__module__)
+        original_load_image = getattr(module, "load_image", None)
+        
+        if original_load_image is None:
+            print("⚠️ In-memory page hand-off unavailable - pages will be written to disk")
+            self.in_memory_pages = False
+            return
+        
+        pending_images = self._pending_images
+        
+        def load_image(image_path):
+            image = pending_images.get(image_path)
+            if image is not None:
+                return image
+            return original_load_image(image_path)
+        
+        module.load_image = load_image
+        self.in_memory_pages = True
+    
+    def _install_decoding_guard(self):
+        """
+        Wrap model.generate so every page decodes under a bounded budget
+        
+        model.infer always asks for its own fixed max_new_tokens. The wrapper
+        (an instance attribute shadowing the class method) lowers that to the
+        page's budget in `self._max_new_tokens`, adds a repetition stopping
+        criterion, trims looping output and records why each sequence stopped.
+        The time left in the current fallback tier (see _extract_with_fallback)
+        is enforced as a deadline even when the decode guard is switched off.
+        With static_kv_cache the call also gets a cache preallocated for the
+        final budget; with prompt_lookup_tokens, single pages decode
+        speculatively instead (see _install_prompt_lookup). With continuous
+        batching, single pages are decoded by the scheduler's worker thread
+        (see _install_decode_scheduler) and the calling thread waits.
+        """
+        original_generate = self.model.generate
+        
+        def guarded_generate(*args, **kwargs):
+            time_left = self._tier_time_left()
+            input_ids = args[0] if args else kwargs.get("input_ids", kwargs.get("inputs"))
+            max_new_tokens = kwargs.get("max_new_tokens")
+            if self.decode_guard and self._max_new_tokens is not None:
+                max_new_tokens = min(max_new_tokens or self._max_new_tokens, self._max_new_tokens)
+                kwargs["max_new_tokens"] = max_new_tokens
+            
+            scheduled = self._schedulable(input_ids, kwargs)
+            if not scheduled:
+                self._add_prompt_lookup(input_ids, kwargs)
+            if not self.decode_guard and time_left is None and not scheduled:
+                self._add_static_cache(input_ids, kwargs)
+                with self._model_lock:
+                    output_ids = original_generate(*args, **kwargs)
+                self._record_prompt_lookup(kwargs)
+                return output_ids
+            
+            criteria = StoppingCriteriaList(kwargs.pop("stopping_criteria", None) or [])
+            
+            repetition = None
+            if self.decode_guard:
+                repetition = RepetitionStoppingCriteria(input_ids.shape[1])
+                criteria.append(repetition)
+            if not scheduled:
+                self._add_static_cache(input_ids, kwargs)
+            
+            deadline = None
+            started = time.monotonic()
+            if time_left is not None:
+                deadline = DeadlineStoppingCriteria(started + time_left)
+                criteria.append(deadline)
+            
+            try:
+                if scheduled:
+                    output_ids = self._generate_scheduled(input_ids, criteria, kwargs)
+                else:
+                    with self._model_lock:
+                        output_ids = original_generate(*args, stopping_criteria=criteria, **kwargs)
+            finally:
+                if time_left is not None:
+                    self._tier_state.time_left = time_left - (time.monotonic() - started)
+            self._record_prompt_lookup(kwargs)
+            
+            eos_token_id = kwargs.get("eos_token_id", self.tokenizer.eos_token_id)
+            output_ids, self.last_decode_report = finish_generation(
+                output_ids, input_ids.shape[1], eos_token_id, max_new_tokens,
+                repetition=repetition, timed_out=deadline is not None and deadline.expired
+            )
+            for entry in self.last_decode_report:
+                if entry['stop_reason'] == "repetition":
+                    print(f"🔁 OCR decoding stopped on a repetition loop after "
+                          f"{entry['generated_tokens']} kept tokens")
+                elif entry['stop_reason'] == "length":
+                    print(f"✂️ OCR output truncated at its {max_new_tokens}-token budget")
+                elif entry['stop_reason'] == "timeout":
+                    print(f"⏱️ OCR decoding hit the tier time budget after {entry['generated_tokens']} tokens")
+            return output_ids
+        
+        self.model.generate = guarded_generate
+    
+    def _token_budget(self, image: Image.Image, complexity: dict = None):
+        """max_new_tokens for a page from its text density (None = model default)"""
+        if not self.decode_guard:
+            return None
+        if complexity is None:
+            try:
+                complexity = estimate_page_complexity(image)
+            except Exception as e:
+                print(f"⚠️ Page complexity estimate failed: {e}")
+                return None
+        return estimate_token_budget(complexity)
+    
+    def _last_decode_stop(self):
+        """Stop reason of the last single-page generate() call"""
+        return self.last_decode_report[-1]['stop_reason'] if self.last_decode_report else None
+    
+    def _to_pil_image(self, image) -> Image.Image:
+        """Normalize a PIL image or ndarray buffer to an RGB PIL image"""
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        return image
+    
+    def _run_infer(self, image_file: str, base_size: int, image_size: int, crop_mode: bool,
+                   max_new_tokens: int = None) -> str:
+        """
+        Single model.infer call on an image path or registered pseudo path
+        
+        With continuous batching the model lock is left to generate(), so the
+        pages of several threads can be decoding at once.
+        """
+        with contextlib.nullcontext() if self._scheduling() else self._model_lock:
+            self.last_decode_report = []
+            self._max_new_tokens = max_new_tokens
+            try:
                 result = self.model.infer(
                     tokenizer=self.tokenizer,
-                    prompt=prompt,
-                    image_file=image_path,
-                    output_path=temp_output_dir,  # Use temp directory instead of None
-                    base_size=1024,
-                    image_size=640,
-                    crop_mode=True,  # Use tiling for better accuracy
+                    prompt=OCR_PROMPT,
+                    image_file=image_file,
+                    output_path=self._output_dir,
+                    base_size=base_size,
+                    image_size=image_size,
+                    crop_mode=crop_mode,
                     save_results=False,
                     test_compress=False
                 )
-                
-                return result if result else ""
-            
+            finally:
+                self._max_new_tokens = None
+        return result if result else ""
+    
+    def _cache_key(self, content_hash: str, **params) -> str:
+        """Cache key for content processed with the current model and prompt"""
+        return OCRResultCache.make_key(
+            content_hash,
+            prompt=OCR_PROMPT,
+            model=self.model_name,
+            revision=self.model_revision,
+            profile=self.inference_profile,
+            decode_guard=self.decode_guard,
+            **params
+        )
+    
+    def _load_page_image(self, image) -> Image.Image:
+        """Open an image path (honouring EXIF rotation) or normalize a PIL image / ndarray"""
+        if isinstance(image, str):
+            with Image.open(image) as img:
+                return ImageOps.exif_transpose(img).convert("RGB")
+        return self._to_pil_image(image)
+    
+    def _select_ocr_mode(self, image: Image.Image):
+        """
+        Pick the cheapest OCR mode whose resolution can still read the page
+        
+        The page is squashed to base_size in the single-view modes, so the
+        handwriting must stay legible at that scale, and few vision tokens can
+        only carry a limited number of text lines.
+        
+        Returns:
+            Tuple of (index into OCR_MODES, complexity stats or None)
+        """
+        if not self.adaptive_resolution:
+            return len(OCR_MODES) - 1, None
+        try:
+            complexity = estimate_page_complexity(image)
         except Exception as e:
-            print(f"❌ Error extracting text from image: {e}")
-            # Try simpler configuration
+            print(f"⚠️ Page complexity estimate failed: {e}")
+            return len(OCR_MODES) - 1, None
+        
+        longest_side = max(complexity['page_size'])
+        for mode_index, (_, params, min_line_height, max_lines) in enumerate(OCR_MODES):
+            line_height = complexity['line_height'] * params['base_size'] / longest_side
+            if line_height >= min_line_height and (max_lines is None or complexity['line_count'] <= max_lines):
+                return mode_index, complexity
+        return len(OCR_MODES) - 1, complexity
+    
+    def _looks_degenerate(self, text: str, complexity: dict = None) -> bool:
+        """
+        Heuristic check that a low-resolution read failed
+        
+        Degenerate output is empty, far too short for the number of text lines
+        seen on the page, or stuck repeating itself.
+        """
+        text = (text or "").strip()
+        if not text:
+            return True
+        
+        if complexity and len(text) < 4 * complexity['line_count']:
+            return True
+        
+        lines = [line.strip() for line in text.splitlines() if line.strip()]
+        if len(lines) >= 6 and len(set(lines)) <= len(lines) // 3:
+            return True
+        
+        words = text.split()
+        if len(words) >= 24:
+            ngrams = [tuple(words[k:k + 4]) for k in range(len(words) - 3)]
+            if len(set(ngrams)) < 0.3 * len(ngrams):
+                return True
+        
+        return False
+    
+    def _extract_text_cached(self, image: Image.Image, infer_params: dict, pixels_hash: str = None,
+                             max_new_tokens: int = None) -> str:
+        """OCR one page with fixed parameters, going through the result cache"""
+        cache_key = None
+        if self.cache is not None and pixels_hash is not None:
             try:
-                print("🔄 Retrying with simpler configuration...")
-                with tempfile.TemporaryDirectory() as temp_output_dir:
-                    result = self.model.infer(
-                        tokenizer=self.tokenizer,
-                        prompt=prompt,
-                        image_file=image_path,
-                        output_path=temp_output_dir,  # Use temp directory instead of None
-                        base_size=640,
-                        image_size=640,
-                        crop_mode=False,
-                        save_results=False,
-                        test_compress=False
-                    )
-                    return result if result else ""
-            except:
-                import traceback
-                traceback.print_exc()
+                cache_key = self._cache_key(pixels_hash, **infer_params)
+                cached_text = self.cache.get(cache_key)
+                if cached_text is not None:
+                    print("⚡ OCR cache hit - skipping model inference")
+                    return cached_text
+            except Exception as e:
+                print(f"⚠️ OCR cache lookup failed: {e}")
+        
+        if not self.initialized:
+            if not self.initialize():
                 return ""
+        
+        text = self._extract_text_uncached(image, infer_params, max_new_tokens)
+        
+        # Never cache failures or output cut short by a tier time budget
+        if cache_key is not None and text and self._last_decode_stop() != "timeout":
+            self.cache.put(cache_key, text)
+        
+        return text
     
-    def extract_text_from_pdf(self, pdf_path: str) -> str:
+    def _cached_page_text(self, pixels_hash: str, mode_index: int, complexity: dict = None):
+        """
+        Cached result for a page at OCR_MODES[mode_index] or any mode above it
+        
+        A page escalated before is served at the mode that finally read it.
+        
+        Returns:
+            Tuple of (mode name, text), or None on a miss
         """
-        Extract text from PDF by converting to images and using DeepSeek-OCR
+        if self.cache is None or pixels_hash is None:
+            return None
+        for mode_name, infer_params, _, _ in OCR_MODES[mode_index:]:
+            cached_text = self.cache.get(self._cache_key(pixels_hash, **infer_params))
+            if cached_text is not None and not self._looks_degenerate(cached_text, complexity):
+                print(f"⚡ OCR cache hit ({mode_name} mode) - skipping model inference")
+                return mode_name, cached_text
+        return None
+    
+    def _extract_with_escalation(self, image: Image.Image, mode_index: int, complexity: dict = None,
+                                 pixels_hash: str = None, max_new_tokens: int = None) -> str:
+        """Read a page starting at OCR_MODES[mode_index], stepping up while the output looks degenerate"""
+        self.last_decode_stop = None
+        cached = self._cached_page_text(pixels_hash, mode_index, complexity)
+        if cached is not None:
+            self.last_ocr_mode, text = cached
+            return text
+        
+        text = ""
+        for index in range(mode_index, len(OCR_MODES)):
+            text = self._extract_at_mode(image, index, pixels_hash, max_new_tokens)
+            
+            if index == len(OCR_MODES) - 1 or not self._looks_degenerate(text, complexity):
+                break
+            if self.last_decode_stop == "timeout":
+                # Out of time for this tier; _extract_with_fallback takes over
+                break
+            print(f"🔼 {self.last_ocr_mode} output looks degenerate ({len(text.strip())} chars) - "
+                  f"escalating to {OCR_MODES[index + 1][0]}")
+        return text
+    
+    def _extract_at_mode(self, image: Image.Image, mode_index: int, pixels_hash: str = None,
+                         max_new_tokens: int = None) -> str:
+        """One OCR attempt at OCR_MODES[mode_index]; sets last_ocr_mode and last_decode_stop"""
+        mode_name, infer_params, _, _ = OCR_MODES[mode_index]
+        self.last_decode_report = []
+        text = self._extract_text_cached(image, infer_params, pixels_hash, max_new_tokens)
+        self.last_ocr_mode = mode_name
+        self.last_decode_stop = self._last_decode_stop()
+        return text
+    
+    def _tier_time_left(self):
+        """Seconds left in the calling thread's current fallback tier (None = unbounded)"""
+        return getattr(self._tier_state, 'time_left', None)
+    
+    @staticmethod
+    def _classify_failure(error: Exception = None, text: str = "", decode_stop: str = None):
+        """
+        Classify a failed OCR tier attempt
         
         Args:
-            pdf_path: Path to the PDF file
+            error: Exception raised by the tier, if any
+            text: Text the tier returned
+            decode_stop: Why the tier's last decode stopped
             
         Returns:
-            Extracted text from all pages
+            "oom", "timeout", "error" or "empty", or None if the attempt succeeded
+        """
+        if error is not None:
+            message = str(error).lower()
+            if (isinstance(error, (torch.cuda.OutOfMemoryError, MemoryError))
+                    or "out of memory" in message or "can't allocate memory" in message):
+                return "oom"
+            if isinstance(error, TimeoutError) or "timeout" in message or "timed out" in message:
+                return "timeout"
+            return "error"
+        if decode_stop == "timeout":
+            return "timeout"
+        if not (text or "").strip():
+            return "empty"
+        return None
+    
+    def _tesseract_text(self, image: Image.Image) -> str:
+        """Cheapest tier: Tesseract on the page, within the tier's time budget"""
+        if not TESSERACT_AVAILABLE:
+            raise RuntimeError("pytesseract not available")
+        self.last_ocr_mode = None
+        self.last_decode_stop = None
+        time_left = self._tier_time_left()
+        # pytesseract takes timeout=0 as "no limit"
+        timeout = 0 if time_left is None else max(1, int(time_left))
+        return pytesseract.image_to_string(image, lang=OCR_LANGUAGE, timeout=timeout)
+    
+    def _extract_with_fallback(self, image: Image.Image, primary=None, pixels_hash: str = None,
+                               max_new_tokens: int = None, failures: dict = None) -> str:
+        """
+        Read one page down the OCR_TIERS chain until a tier succeeds
+        
+        Each tier runs under its own time budget (OCR_TIER_TIME_BUDGETS) and a
+        failure is classified before choosing the next tier: an OOM or error
+        retries DeepSeek at the small single-view mode, while a timeout or
+        empty output drops straight to Tesseract. The tier that produced the
+        text is left in last_ocr_tier.
+        
+        Args:
+            image: Page image
+            primary: Callable running the full DeepSeek tier, or None if it
+                already ran and failed (see `failures`)
+            pixels_hash: Page hash for the result cache
+            max_new_tokens: Output token budget of the page
+            failures: Failure class per tier already tried
+            
+        Returns:
+            Text of the first successful tier, else the partial output of the
+            best failed tier (possibly empty)
+        """
+        failures = dict(failures or {})
+        runners = {
+            "deepseek": primary,
+            "deepseek_small": lambda: self._extract_at_mode(image, 0, pixels_hash, max_new_tokens),
+            "tesseract": lambda: self._tesseract_text(image),
+        }
+        partial_text, partial_tier, partial_state = "", None, (None, None)
+        
+        for tier in OCR_TIERS:
+            last_failure = list(failures.values())[-1] if failures else None
+            if runners[tier] is None or tier in failures:
+                continue
+            if last_failure is not None and last_failure not in TIER_RECOVERS_FROM.get(tier, ()):
+                continue
+            if tier == "tesseract" and not TESSERACT_AVAILABLE:
+                continue
+            if last_failure is not None:
+                print(f"↪️ Falling back to OCR tier '{tier}' after {last_failure}")
+            
+            started = time.monotonic()
+            self._tier_state.time_left = OCR_TIER_TIME_BUDGETS.get(tier)
+            try:
+                text = runners[tier]()
+                failure = self._classify_failure(text=text, decode_stop=self.last_decode_stop)
+            except Exception as e:
+                text = ""
+                failure = self._classify_failure(e)
+                print(f"❌ OCR tier '{tier}' failed: {e}")
+            finally:
+                self._tier_state.time_left = None
+            
+            if failure is None:
+                self.last_ocr_tier = {'tier': tier, 'failures': failures}
+                return text
+            
+            failures[tier] = failure
+            print(f"⚠️ OCR tier '{tier}' gave no usable text ({failure}, {time.monotonic() - started:.1f}s)")
+            if failure == "oom" and torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            if text.strip() and not partial_text:
+                partial_text, partial_tier = text, tier
+                partial_state = (self.last_ocr_mode, self.last_decode_stop)
+        
+        self.last_ocr_mode, self.last_decode_stop = partial_state
+        self.last_ocr_tier = {'tier': partial_tier, 'failures': failures}
+        return partial_text
+    
+    def extract_text_from_image(self, image) -> str:
+        """
+        Extract text from a single image using DeepSeek-OCR
+        
+        The cheapest resolution/tiling mode that should read the page is tried
+        first and escalated only if its output looks degenerate. Decoding is
+        bounded by the page's token budget (see _install_decoding_guard), and
+        a page DeepSeek cannot read falls back per _extract_with_fallback.
+        
+        Args:
+            image: Path to the image file, a PIL image or an ndarray buffer
+            
+        Returns:
+            Extracted text as string
+        """
+        try:
+            image = self._load_page_image(image)
+        except Exception as e:
+            print(f"❌ Error loading image: {e}")
+            return ""
+        
+        pixels_hash = None
+        if self.cache is not None:
+            try:
+                # Hash the pixels the model would see, not the file bytes
+                pixels_hash = hash_image_pixels(image)
+            except Exception as e:
+                print(f"⚠️ OCR cache lookup failed: {e}")
+        
+        mode_index, complexity = self._select_ocr_mode(image)
+        max_new_tokens = self._token_budget(image, complexity)
+        return self._extract_with_fallback(
+            image,
+            lambda: self._extract_with_escalation(image, mode_index, complexity, pixels_hash, max_new_tokens),
+            pixels_hash, max_new_tokens
+        )
+    
+    def _extract_text_uncached(self, image, infer_params: dict, max_new_tokens: int = None) -> str:
+        """
+        Run the model on one image
+        
+        Model errors (OOM, CUDA failures, ...) propagate so the fallback chain
+        can classify them instead of blindly re-running the model.
+        """
+        image_key = None
+        temp_image_file = None
+        
+        try:
+            if isinstance(image, str):
+                image_file = image
+                print(f"🚀 Running OCR on image: {os.path.basename(image_file)}")
+            else:
+                image = self._to_pil_image(image)
+                page_id = next(self._image_ids)
+                
+                if self.in_memory_pages:
+                    image_key = f"{IN_MEMORY_IMAGE_PREFIX}{page_id}"
+                    self._pending_images[image_key] = image
+                    image_file = image_key
+                else:
+                    # Loader hook unavailable, fall back to a JPEG round-trip
+                    temp_image_file = os.path.join(self._output_dir, f"page_{page_id}.jpg")
+                    image.save(temp_image_file, 'JPEG')
+                    image_file = temp_image_file
+                
+                print(f"🚀 Running OCR on in-memory page ({image.width}x{image.height})")
+            
+            return self._run_infer(image_file, max_new_tokens=max_new_tokens, **infer_params)
+        
+        finally:
+            if image_key is not None:
+                self._pending_images.pop(image_key, None)
+            if temp_image_file is not None and os.path.exists(temp_image_file):
+                os.remove(temp_image_file)
+    
+    def _capture_generate_inputs(self, image: Image.Image, infer_params: dict):
+        """
+        Run model.infer only up to its generate() call and return the prepared inputs
+        
+        This reuses the remote code's own preprocessing (prompt formatting, tiling,
+        image token layout) so batched pages are tokenized exactly like single ones.
+        
+        Returns:
+            (args, kwargs) passed to generate, or None if infer never reached it
+        """
+        capturing_thread = threading.get_ident()
+        
+        def capture_generate(*args, **kwargs):
+            if threading.get_ident() != capturing_thread:
+                # Another thread's page reached generate() meanwhile (continuous batching)
+                return generate(*args, **kwargs)
+            raise _GenerateCaptured(args, kwargs)
+        
+        image_key = f"{IN_MEMORY_IMAGE_PREFIX}{next(self._image_ids)}"
+        self._pending_images[image_key] = image
+        
+        with self._model_lock:
+            # Instance attribute shadows the class method for the duration of the call
+            previous_generate = self.model.__dict__.get("generate")
+            generate = self.model.generate
+            self.model.generate = capture_generate
+            try:
+                self._run_infer(image_key, **infer_params)
+            except _GenerateCaptured as captured:
+                return captured.args, captured.kwargs
+            except Exception as e:
+                print(f"⚠️ Could not prepare page for batching: {e}")
+            finally:
+                if previous_generate is not None:
+                    self.model.generate = previous_generate
+                else:
+                    del self.model.generate
+                self._pending_images.pop(image_key, None)
+        
+        return None
+    
+    def _generate_text_batch(self, prepared: list, max_new_tokens: int = None) -> List[str]:
+        """
+        Decode several prepared pages as one left-padded batch
+        
+        Vision encoding and prefill run once for the whole batch; finished rows
+        are padded by generate() while the longest page keeps decoding.
+        
+        Args:
+            prepared: (args, kwargs) tuples from _capture_generate_inputs
+            max_new_tokens: Output budget of the batch (the largest page budget)
+            
+        Returns:
+            Decoded text per page, in order
+        """
+        eos_token_id = self.tokenizer.eos_token_id
+        pad_token_id = self.tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = eos_token_id
+        
+        input_ids = [args[0] for args, _ in prepared]
+        max_len = max(ids.shape[1] for ids in input_ids)
+        
+        batch_ids, batch_mask, batch_seq_mask, batch_images, batch_crops = [], [], [], [], []
+        for ids, (_, kwargs) in zip(input_ids, prepared):
+            pad = max_len - ids.shape[1]
+            batch_ids.append(F.pad(ids, (pad, 0), value=pad_token_id))
+            mask = torch.ones_like(ids)
+            batch_mask.append(F.pad(mask, (pad, 0), value=0))
+            batch_seq_mask.append(F.pad(kwargs["images_seq_mask"], (pad, 0), value=False))
+            batch_images.extend(kwargs["images"])
+            batch_crops.append(torch.as_tensor(kwargs["images_spatial_crop"]).view(-1, 2))
+        
+        generate_kwargs = {
+            key: value for key, value in prepared[0][1].items()
+            if key not in PER_PAGE_GENERATE_KWARGS
+        }
+        generate_kwargs["pad_token_id"] = pad_token_id
+        
+        with self._model_lock, torch.no_grad(), self._autocast():
+            self.last_decode_report = []
+            self._max_new_tokens = max_new_tokens
+            try:
+                output_ids = self.model.generate(
+                    torch.cat(batch_ids, dim=0),
+                    attention_mask=torch.cat(batch_mask, dim=0),
+                    images=batch_images,
+                    images_seq_mask=torch.cat(batch_seq_mask, dim=0),
+                    images_spatial_crop=torch.cat(batch_crops, dim=0),
+                    **generate_kwargs
+                )
+            finally:
+                self._max_new_tokens = None
+        
+        texts = []
+        for row in output_ids[:, max_len:].tolist():
+            if eos_token_id in row:
+                row = row[:row.index(eos_token_id)]
+            texts.append(self.tokenizer.decode(row).strip())
+        return texts
+    
+    def extract_text_from_images_batch(self, images: list, batch_size: int = None) -> List[str]:
         """
+        Extract text from several images, sharing model forward passes between them
+        
+        Pages are grouped by their selected OCR mode (a batch must share one
+        resolution); pages whose output looks degenerate are escalated one by one
+        and pages DeepSeek cannot read go down the per-page fallback chain.
+        
+        Args:
+            images: Image paths, PIL images or ndarray buffers (may mix documents)
+            batch_size: Pages decoded together (defaults to the instance setting)
+            
+        Returns:
+            Extracted text per image, in input order (last_ocr_modes, last_decode_stops
+            and last_ocr_tiers hold the mode, decode stop and fallback tier per image)
+        """
+        batch_size = max(1, int(batch_size or self.batch_size))
+        
+        texts = [""] * len(images)
+        self.last_ocr_modes = [None] * len(images)
+        self.last_decode_stops = [None] * len(images)
+        self.last_ocr_tiers = [None] * len(images)
+        pending = {}  # mode index -> [(index, PIL image, pixels hash, complexity, token budget)]
+        
+        for index, image in enumerate(images):
+            try:
+                image = self._load_page_image(image)
+            except Exception as e:
+                print(f"❌ Error loading image {index + 1}: {e}")
+                continue
+            
+            mode_index, complexity = self._select_ocr_mode(image)
+            pixels_hash = hash_image_pixels(image) if self.cache is not None else None
+            
+            cached = self._cached_page_text(pixels_hash, mode_index, complexity)
+            if cached is not None:
+                self.last_ocr_modes[index], texts[index] = cached
+                self.last_ocr_tiers[index] = {'tier': "deepseek", 'failures': {}}
+                continue
+            max_new_tokens = self._token_budget(image, complexity)
+            pending.setdefault(mode_index, []).append((index, image, pixels_hash, complexity, max_new_tokens))
+        
+        if not pending:
+            print(f"⚡ All {len(images)} pages served from the OCR cache")
+            return texts
+        
+        def record(index, text):
+            texts[index] = text
+            self.last_ocr_modes[index] = self.last_ocr_mode
+            self.last_decode_stops[index] = self.last_decode_stop
+            self.last_ocr_tiers[index] = self.last_ocr_tier
+        
         if not self.initialized:
             if not self.initialize():
-                return ""
+                # Model unavailable: only the non-DeepSeek tiers can help
+                for entries in pending.values():
+                    for index, image, _, _, _ in entries:
+                        record(index, self._extract_with_fallback(
+                            image, failures={'deepseek': "error", 'deepseek_small': "error"}))
+                return texts
+        
+        top_mode = len(OCR_MODES) - 1
+        for mode_index, entries in sorted(pending.items()):
+            mode_name, infer_params, _, _ = OCR_MODES[mode_index]
+            
+            for start in range(0, len(entries), batch_size):
+                chunk = entries[start:start + batch_size]
+                print(f"🚀 Running batched OCR on {len(chunk)} page(s) ({mode_name} mode)...")
+                
+                batch_texts = None
+                if len(chunk) > 1:
+                    prepared = [self._capture_generate_inputs(entry[1], infer_params) for entry in chunk]
+                    if all(p is not None for p in prepared):
+                        # Rows decode side by side, so the batch gets one page's time budget
+                        self._tier_state.time_left = OCR_TIER_TIME_BUDGETS.get("deepseek")
+                        try:
+                            budgets = [entry[4] for entry in chunk]
+                            batch_texts = self._generate_text_batch(
+                                prepared, None if None in budgets else max(budgets))
+                            batch_stops = [entry['stop_reason'] for entry in self.last_decode_report]
+                        except Exception as e:
+                            print(f"⚠️ Batched inference failed, falling back to one page at a time: {e}")
+                            if self._classify_failure(e) == "oom" and torch.cuda.is_available():
+                                torch.cuda.empty_cache()
+                        finally:
+                            self._tier_state.time_left = None
+                    del prepared
+                
+                if batch_texts is None:
+                    # One page at a time, each down its own fallback chain
+                    for index, image, pixels_hash, complexity, max_new_tokens in chunk:
+                        record(index, self._extract_with_fallback(
+                            image,
+                            lambda: self._extract_with_escalation(image, mode_index, complexity, pixels_hash,
+                                                                  max_new_tokens),
+                            pixels_hash, max_new_tokens
+                        ))
+                    continue
+                
+                for (index, image, pixels_hash, complexity, max_new_tokens), text, stop in zip(
+                        chunk, batch_texts, batch_stops or [None] * len(chunk)):
+                    if pixels_hash is not None and text and stop != "timeout":
+                        self.cache.put(self._cache_key(pixels_hash, **infer_params), text)
+                    
+                    self.last_ocr_mode = mode_name
+                    self.last_decode_stop = stop
+                    self.last_ocr_tier = {'tier': "deepseek", 'failures': {}}
+                    failure = self._classify_failure(text=text, decode_stop=stop)
+                    
+                    if failure is None and (mode_index == top_mode or not self._looks_degenerate(text, complexity)):
+                        pass
+                    elif failure != "timeout" and mode_index < top_mode:
+                        print(f"🔼 Page {index + 1}: {mode_name} output looks degenerate - escalating")
+                        text = self._extract_with_fallback(
+                            image,
+                            lambda: self._extract_with_escalation(image, mode_index + 1, complexity, pixels_hash,
+                                                                  max_new_tokens),
+                            pixels_hash, max_new_tokens
+                        )
+                    else:
+                        fallback_text = self._extract_with_fallback(image, None, pixels_hash, max_new_tokens,
+                                                                     failures={'deepseek': failure})
+                        if fallback_text.strip() or not text.strip():
+                            text = fallback_text
+                        else:
+                            # Nothing better than the partial DeepSeek output
+                            self.last_ocr_tier['tier'] = "deepseek"
+                    
+                    record(index, text)
         
+        return texts
+    
+    def _is_blank(self, image, page_label: str) -> bool:
+        """NumPy pre-screen: True if the page carries no ink beyond ruling lines"""
+        if not self.skip_blank_pages:
+            return False
         try:
-            print(f"📄 Converting PDF to images: {os.path.basename(pdf_path)}")
+            blank, stats = is_blank_page(image)
+        except Exception as e:
+            print(f"⚠️ Blank-page screen failed on {page_label}: {e}")
+            return False
+        if blank:
+            print(f"⏭️ {page_label} looks blank (ink {stats['ink_ratio']:.3%}) - skipping OCR")
+        return blank
+    
+    def _prepare_page(self, image, tag):
+        """
+        Crop a rasterized page to its answer region and deskew it before OCR
+        
+        Margins and desk background would otherwise become extra vision tiles.
+        The crop box and angle are kept for the page report.
+        """
+        if not self.crop_to_content:
+            return image
+        try:
+            prepared, info = crop_to_content(image)
+        except Exception as e:
+            print(f"⚠️ Answer-region crop failed on page {tag}: {e}")
+            return image
+        self._page_details.setdefault(tag, {}).update(info)
+        if info['crop_box'] is not None or info['skew_angle']:
+            print(f"✂️ Page {tag}: cropped to {info['crop_box']} "
+                  f"({info['area_ratio']:.0%} of the page), deskewed {info['skew_angle']}°")
+        return prepared
+    
+    def _poppler_kwargs(self) -> dict:
+        """Extra pdf2image arguments for the configured poppler install"""
+        if POPPLER_PATH and os.path.exists(POPPLER_PATH):
+            return {'poppler_path': POPPLER_PATH}
+        # Assume poppler is in PATH
+        return {}
+    
+    def get_pdf_page_count(self, pdf_path: str) -> int:
+        """Return the number of pages in a PDF without rasterizing it"""
+        info = pdfinfo_from_path(pdf_path, **self._poppler_kwargs())
+        return int(info.get("Pages", 0))
+    
+    @staticmethod
+    def _page_ranges(page_numbers: List[int], window: int):
+        """Split sorted page numbers into contiguous (first, last) runs of at most `window` pages"""
+        first_page = last_page = None
+        for page_number in page_numbers:
+            if first_page is not None and page_number == last_page + 1 and page_number - first_page < window:
+                last_page = page_number
+                continue
+            if first_page is not None:
+                yield first_page, last_page
+            first_page = last_page = page_number
+        if first_page is not None:
+            yield first_page, last_page
+    
+    def iter_pdf_pages(self, pdf_path: str, page_window: int = None, page_numbers: List[int] = None):
+        """
+        Rasterize a PDF lazily, at most `page_window` pages at a time
+        
+        Args:
+            pdf_path: Path to the PDF file
+            page_window: Number of pages converted per poppler call
+                (defaults to the instance setting)
+            page_numbers: Only rasterize these pages (1-based, default all)
+            
+        Yields:
+            Tuples of (page_number, total_pages, PIL image), page numbers start at 1
+        """
+        window = max(1, int(page_window or self.page_window))
+        total_pages = self.get_pdf_page_count(pdf_path)
+        
+        if page_numbers is None:
+            wanted = range(1, total_pages + 1)
+        else:
+            wanted = sorted({int(n) for n in page_numbers if 1 <= int(n) <= total_pages})
+        
+        for first_page, last_page in self._page_ranges(wanted, window):
+            images = convert_from_path(
+                pdf_path,
+                dpi=self.dpi,
+                first_page=first_page,
+                last_page=last_page,
+                **self._poppler_kwargs()
+            )
             
-            # Convert PDF to images with poppler path from config
-            if POPPLER_PATH and os.path.exists(POPPLER_PATH):
-                images = convert_from_path(pdf_path, dpi=300, poppler_path=POPPLER_PATH)
+            page_number = first_page
+            # Pop pages off the window so each image is released once the caller moves on
+            while images:
+                image = images.pop(0)
+                yield page_number, total_pages, image
+                del image
+                page_number += 1
+    
+    def iter_pdf_pages_prefetched(self, pdf_path: str, page_window: int = None, prefetch: int = None,
+                                  page_numbers: List[int] = None):
+        """
+        Rasterize pages on a background thread while the caller runs OCR
+        
+        Poppler runs in a subprocess and PIL decodes outside the GIL, so page
+        N+1 is rasterized while page N is being OCRed. The bounded queue keeps
+        at most `prefetch` finished pages waiting, which bounds memory.
+        
+        Args:
+            pdf_path: Path to the PDF file
+            page_window: Pages converted per poppler call
+            prefetch: Pages rasterized ahead of the consumer (0 = no pipelining)
+            page_numbers: Only rasterize these pages (1-based, default all)
+            
+        Yields:
+            Same tuples as iter_pdf_pages
+        """
+        prefetch = self.prefetch_pages if prefetch is None else max(0, int(prefetch))
+        if prefetch == 0:
+            yield from self.iter_pdf_pages(pdf_path, page_window, page_numbers)
+            return
+        
+        pages = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        done = object()
+        
+        def put(item):
+            # Give up if the consumer has gone away instead of blocking forever
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+        
+        def rasterize():
+            try:
+                for page in self.iter_pdf_pages(pdf_path, page_window, page_numbers):
+                    if not put(page):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+        
+        producer = threading.Thread(target=rasterize, name="pdf-rasterizer", daemon=True)
+        producer.start()
+        
+        try:
+            while True:
+                item = pages.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                del item
+        finally:
+            stop.set()
+            producer.join(timeout=5)
+    
+    def iter_text_from_pdf(self, pdf_path: str, page_window: int = None, batch_size: int = None,
+                           page_numbers: List[int] = None):
+        """
+        Page-at-a-time OCR of a PDF; page N is rasterized only when it is needed
+        
+        Args:
+            pdf_path: Path to the PDF file
+            page_window: Number of pages rasterized ahead of the OCR loop
+            batch_size: Pages decoded together; the page window grows to match
+            page_numbers: Only OCR these pages (1-based, default all)
+            
+        Yields:
+            Tuples of (page_number, page_text)
+        """
+        batch_size = max(1, int(batch_size or self.batch_size))
+        
+        if batch_size > 1:
+            window = max(page_window or self.page_window, batch_size)
+            pages = ((page_number, image) for page_number, _, image in
+                     self.iter_pdf_pages_prefetched(pdf_path, window, page_numbers=page_numbers))
+            yield from self._iter_batched_text(pages, batch_size)
+            return
+        
+        for page_number, total_pages, image in self.iter_pdf_pages_prefetched(pdf_path, page_window,
+                                                                              page_numbers=page_numbers):
+            print(f"📄 Processing page {page_number}/{total_pages}...")
+            
+            if self._is_blank(image, f"Page {page_number}"):
+                yield page_number, BLANK_PAGE_MARKER
+                continue
+            
+            image = self._prepare_page(image, page_number)
+            
+            # Hand the rasterized page to the model without touching the filesystem
+            page_text = self.extract_text_from_image(image)
+            self._page_details.setdefault(page_number, {}).update(
+                ocr_mode=self.last_ocr_mode, decode_stop=self.last_decode_stop,
+                **self._tier_details(self.last_ocr_tier)
+            )
+            del image
+            
+            yield page_number, page_text
+    
+    def _iter_batched_text(self, pages, batch_size: int):
+        """
+        Group a stream of (tag, image) pages into batches and yield (tag, text)
+        
+        Only one batch of images is alive at a time. Blank pages keep their
+        place in the stream but are never sent to the model.
+        """
+        batch = []
+        
+        def flush():
+            images = [image for _, image in batch if image is not None]
+            texts = iter(self.extract_text_from_images_batch(images, batch_size) if images else [])
+            modes = iter(self.last_ocr_modes if images else [])
+            stops = iter(self.last_decode_stops if images else [])
+            tiers = iter(self.last_ocr_tiers if images else [])
+            for tag, image in batch:
+                if image is None:
+                    yield tag, BLANK_PAGE_MARKER
+                    continue
+                self._page_details.setdefault(tag, {}).update(
+                    ocr_mode=next(modes), decode_stop=next(stops), **self._tier_details(next(tiers)))
+                yield tag, next(texts)
+        
+        for tag, image in pages:
+            if self._is_blank(image, f"Page {tag}"):
+                image = None
             else:
-                # Try without explicit path (assumes poppler in PATH)
-                images = convert_from_path(pdf_path, dpi=300)
+                image = self._prepare_page(image, tag)
+            batch.append((tag, image))
+            if sum(image is not None for _, image in batch) == batch_size:
+                yield from flush()
+                batch = []
+        
+        if batch:
+            yield from flush()
+    
+    def extract_text_from_pdfs(self, pdf_paths: List[str], batch_size: int = None) -> List[str]:
+        """
+        OCR several queued PDFs, letting pages from different documents share batches
+        
+        Args:
+            pdf_paths: Paths to the PDF files
+            batch_size: Pages decoded together (defaults to the instance setting)
+            
+        Returns:
+            Extracted text per PDF, formatted like extract_text_from_pdf
+        """
+        batch_size = max(1, int(batch_size or self.batch_size))
+        page_texts = {index: [] for index in range(len(pdf_paths))}
+        results = [None] * len(pdf_paths)
+        cache_keys = {}
+        
+        for index, pdf_path in enumerate(pdf_paths):
+            if self.cache is not None:
+                cache_keys[index] = self._cache_key(hash_file(pdf_path), kind="pdf", dpi=self.dpi,
+                                                    crop=self.crop_to_content,
+                                                    adaptive=self.adaptive_resolution,
+                                                    skip_blank=self.skip_blank_pages,
+                                                    blank_ink=BLANK_PAGE_INK_RATIO)
+                results[index] = self.cache.get(cache_keys[index])
+        
+        def queued_pages():
+            for index, pdf_path in enumerate(pdf_paths):
+                if results[index] is not None:
+                    continue
+                print(f"📄 Queueing PDF pages: {os.path.basename(pdf_path)}")
+                window = max(self.page_window, batch_size)
+                for page_number, _, image in self.iter_pdf_pages_prefetched(pdf_path, window):
+                    yield (index, page_number), image
+        
+        completed = False
+        degraded = set()
+        try:
+            for (index, page_number), page_text in self._iter_batched_text(queued_pages(), batch_size):
+                if page_text:
+                    page_texts[index].append(f"\n--- Page {page_number} ---\n{page_text}\n")
+                if self._page_details.get((index, page_number), {}).get('ocr_failures'):
+                    degraded.add(index)
+            completed = True
+        except Exception as e:
+            print(f"❌ Error extracting text from PDFs: {e}")
+            import traceback
+            traceback.print_exc()
+        
+        self._page_details = {}
+        for index in range(len(pdf_paths)):
+            if results[index] is None:
+                results[index] = "\n".join(page_texts[index])
+                # Partial results from a failed run (or pages read by a fallback tier)
+                # are returned but never cached
+                if completed and index in cache_keys and results[index] and index not in degraded:
+                    self.cache.put(cache_keys[index], results[index])
+        
+        return results
+    
+    @staticmethod
+    def _tier_details(tier: dict) -> dict:
+        """Page-report fields for a last_ocr_tier entry (failures only when a tier failed)"""
+        if not tier:
+            return {}
+        details = {'ocr_tier': tier['tier']}
+        if tier['failures']:
+            details['ocr_failures'] = tier['failures']
+        return details
+    
+    def _page_record(self, page_number: int, page_text: str) -> dict:
+        """Per-page outcome entry for last_page_report"""
+        if page_text == BLANK_PAGE_MARKER:
+            status = "blank_skipped"
+        elif page_text:
+            status = "ocr"
+        else:
+            status = "empty"
+        record = {'page': page_number, 'status': status, 'characters': len(page_text or "")}
+        details = self._page_details.pop(page_number, {})
+        for key in ("ocr_mode", "decode_stop", "ocr_tier", "ocr_failures", "crop_box", "skew_angle"):
+            if key in details:
+                record[key] = details[key]
+        return record
+    
+    def extract_text_from_pdf(self, pdf_path: str) -> str:
+        """
+        Extract text from PDF by streaming its pages through DeepSeek-OCR
+        
+        Args:
+            pdf_path: Path to the PDF file
+            
+        Returns:
+            Extracted text from all pages
+        """
+        cache_key = None
+        if self.cache is not None:
+            try:
+                cache_key = self._cache_key(hash_file(pdf_path), kind="pdf", dpi=self.dpi,
+                                            crop=self.crop_to_content,
+                                            adaptive=self.adaptive_resolution,
+                                            skip_blank=self.skip_blank_pages,
+                                            blank_ink=BLANK_PAGE_INK_RATIO)
+                cached_text = self.cache.get(cache_key)
+                if cached_text is not None:
+                    print(f"⚡ OCR cache hit for {os.path.basename(pdf_path)} - skipping OCR entirely")
+                    return cached_text
+            except Exception as e:
+                print(f"⚠️ OCR cache lookup failed: {e}")
+        
+        try:
+            print(f"📄 Streaming PDF pages: {os.path.basename(pdf_path)} "
+                  f"(window: {self.page_window} page(s) at {self.dpi} DPI, "
+                  f"prefetch: {self.prefetch_pages})")
             
             all_text = []
+            page_count = 0
+            self.last_page_report = []
+            self._page_details = {}
             
-            # Create temporary directory for images
-            with tempfile.TemporaryDirectory() as temp_dir:
-                for i, image in enumerate(images, 1):
-                    print(f"📄 Processing page {i}/{len(images)}...")
-                    
-                    # Save image temporarily
-                    temp_image_path = os.path.join(temp_dir, f"page_{i}.jpg")
-                    image.save(temp_image_path, 'JPEG')
-                    
-                    # Extract text from image
-                    page_text = self.extract_text_from_image(temp_image_path)
-                    
-                    if page_text:
-                        all_text.append(f"\n--- Page {i} ---\n{page_text}\n")
+            for page_number, page_text in self.iter_text_from_pdf(pdf_path):
+                page_count += 1
+                self.last_page_report.append(self._page_record(page_number, page_text))
+                if page_text:
+                    all_text.append(f"\n--- Page {page_number} ---\n{page_text}\n")
             
             combined_text = "\n".join(all_text)
-            print(f"✅ Successfully extracted text from {len(images)} pages")
+            print(f"✅ Successfully extracted text from {page_count} pages")
+            
+            skipped = sum(1 for record in self.last_page_report if record['status'] == "blank_skipped")
+            if skipped:
+                print(f"⏭️ {skipped} blank page(s) skipped without OCR")
+            
+            fallbacks = [record for record in self.last_page_report if record.get('ocr_failures')]
+            if fallbacks:
+                print(f"↪️ {len(fallbacks)} page(s) read by a fallback OCR tier - not caching the document")
+            
+            if cache_key is not None and combined_text and not fallbacks:
+                self.cache.put(cache_key, combined_text)
+                print(f"📊 OCR cache: {self.cache.stats()}")
             
             return combined_text
             
@@ -178,8 +2081,49 @@ class DeepSeekOCR:
             traceback.print_exc()
             return ""
     
+    def extract_text_from_pdf_pages(self, pdf_path: str, page_numbers: List[int]) -> Dict[int, str]:
+        """
+        OCR selected pages of a PDF (e.g. the image-only pages of a mixed document)
+        
+        Args:
+            pdf_path: Path to the PDF file
+            page_numbers: 1-based pages to rasterize and OCR
+            
+        Returns:
+            Dictionary mapping page number to extracted text; pages that fail
+            are missing from the result
+        """
+        page_texts = {}
+        if not page_numbers:
+            return page_texts
+        
+        try:
+            print(f"📄 OCR of {len(page_numbers)} page(s) of {os.path.basename(pdf_path)}: "
+                  f"{', '.join(str(n) for n in sorted(page_numbers))}")
+            
+            self.last_page_report = []
+            self._page_details = {}
+            for page_number, page_text in self.iter_text_from_pdf(pdf_path, page_numbers=page_numbers):
+                self.last_page_report.append(self._page_record(page_number, page_text))
+                page_texts[page_number] = page_text
+            
+            print(f"✅ Successfully extracted text from {len(page_texts)} pages")
+            
+        except Exception as e:
+            print(f"❌ Error extracting text from PDF pages: {e}")
+            import traceback
+            traceback.print_exc()
+        
+        return page_texts
+    
     def cleanup(self):
         """Clean up model resources"""
+        if self._decode_worker is not None:
+            self._decode_jobs.put(None)
+            self._decode_worker.join(timeout=30)
+            self._decode_worker = None
+        self._decode_scheduler = None
+        
         if self.model is not None:
             del self.model
             self.model = None
@@ -188,6 +2132,13 @@ class DeepSeekOCR:
             del self.tokenizer
             self.tokenizer = None
         
+        if self._output_dir is not None:
+            shutil.rmtree(self._output_dir, ignore_errors=True)
+            self._output_dir = None
+        
+        self._pending_images.clear()
+        self.in_memory_pages = False
+        
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         
@@ -199,8 +2150,17 @@ class DeepSeekOCR:
 _deepseek_ocr_instance = None
 
 def get_deepseek_ocr():
-    """Get or create singleton DeepSeek-OCR instance"""
+    """
+    Get or create singleton DeepSeek-OCR instance
+    
+    When OCR_SERVER_URL is configured this is a client of the shared OCR server
+    (ocr_server.py) instead of an in-process model.
+    """
     global _deepseek_ocr_instance
     if _deepseek_ocr_instance is None:
-        _deepseek_ocr_instance = DeepSeekOCR()
+        if OCR_SERVER_URL:
+            from ocr_client import OCRClient
+            _deepseek_ocr_instance = OCRClient(OCR_SERVER_URL)
+        else:
+            _deepseek_ocr_instance = DeepSeekOCR()
     return _deepseek_ocr_instance
@@ -9,10 +9,17 @@ from datetime import datetime
 from typing import Dict, List, Optional
 
 from pdf_processor_fast import PDFProcessor
-from deepseek_ocr import DeepSeekOCR
+from deepseek_ocr import get_deepseek_ocr
 from ollama_evaluator import OllamaEvaluator
 from pdf_generator import OCRtoPDFConverter, ResultPDFGenerator
 
+# Import text-layer detection setting
+try:
+    from config import Config
+    TEXT_LAYER_MIN_CHARS = Config.TEXT_LAYER_MIN_CHARS
+except ImportError:
+    TEXT_LAYER_MIN_CHARS = 30
+
 
 class AnswerEvaluationPipeline:
     def __init__(self, ollama_model: Optional[str] = None):
@@ -39,6 +46,7 @@ class AnswerEvaluationPipeline:
         self.student_answers = []
         self.student_text_pdf_path = None
         self.student_raw_text = ""
+        self.student_page_sources = {}  # page number -> "text_layer" or "ocr"
         
         print("✅ Pipeline initialized successfully!\n")
     
@@ -100,7 +108,7 @@ class AnswerEvaluationPipeline:
         use_ocr: bool = True
     ) -> tuple[List[Dict], str]:
         """
-        Process student answer PDF - detect if image-based and use OCR if needed
+        Process student answer PDF - OCR only the pages that have no text layer
         
         Args:
             pdf_path: Path to student answer PDF
@@ -113,40 +121,15 @@ class AnswerEvaluationPipeline:
         print(f"\n✍️  Processing Student Answer: {pdf_path}")
         
         try:
-            # Step 1: Check if PDF is image-based
-            is_image_based = self._is_image_based_pdf(pdf_path)
-            
-            if is_image_based and use_ocr:
-                print("📸 Detected image-based PDF - Using DeepSeek OCR...")
-                
-                # Initialize DeepSeek OCR if not already done
-                if self.deepseek_ocr is None:
-                    print("🔄 Loading DeepSeek OCR model...")
-                    self.deepseek_ocr = DeepSeekOCR()
-                
-                # Extract text using OCR
-                extracted_text = self.deepseek_ocr.extract_text_from_pdf(pdf_path)
-                print(f"✅ OCR extraction complete ({len(extracted_text)} characters)")
-                
-                # Convert extracted text to PDF
-                print(f"📄 Creating text-based PDF: {output_text_pdf}")
-                self.pdf_converter.create_text_pdf(
-                    extracted_text=extracted_text,
-                    output_path=output_text_pdf,
-                    title="Student Answer Sheet (OCR Extracted)"
-                )
-                
-            else:
-                print("📝 Text-based PDF detected - Using fast extraction...")
-                extracted_text = self.pdf_processor.extract_text_from_pdf(pdf_path)
-                print(f"✅ Text extraction complete ({len(extracted_text)} characters)")
-                
-                # Still create a cleaned PDF
-                self.pdf_converter.create_text_pdf(
-                    extracted_text=extracted_text,
-                    output_path=output_text_pdf,
-                    title="Student Answer Sheet (Extracted)"
-                )
+            # Step 1: Reuse the text layer where a page has one, OCR the rest
+            extracted_text, used_ocr = self._extract_student_text(pdf_path, use_ocr)
+            
+            print(f"📄 Creating text-based PDF: {output_text_pdf}")
+            self.pdf_converter.create_text_pdf(
+                extracted_text=extracted_text,
+                output_path=output_text_pdf,
+                title="Student Answer Sheet (OCR Extracted)" if used_ocr else "Student Answer Sheet (Extracted)"
+            )
             
             # Step 2: Parse student answers from extracted text
             self.student_answers = self.pdf_processor.extract_student_answers(extracted_text)
@@ -347,35 +330,80 @@ class AnswerEvaluationPipeline:
             print(f"\n❌ Pipeline failed: {str(e)}")
             raise
     
-    def _is_image_based_pdf(self, pdf_path: str) -> bool:
+    def _has_text_layer(self, page_text: str) -> bool:
         """
-        Check if PDF is image-based (scanned) or text-based
+        Check if a page carries a usable text layer (typed rather than scanned)
         
         Args:
-            pdf_path: Path to PDF file
+            page_text: Text PyPDF2 extracted from the page
             
         Returns:
-            True if image-based, False if text-based
+            True if the page text can be used without OCR
         """
-        try:
-            # Try to extract text
-            text = self.pdf_processor.extract_text_from_pdf(pdf_path)
-            
-            # If very little text extracted, it's likely image-based
-            if len(text.strip()) < 100:
-                return True
-            
-            # Check ratio of text length to file size
-            # Text PDFs have more text per KB
-            file_size_kb = os.path.getsize(pdf_path) / 1024
-            text_ratio = len(text) / file_size_kb
-            
-            # If ratio is very low, it's likely scanned
-            return text_ratio < 50
+        return len(page_text.strip()) >= TEXT_LAYER_MIN_CHARS
+    
+    def _extract_student_text(self, pdf_path: str, use_ocr: bool = True) -> tuple[str, bool]:
+        """
+        Extract text page by page, sending only image-only pages to DeepSeek OCR
+        
+        Mixed documents (typed cover page, scanned handwritten answers) keep the
+        PyPDF2 text of their typed pages; the rest are OCRed and everything is
+        merged back in page order.
+        
+        Args:
+            pdf_path: Path to student answer PDF
+            use_ocr: Whether to use OCR for image-only pages
             
-        except:
-            # If extraction fails, assume image-based
-            return True
+        Returns:
+            Tuple of (extracted text, whether any page was OCRed)
+        """
+        page_texts = self.pdf_processor.extract_page_texts(pdf_path)
+        ocr_pages = [
+            page_number for page_number, page_text in enumerate(page_texts, start=1)
+            if not self._has_text_layer(page_text)
+        ]
+        
+        # Unreadable by PyPDF2: treat the whole document as scanned
+        if not page_texts and use_ocr:
+            ocr_pages = None
+        
+        if ocr_pages is not None and (not ocr_pages or not use_ocr):
+            print("📝 Text-based PDF detected - Using fast extraction...")
+            self.student_page_sources = {n: "text_layer" for n in range(1, len(page_texts) + 1)}
+            extracted_text = "".join(page_text + "\n" for page_text in page_texts)
+            print(f"✅ Text extraction complete ({len(extracted_text)} characters)")
+            return extracted_text, False
+        
+        # Initialize DeepSeek OCR if not already done
+        if self.deepseek_ocr is None:
+            print("🔄 Loading DeepSeek OCR model...")
+            self.deepseek_ocr = get_deepseek_ocr()
+        
+        if ocr_pages is None or len(ocr_pages) == len(page_texts):
+            print("📸 Detected image-based PDF - Using DeepSeek OCR...")
+            self.student_page_sources = {n: "ocr" for n in ocr_pages or []}
+            extracted_text = self.deepseek_ocr.extract_text_from_pdf(pdf_path)
+            print(f"✅ OCR extraction complete ({len(extracted_text)} characters)")
+            return extracted_text, True
+        
+        print(f"📸 Mixed PDF detected - OCR for {len(ocr_pages)} of {len(page_texts)} pages, "
+              f"text layer for the rest")
+        ocr_texts = self.deepseek_ocr.extract_text_from_pdf_pages(pdf_path, ocr_pages)
+        
+        all_text = []
+        self.student_page_sources = {}
+        for page_number, page_text in enumerate(page_texts, start=1):
+            if page_number in ocr_texts:
+                page_text = ocr_texts[page_number]
+                self.student_page_sources[page_number] = "ocr"
+            else:
+                self.student_page_sources[page_number] = "text_layer"
+            if page_text.strip():
+                all_text.append(f"\n--- Page {page_number} ---\n{page_text}\n")
+        
+        extracted_text = "\n".join(all_text)
+        print(f"✅ Mixed extraction complete ({len(extracted_text)} characters)")
+        return extracted_text, True
 
 
 # Example usage
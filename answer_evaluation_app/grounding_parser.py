@@ -0,0 +1,222 @@
+"""
+Parser for DeepSeek-OCR grounding output
+The grounding prompt makes the model emit every block as
+    <|ref|>label<|/ref|><|det|>[[x1, y1, x2, y2]]<|/det|>
+    block text...
+with box coordinates normalized to 0-999. This module turns that output into
+per-line records (page, label, text, bbox) and segments student answers by
+layout instead of re-scanning flattened text.
+"""
+
+import re
+from typing import Dict, List, Optional, Tuple
+
+from page_screening import BLANK_PAGE_MARKER
+
+# One grounded block header: label plus one or more boxes
+GROUNDING_PATTERN = re.compile(
+    r'<\|ref\|>(?P<label>.*?)<\|/ref\|>\s*<\|det\|>(?P<boxes>.*?)<\|/det\|>',
+    re.DOTALL
+)
+BOX_PATTERN = re.compile(r'\[\s*(\d+(?:\.\d+)?)\s*,\s*(\d+(?:\.\d+)?)\s*,\s*(\d+(?:\.\d+)?)\s*,\s*(\d+(?:\.\d+)?)\s*\]')
+PAGE_MARKER_PATTERN = re.compile(r'^\s*-{2,}\s*Page\s*(\d+)\s*-{2,}\s*$', re.IGNORECASE | re.MULTILINE)
+
+# Leftover special tokens (<|grounding|>, <|ref|> without a box, ...) and HTML from tables
+SPECIAL_TOKEN_PATTERN = re.compile(r'<\|[^|>]*\|>')
+HTML_TAG_PATTERN = re.compile(r'</?[a-zA-Z][^>]*>')
+
+# Start of an answer: "1.", "Q2)", "Ans 3:", "Answer 4." ...
+QUESTION_MARKER_PATTERN = re.compile(
+    r'^\s*(?:Q|Ques(?:tion)?|Ans(?:wer)?|A)?\s*\.?\s*(\d{1,2})\s*[\.\):](?!\d)\s*(.*)$',
+    re.IGNORECASE
+)
+
+# Grounding labels that never carry answer text
+NON_TEXT_LABELS = {'image', 'figure'}
+
+# Normalized width (0-999) a question marker may sit right of the page's left margin
+MARGIN_TOLERANCE = 40
+
+
+def has_grounding(text: str) -> bool:
+    """True if the text contains DeepSeek-OCR grounding tags"""
+    return bool(text) and GROUNDING_PATTERN.search(text) is not None
+
+
+def _clean_line(line: str) -> str:
+    """Remove leftover tokens/HTML from one line of block text"""
+    line = SPECIAL_TOKEN_PATTERN.sub(' ', line)
+    line = HTML_TAG_PATTERN.sub(' ', line)
+    return re.sub(r'\s+', ' ', line).strip()
+
+
+def _parse_boxes(boxes: str) -> Optional[Tuple[int, int, int, int]]:
+    """Union of all boxes in a <|det|> payload, or None if none parse"""
+    coords = [tuple(float(v) for v in match.groups()) for match in BOX_PATTERN.finditer(boxes)]
+    if not coords:
+        return None
+    return (
+        int(min(c[0] for c in coords)),
+        int(min(c[1] for c in coords)),
+        int(max(c[2] for c in coords)),
+        int(max(c[3] for c in coords)),
+    )
+
+
+def _split_box(bbox: Optional[Tuple[int, int, int, int]], count: int, index: int):
+    """Evenly slice a block box into `count` line boxes and return line `index`"""
+    if bbox is None or count <= 1:
+        return bbox
+    x1, y1, x2, y2 = bbox
+    step = (y2 - y1) / count
+    return (x1, int(round(y1 + index * step)), x2, int(round(y1 + (index + 1) * step)))
+
+
+def parse_grounding(text: str, page: Optional[int] = None) -> List[Dict]:
+    """
+    Parse one page of grounding output into line records
+
+    Args:
+        text: Raw OCR output for a single page
+        page: Page number to record on each line
+
+    Returns:
+        List of {'page', 'label', 'text', 'bbox'} dicts in reading order.
+        bbox is (x1, y1, x2, y2) in 0-999 page coordinates, or None for text
+        outside any grounded block. Multi-line blocks are split evenly.
+    """
+    records = []
+    if not text:
+        return records
+
+    # Each block runs from its header to the next header
+    blocks = []
+    matches = list(GROUNDING_PATTERN.finditer(text))
+    leading = text[:matches[0].start()] if matches else text
+    blocks.append(('text', None, leading))
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        blocks.append((
+            match.group('label').strip().lower() or 'text',
+            _parse_boxes(match.group('boxes')),
+            text[match.end():end],
+        ))
+
+    for label, bbox, body in blocks:
+        if label in NON_TEXT_LABELS:
+            continue
+        lines = [_clean_line(line) for line in body.splitlines()]
+        lines = [line for line in lines if line and line != BLANK_PAGE_MARKER]
+        for index, line in enumerate(lines):
+            records.append({
+                'page': page,
+                'label': label,
+                'text': line,
+                'bbox': _split_box(bbox, len(lines), index),
+            })
+
+    return records
+
+
+def parse_ocr_document(text: str) -> List[Dict]:
+    """
+    Parse a multi-page OCR result ("--- Page N ---" separated) into line records
+
+    Args:
+        text: Output of extract_text_from_pdf (or a single page)
+
+    Returns:
+        Line records of every page, in page order
+    """
+    if not text:
+        return []
+
+    markers = list(PAGE_MARKER_PATTERN.finditer(text))
+    if not markers:
+        return parse_grounding(text, page=1)
+
+    records = parse_grounding(text[:markers[0].start()], page=None)
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(text)
+        records.extend(parse_grounding(text[marker.end():end], page=int(marker.group(1))))
+    return records
+
+
+def strip_grounding(text: str) -> str:
+    """
+    Remove grounding tags, box coordinates and other markup but keep line breaks
+
+    Args:
+        text: Raw OCR output
+
+    Returns:
+        Plain text suitable for regex parsing or the LLM prompt
+    """
+    if not text:
+        return ""
+    text = GROUNDING_PATTERN.sub('\n', text)
+    text = SPECIAL_TOKEN_PATTERN.sub(' ', text)
+    text = HTML_TAG_PATTERN.sub(' ', text)
+    text = re.sub(r'[ \t]+', ' ', text)
+    return re.sub(r'\n\s*\n+', '\n\n', text).strip()
+
+
+def records_to_text(records: List[Dict]) -> str:
+    """Join line records back into plain text, one line per record"""
+    return "\n".join(record['text'] for record in records)
+
+
+def _left_margins(records: List[Dict]) -> Dict[Optional[int], int]:
+    """Leftmost box edge per page"""
+    margins = {}
+    for record in records:
+        if record['bbox'] is not None:
+            page = record['page']
+            margins[page] = min(margins.get(page, 999), record['bbox'][0])
+    return margins
+
+
+def segment_answers(records: List[Dict], min_length: int = 10) -> List[Dict]:
+    """
+    Split line records into student answers using the page layout
+
+    A line starts a new answer when it opens with a question marker ("1.",
+    "Q2)", "Ans 3:") and sits at the page's left margin. Numbered points
+    indented inside an answer therefore stay part of that answer. Lines
+    without boxes only need the marker.
+
+    Args:
+        records: Line records from parse_ocr_document
+        min_length: Answers shorter than this are dropped
+
+    Returns:
+        List of {'question_number', 'student_answer'} sorted by question;
+        for a repeated number the longest answer is kept
+    """
+    margins = _left_margins(records)
+    answers = []
+    current = None
+
+    for record in records:
+        match = QUESTION_MARKER_PATTERN.match(record['text'])
+        at_margin = (
+            record['bbox'] is None
+            or record['bbox'][0] <= margins.get(record['page'], 0) + MARGIN_TOLERANCE
+        )
+
+        if match and at_margin:
+            current = {'question_number': int(match.group(1)), 'lines': [match.group(2)]}
+            answers.append(current)
+        elif current is not None:
+            current['lines'].append(record['text'])
+
+    unique_answers = {}
+    for answer in answers:
+        answer_text = re.sub(r'\s+', ' ', " ".join(answer['lines'])).strip()
+        if len(answer_text) <= min_length:
+            continue
+        q_num = answer['question_number']
+        if q_num not in unique_answers or len(answer_text) > len(unique_answers[q_num]['student_answer']):
+            unique_answers[q_num] = {'question_number': q_num, 'student_answer': answer_text}
+
+    return sorted(unique_answers.values(), key=lambda x: x['question_number'])
@@ -0,0 +1,197 @@
+"""
+Content-addressed OCR result cache
+Stores OCR output on disk keyed by page pixels (or PDF bytes) plus inference parameters,
+so re-uploaded papers are re-graded without running the OCR model again
+"""
+
+import os
+import hashlib
+import threading
+from typing import Optional
+
+from PIL import Image
+
+# Import cache settings
+try:
+    from config import Config
+    OCR_CACHE_FOLDER = Config.OCR_CACHE_FOLDER
+    OCR_CACHE_MAX_MB = Config.OCR_CACHE_MAX_MB
+except ImportError:
+    OCR_CACHE_FOLDER = 'ocr_cache'
+    OCR_CACHE_MAX_MB = 512
+
+
+def hash_image_pixels(image: Image.Image) -> str:
+    """
+    Hash the decoded pixels of an image (independent of file name or encoding)
+
+    Args:
+        image: PIL image
+
+    Returns:
+        Hex digest of mode, size and raw pixel bytes
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """Hash a file's bytes without reading it into memory at once"""
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class OCRResultCache:
+    """
+    Persistent, size-bounded LRU cache of OCR results
+
+    Each entry is a UTF-8 text file named after its key. A hit refreshes the
+    file's modification time, and eviction removes the least recently used
+    entries once the cache grows past `max_bytes`.
+    """
+    def __init__(self, cache_dir: str = OCR_CACHE_FOLDER, max_mb: float = OCR_CACHE_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._total_bytes = sum(size for _, size, _ in self._entries())
+
+    @staticmethod
+    def make_key(content_hash: str, **params) -> str:
+        """
+        Build a cache key from a content hash and the inference parameters
+
+        Args:
+            content_hash: Hash of the page pixels or document bytes
+            **params: Everything else that changes the OCR output
+                (prompt, base_size, image_size, crop_mode, model revision, ...)
+
+        Returns:
+            Hex digest identifying the entry
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(content_hash.encode())
+        for name in sorted(params):
+            digest.update(f"|{name}={params[name]!r}".encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> str:
+        # Shard by key prefix to keep directories small
+        return os.path.join(self.cache_dir, key[:2], f"{key}.txt")
+
+    def _entries(self):
+        """Yield (path, size, mtime) for every cached entry"""
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".txt"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a cached result
+
+        Args:
+            key: Key from make_key
+
+        Returns:
+            Cached text, or None on a miss
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                text = f.read()
+            # Mark as recently used
+            os.utime(path, None)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return text
+
+    def put(self, key: str, text: str):
+        """
+        Store a result and evict least recently used entries if over budget
+
+        Args:
+            key: Key from make_key
+            text: OCR output to cache
+        """
+        path = self._path(key)
+        data = text.encode('utf-8')
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            previous_size = os.path.getsize(path) if os.path.exists(path) else 0
+
+            # Write atomically so concurrent workers never read a partial entry
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print(f"⚠️ Could not write OCR cache entry: {e}")
+            return
+
+        with self._lock:
+            self._total_bytes += len(data) - previous_size
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits its budget"""
+        # Rescan: other worker processes may share the directory
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+
+        self._total_bytes = total
+
+    def clear(self):
+        """Remove every cached entry"""
+        with self._lock:
+            for path, _, _ in list(self._entries()):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self._total_bytes = 0
+
+    def stats(self) -> dict:
+        """Hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'size_bytes': self._total_bytes,
+                'max_bytes': self.max_bytes,
+            }
@@ -0,0 +1,161 @@
+"""
+Client for the standalone DeepSeek-OCR server (ocr_server.py)
+Drop-in replacement for DeepSeekOCR in the web apps: same extraction methods,
+but the model lives in the shared server process
+"""
+
+import io
+import json
+import os
+import urllib.error
+import urllib.request
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image
+
+# Import server settings
+try:
+    from config import Config
+    OCR_SERVER_URL = Config.OCR_SERVER_URL
+    OCR_SERVER_TIMEOUT = Config.OCR_SERVER_TIMEOUT
+except ImportError:
+    OCR_SERVER_URL = os.environ.get('OCR_SERVER_URL', '')
+    OCR_SERVER_TIMEOUT = 1800
+
+
+class OCRClient:
+    def __init__(self, server_url: str = None, timeout: float = OCR_SERVER_TIMEOUT):
+        """
+        Initialize the OCR server client
+
+        Args:
+            server_url: Base URL of the OCR server (e.g. http://127.0.0.1:8765)
+            timeout: Seconds to wait for a job (whole PDFs can take minutes)
+        """
+        self.server_url = (server_url or OCR_SERVER_URL).rstrip("/")
+        self.timeout = timeout
+        self.initialized = False
+        self.last_page_report = []
+
+    def _request(self, path: str, data: bytes = None, content_type: str = "application/json",
+                 timeout: float = None) -> dict:
+        """Send a request to the server and decode its JSON reply"""
+        request = urllib.request.Request(self.server_url + path, data=data)
+        if data is not None:
+            request.add_header("Content-Type", content_type)
+
+        try:
+            with urllib.request.urlopen(request, timeout=timeout or self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            # The server reports job failures as JSON
+            try:
+                message = json.loads(e.read().decode('utf-8')).get('error', str(e))
+            except Exception:
+                message = str(e)
+            raise RuntimeError(f"OCR server error ({e.code}): {message}") from e
+
+    def _post_json(self, path: str, payload: dict) -> dict:
+        return self._request(path, json.dumps(payload).encode('utf-8'))
+
+    def initialize(self):
+        """Check that the OCR server is reachable (the server loads the model itself)"""
+        if self.initialized:
+            return True
+
+        try:
+            health = self._request("/health", timeout=10)
+            self.initialized = True
+            print(f"✅ Connected to DeepSeek-OCR server at {self.server_url} "
+                  f"(model loaded: {health.get('initialized')})")
+            return True
+        except Exception as e:
+            print(f"❌ DeepSeek-OCR server not reachable at {self.server_url}: {e}")
+            print("   Start it with: python ocr_server.py")
+            return False
+
+    def extract_text_from_image(self, image) -> str:
+        """
+        Extract text from a single image on the OCR server
+
+        Args:
+            image: Path to the image file, a PIL image or an ndarray buffer
+
+        Returns:
+            Extracted text as string
+        """
+        try:
+            if isinstance(image, str):
+                # Same machine: let the server read the file
+                result = self._post_json("/ocr/image", {'image_path': os.path.abspath(image)})
+            else:
+                if isinstance(image, np.ndarray):
+                    image = Image.fromarray(image)
+                buffer = io.BytesIO()
+                image.save(buffer, format="PNG")
+                result = self._request("/ocr/image", buffer.getvalue(), content_type="image/png")
+            return result.get('text', "")
+        except Exception as e:
+            print(f"❌ Error extracting text from image: {e}")
+            return ""
+
+    def extract_text_from_pdf(self, pdf_path: str) -> str:
+        """
+        Extract text from a PDF on the OCR server
+
+        Args:
+            pdf_path: Path to the PDF file
+
+        Returns:
+            Extracted text from all pages
+        """
+        try:
+            print(f"📤 Sending {os.path.basename(pdf_path)} to DeepSeek-OCR server...")
+            result = self._post_json("/ocr/pdf", {'pdf_path': os.path.abspath(pdf_path)})
+            self.last_page_report = result.get('pages', [])
+            return result.get('text', "")
+        except Exception as e:
+            print(f"❌ Error extracting text from PDF: {e}")
+            return ""
+
+    def extract_text_from_pdf_pages(self, pdf_path: str, page_numbers: List[int]) -> Dict[int, str]:
+        """
+        OCR selected pages of a PDF on the OCR server
+
+        Args:
+            pdf_path: Path to the PDF file
+            page_numbers: 1-based pages to OCR
+
+        Returns:
+            Dictionary mapping page number to extracted text
+        """
+        if not page_numbers:
+            return {}
+
+        try:
+            result = self._post_json("/ocr/pdf_pages", {
+                'pdf_path': os.path.abspath(pdf_path),
+                'page_numbers': [int(n) for n in page_numbers],
+            })
+            self.last_page_report = result.get('pages', [])
+            return {int(n): text for n, text in result.get('page_texts', {}).items()}
+        except Exception as e:
+            print(f"❌ Error extracting text from PDF pages: {e}")
+            return {}
+
+    def set_reference_text(self, text: str = None):
+        """
+        Text the pages are expected to repeat, e.g. the question paper
+
+        Sent to the server so the shared model drafts from it during
+        decoding (see DeepSeekOCR.set_reference_text). None clears it.
+        """
+        try:
+            self._post_json("/ocr/reference_text", {'text': text})
+        except Exception as e:
+            print(f"⚠️  Could not send reference text to OCR server: {e}")
+
+    def cleanup(self):
+        """Nothing to release locally; the server keeps the model loaded"""
+        self.initialized = False
@@ -0,0 +1,172 @@
+"""
+Standalone DeepSeek-OCR server
+One long-lived process owns the model and serves OCR jobs to every web worker
+over local HTTP, so several Flask/gunicorn workers share a single model load
+and web-worker restarts never reload the weights.
+
+Run:
+    python ocr_server.py [host] [port]
+
+Then point the web apps at it:
+    OCR_SERVER_URL=http://127.0.0.1:8765 python app_ollama_integrated.py
+"""
+
+import io
+import sys
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageOps
+
+from deepseek_ocr import DeepSeekOCR
+
+# Import server settings
+try:
+    from config import Config
+    OCR_SERVER_HOST = Config.OCR_SERVER_HOST
+    OCR_SERVER_PORT = Config.OCR_SERVER_PORT
+except ImportError:
+    OCR_SERVER_HOST = '127.0.0.1'
+    OCR_SERVER_PORT = 8765
+
+# Largest request body accepted (a 300 DPI page PNG is well under this)
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+
+
+class OCRRequestHandler(BaseHTTPRequestHandler):
+    """
+    JSON endpoints:
+        GET  /health         -> {"status", "initialized", "cache"}
+        POST /ocr/image      image bytes, or {"image_path"} -> {"text"}
+        POST /ocr/pdf        {"pdf_path"} -> {"text", "pages"}
+        POST /ocr/pdf_pages  {"pdf_path", "page_numbers"} -> {"page_texts", "pages"}
+        POST /ocr/reference_text  {"text"} -> {"success"}
+
+    PDFs are passed by path: the server runs on the same machine as the web
+    workers and reads the uploaded file directly.
+    """
+    server_version = "DeepSeekOCRServer/1.0"
+
+    @property
+    def ocr(self) -> DeepSeekOCR:
+        return self.server.ocr
+
+    def log_message(self, format, *args):
+        print(f"🌐 {self.address_string()} - {format % args}")
+
+    def _send_json(self, status: int, payload: dict):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_REQUEST_BYTES:
+            raise ValueError(f"Request body too large ({length} bytes)")
+        return self.rfile.read(length)
+
+    def _read_json(self) -> dict:
+        return json.loads(self._read_body() or b"{}")
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {'error': f"Unknown endpoint: {self.path}"})
+            return
+
+        self._send_json(200, {
+            'status': "ok",
+            'initialized': self.ocr.initialized,
+            'cache': self.ocr.cache.stats() if self.ocr.cache is not None else None,
+        })
+
+    def do_POST(self):
+        routes = {
+            "/ocr/image": self._handle_image,
+            "/ocr/pdf": self._handle_pdf,
+            "/ocr/pdf_pages": self._handle_pdf_pages,
+            "/ocr/reference_text": self._handle_reference_text,
+        }
+        handler = routes.get(self.path)
+        if handler is None:
+            self._send_json(404, {'error': f"Unknown endpoint: {self.path}"})
+            return
+
+        try:
+            self._send_json(200, handler())
+        except (ValueError, KeyError, FileNotFoundError) as e:
+            self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            print(f"❌ OCR job failed: {e}")
+            self._send_json(500, {'error': str(e)})
+
+    def _handle_image(self) -> dict:
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return {'text': self.ocr.extract_text_from_image(self._read_json()['image_path'])}
+
+        with Image.open(io.BytesIO(self._read_body())) as img:
+            image = ImageOps.exif_transpose(img).convert("RGB")
+        return {'text': self.ocr.extract_text_from_image(image)}
+
+    def _handle_pdf(self) -> dict:
+        pdf_path = self._read_json()['pdf_path']
+        # last_page_report is kept per thread, so concurrent PDF jobs do not mix reports
+        text = self.ocr.extract_text_from_pdf(pdf_path)
+        return {'text': text, 'pages': self.ocr.last_page_report}
+
+    def _handle_pdf_pages(self) -> dict:
+        request = self._read_json()
+        page_numbers = [int(n) for n in request['page_numbers']]
+        page_texts = self.ocr.extract_text_from_pdf_pages(request['pdf_path'], page_numbers)
+        return {
+            'page_texts': {str(n): text for n, text in page_texts.items()},
+            'pages': self.ocr.last_page_report,
+        }
+
+    def _handle_reference_text(self) -> dict:
+        # Shared by every job on the server: the question paper of the current exam
+        self.ocr.set_reference_text(self._read_json().get('text'))
+        return {'success': True}
+
+
+class OCRServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the one shared DeepSeekOCR instance"""
+    daemon_threads = True
+
+    def __init__(self, host: str = OCR_SERVER_HOST, port: int = OCR_SERVER_PORT, ocr: DeepSeekOCR = None):
+        super().__init__((host, port), OCRRequestHandler)
+        # Jobs take turns on the model lock inside DeepSeekOCR, or with
+        # continuous batching (OCR_CONTINUOUS_BATCHING) share decode batches
+        self.ocr = ocr or DeepSeekOCR()
+
+
+def main():
+    host = sys.argv[1] if len(sys.argv) > 1 else OCR_SERVER_HOST
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else OCR_SERVER_PORT
+
+    print("="*60)
+    print("🚀 Starting DeepSeek-OCR Server")
+    print("="*60)
+
+    server = OCRServer(host, port)
+
+    # Load the weights once, before the first job arrives
+    if not server.ocr.initialize():
+        print("❌ Could not load DeepSeek-OCR - server not started")
+        server.server_close()
+        sys.exit(1)
+
+    print(f"✅ Serving OCR on http://{host}:{port} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 Shutting down OCR server...")
+    finally:
+        server.server_close()
+        server.ocr.cleanup()
+
+
+if __name__ == "__main__":
+    main()
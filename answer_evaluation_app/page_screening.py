@@ -0,0 +1,358 @@
+"""
+Fast NumPy pre-screening of rasterized pages before OCR
+Detects blank and near-blank pages (nothing but ruling lines, margins or scanner noise)
+and crops/deskews written pages to their answer region
+"""
+
+import numpy as np
+from PIL import Image
+
+# Import screening settings
+try:
+    from config import Config
+    BLANK_PAGE_INK_RATIO = Config.BLANK_PAGE_INK_RATIO
+    CROP_MARGIN = Config.OCR_CROP_MARGIN
+    MAX_SKEW_DEGREES = Config.OCR_MAX_SKEW_DEGREES
+except ImportError:
+    BLANK_PAGE_INK_RATIO = 0.0015
+    CROP_MARGIN = 0.02
+    MAX_SKEW_DEGREES = 5.0
+
+# Text recorded in place of OCR output for skipped pages
+BLANK_PAGE_MARKER = "[blank page - OCR skipped]"
+
+# Pages are analyzed at this width; enough to see handwriting, cheap to scan
+SCREEN_WIDTH = 600
+
+
+def to_grayscale_array(image, max_width: int = SCREEN_WIDTH) -> np.ndarray:
+    """
+    Downscale a page and convert it to a float32 grayscale array
+
+    Args:
+        image: PIL image or ndarray
+        max_width: Width the page is reduced to before analysis
+
+    Returns:
+        2D array of gray levels in [0, 255]
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    gray = image.convert("L")
+    if gray.width > max_width:
+        height = max(1, round(gray.height * max_width / gray.width))
+        gray = gray.resize((max_width, height), Image.BILINEAR)
+    return np.asarray(gray, dtype=np.float32)
+
+
+def ink_mask(gray: np.ndarray) -> np.ndarray:
+    """
+    Pixels clearly darker than the paper
+
+    The paper level is the median gray value, so lighting and off-white paper
+    do not matter. Faint printed ruling (light blue/grey) stays above the
+    threshold; pen and pencil strokes fall below it.
+    """
+    background = float(np.median(gray))
+    threshold = background - max(50.0, 0.35 * background)
+    return gray < threshold
+
+
+def remove_ruling_lines(mask: np.ndarray, line_fraction: float = 0.5) -> np.ndarray:
+    """
+    Drop rows and columns that are mostly ink (ruled lines, margin lines, borders)
+
+    Args:
+        mask: Boolean ink mask
+        line_fraction: A row/column is a line if this fraction of it is ink
+
+    Returns:
+        Copy of the mask with ruling removed (including the rows/columns next to
+        each line, which carry its anti-aliased edges)
+    """
+    mask = mask.copy()
+    height, width = mask.shape
+
+    line_rows = np.flatnonzero(mask.mean(axis=1) > line_fraction)
+    line_cols = np.flatnonzero(mask.mean(axis=0) > line_fraction)
+
+    for offset in (-1, 0, 1):
+        mask[np.clip(line_rows + offset, 0, height - 1), :] = False
+        mask[:, np.clip(line_cols + offset, 0, width - 1)] = False
+
+    return mask
+
+
+def analyze_page(image) -> dict:
+    """
+    Measure how much writing a page carries once ruling lines are removed
+
+    Args:
+        image: PIL image or ndarray of the rasterized page
+
+    Returns:
+        Dictionary with ink_ratio (residual ink fraction), ink_rows (rows with
+        ink after ruling removal) and row_variance (variance of the row
+        projection, near zero for uniform noise)
+    """
+    gray = to_grayscale_array(image)
+    mask = remove_ruling_lines(ink_mask(gray))
+
+    row_profile = mask.mean(axis=1)
+    # Rows with a couple of isolated dark pixels are scanner noise, not writing
+    min_row_ink = 3.0 / mask.shape[1]
+
+    return {
+        'ink_ratio': float(mask.mean()),
+        'ink_rows': int(np.count_nonzero(row_profile > min_row_ink)),
+        'row_variance': float(row_profile.var()),
+    }
+
+
+def estimate_page_complexity(image) -> dict:
+    """
+    Measure how much text a page carries and how small it is written
+
+    Lines of writing are the runs of inked rows in the row projection once
+    ruling lines are removed; their median height approximates the size of
+    the handwriting.
+
+    Args:
+        image: PIL image or ndarray of the page
+
+    Returns:
+        Dictionary with ink_ratio, line_count, line_height (median text line
+        height in page pixels) and page_size (width, height)
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    gray = to_grayscale_array(image)
+    scale = image.width / gray.shape[1]
+    mask = remove_ruling_lines(ink_mask(gray))
+
+    text_rows = mask.mean(axis=1) > 3.0 / mask.shape[1]
+    line_heights = []
+    start = None
+    for i, is_text in enumerate(np.append(text_rows, False)):
+        if is_text and start is None:
+            start = i
+        elif not is_text and start is not None:
+            # Single rows are specks or stray stroke ends, not lines
+            if i - start >= 2:
+                line_heights.append(i - start)
+            start = None
+
+    return {
+        'ink_ratio': float(mask.mean()),
+        'line_count': len(line_heights),
+        'line_height': float(np.median(line_heights)) * scale if line_heights else 0.0,
+        'page_size': (image.width, image.height),
+    }
+
+
+def is_blank_page(image, ink_ratio_threshold: float = BLANK_PAGE_INK_RATIO):
+    """
+    Decide whether a page has no ink beyond ruling lines
+
+    Args:
+        image: PIL image or ndarray of the rasterized page
+        ink_ratio_threshold: Residual ink fraction below which a page is blank
+
+    Returns:
+        Tuple of (is_blank, stats from analyze_page)
+    """
+    stats = analyze_page(image)
+    # Both checks must agree: one short answer line covers far less of a page
+    # than the ratio threshold, but it spans a few rows where noise rarely does
+    blank = stats['ink_ratio'] < ink_ratio_threshold and stats['ink_rows'] < 3
+    return blank, stats
+
+
+def _longest_run(flags: np.ndarray):
+    """(start, end) of the longest run of True values, end exclusive; None if there is none"""
+    best = None
+    start = None
+    for i, flag in enumerate(np.append(flags, False)):
+        if flag and start is None:
+            start = i
+        elif not flag and start is not None:
+            if best is None or i - start > best[1] - best[0]:
+                best = (start, i)
+            start = None
+    return best
+
+
+def _otsu_threshold(gray: np.ndarray) -> float:
+    """Gray level that best separates the two main populations of a page"""
+    histogram, _ = np.histogram(gray, bins=256, range=(0, 256))
+    histogram = histogram.astype(np.float64)
+    weights = np.cumsum(histogram)
+    means = np.cumsum(histogram * np.arange(256))
+    total, total_mean = weights[-1], means[-1]
+
+    background = weights[:-1]
+    foreground = total - background
+    valid = (background > 0) & (foreground > 0)
+    between = np.zeros(255)
+    between[valid] = (
+        (total_mean * background[valid] - means[:-1][valid] * total) ** 2
+        / (background[valid] * foreground[valid])
+    )
+    return float(np.argmax(between))
+
+
+def find_paper_box(gray: np.ndarray, min_fraction: float = 0.3, min_contrast: float = 100.0):
+    """
+    Locate the sheet of paper in a photographed page
+
+    The paper is the bright population of the image and the desk the dark one.
+    Unless the two are far apart in brightness (uneven lighting on the sheet
+    is not a desk) the whole frame is returned, as it is for scans.
+
+    Returns:
+        (top, bottom, left, right) in array coordinates, end exclusive
+    """
+    full_frame = (0, gray.shape[0], 0, gray.shape[1])
+    threshold = _otsu_threshold(gray)
+    paper = gray > threshold
+    if paper.all() or not paper.any():
+        return full_frame
+    if gray[paper].mean() - gray[~paper].mean() < min_contrast:
+        return full_frame
+
+    # Smooth the projections so ruling lines and writing do not split the sheet
+    window = np.ones(9) / 9
+    rows = _longest_run(np.convolve(paper.mean(axis=1), window, mode='same') > min_fraction)
+    cols = _longest_run(np.convolve(paper.mean(axis=0), window, mode='same') > min_fraction)
+    if rows is None or cols is None:
+        return full_frame
+    return rows[0], rows[1], cols[0], cols[1]
+
+
+def estimate_skew(mask: np.ndarray, max_degrees: float = MAX_SKEW_DEGREES, step: float = 0.25) -> float:
+    """
+    Angle (degrees, counter-clockwise) that makes the lines of writing horizontal
+
+    Text lines produce the sharpest row projection when they are level, so
+    the angle maximising the variance of the row profile wins.
+    """
+    if not mask.any() or max_degrees <= 0:
+        return 0.0
+
+    mask_image = Image.fromarray(mask.astype(np.uint8) * 255)
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_degrees, max_degrees + step / 2, step):
+        rotated = np.asarray(mask_image.rotate(float(angle), resample=Image.NEAREST, expand=True))
+        score = float(rotated.mean(axis=1).var())
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return round(best_angle, 2)
+
+
+def _paper_region(gray: np.ndarray):
+    """Slice of the screening array covering the paper, inset from its (often shadowed) edge"""
+    top, bottom, left, right = find_paper_box(gray)
+    inset_y = max(1, (bottom - top) // 100)
+    inset_x = max(1, (right - left) // 100)
+    return top + inset_y, bottom - inset_y, left + inset_x, right - inset_x
+
+
+def _border_color(image) -> tuple:
+    """Median color of the outermost pixels (desk for photos, paper for scans)"""
+    pixels = np.asarray(image.convert("RGB"))
+    border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+    return tuple(int(v) for v in np.median(border, axis=0))
+
+
+def find_content_box(image, margin: float = CROP_MARGIN, ink_quantile: float = 0.001):
+    """
+    Bounding box of the written content of an upright page
+
+    Args:
+        image: PIL image or ndarray of the page
+        margin: Padding added around the ink, as a fraction of the page size
+        ink_quantile: Fraction of ink trimmed from each side (specks, edge shadows)
+
+    Returns:
+        (left, top, right, bottom) in page pixels, or None if there is no ink
+    """
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    gray = to_grayscale_array(image)
+    scale = image.width / gray.shape[1]
+
+    top, bottom, left, right = _paper_region(gray)
+    if bottom <= top or right <= left:
+        return None
+
+    mask = remove_ruling_lines(ink_mask(gray[top:bottom, left:right]))
+    total = mask.sum()
+    if total == 0:
+        return None
+
+    def bounds(profile):
+        cumulative = np.cumsum(profile) / total
+        first = int(np.searchsorted(cumulative, ink_quantile))
+        last = int(np.searchsorted(cumulative, 1.0 - ink_quantile)) + 1
+        return first, min(last, len(profile))
+
+    row_first, row_last = bounds(mask.sum(axis=1))
+    col_first, col_last = bounds(mask.sum(axis=0))
+
+    pad_y = margin * gray.shape[0]
+    pad_x = margin * gray.shape[1]
+    return (
+        max(0, int((left + col_first - pad_x) * scale)),
+        max(0, int((top + row_first - pad_y) * scale)),
+        min(image.width, int(np.ceil((left + col_last + pad_x) * scale))),
+        min(image.height, int(np.ceil((top + row_last + pad_y) * scale))),
+    )
+
+
+def crop_to_content(image, margin: float = CROP_MARGIN, deskew: bool = True, min_saving: float = 0.1,
+                    min_skew: float = 1.0):
+    """
+    Straighten a page and crop it to its answer region before OCR
+
+    Margins, desk background and empty page areas otherwise become extra
+    vision tiles for the OCR model. The page is deskewed first (ruling and
+    lines of writing give the angle) so tilted ruling can be told apart from
+    writing when the crop box is found.
+
+    Args:
+        image: PIL image of the page
+        margin: Padding around the writing, as a fraction of the page size
+        deskew: Rotate the page so lines of writing are horizontal
+        min_saving: Keep the full page unless cropping removes this fraction of its area
+        min_skew: Smallest angle (degrees) worth resampling the page for
+
+    Returns:
+        Tuple of (prepared image, info dict with skew_angle, crop_box (left,
+        top, right, bottom in pixels of the deskewed page, None if uncropped)
+        and area_ratio)
+    """
+    info = {'crop_box': None, 'skew_angle': 0.0, 'area_ratio': 1.0}
+
+    if deskew:
+        gray = to_grayscale_array(image)
+        top, bottom, left, right = _paper_region(gray)
+        # Central part of the sheet only: a tilted sheet leaves desk in the corners of its box
+        inset_y, inset_x = (bottom - top) * 15 // 100, (right - left) * 15 // 100
+        top, bottom, left, right = top + inset_y, bottom - inset_y, left + inset_x, right - inset_x
+        if bottom > top and right > left:
+            angle = estimate_skew(ink_mask(gray[top:bottom, left:right]))
+            if abs(angle) >= min_skew:
+                image = image.rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=_border_color(image))
+                info['skew_angle'] = angle
+
+    box = find_content_box(image, margin)
+    if box is None:
+        return image, info
+
+    area_ratio = (box[2] - box[0]) * (box[3] - box[1]) / float(image.width * image.height)
+    if area_ratio <= 1.0 - min_saving:
+        image = image.crop(box)
+        info['crop_box'] = box
+        info['area_ratio'] = round(area_ratio, 4)
+
+    return image, info
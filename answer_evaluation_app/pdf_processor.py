@@ -30,6 +30,8 @@ except ImportError:
 
 from datetime import datetime
 import os
+from page_screening import BLANK_PAGE_MARKER
+from grounding_parser import has_grounding, parse_ocr_document, segment_answers, strip_grounding
 from deepseek_ocr import get_deepseek_ocr
 
 class PDFProcessor:
@@ -100,6 +102,11 @@ class PDFProcessor:
             
             print(f"🧠 Using DeepSeek-OCR for text extraction: {os.path.basename(pdf_path)}")
             text = self.deepseek_ocr.extract_text_from_pdf(pdf_path)
+            # Unreadable pages already fell back page by page inside DeepSeek-OCR;
+            # only a document that produced nothing at all is re-read whole
+            if not text.strip():
+                print("⚠️ DeepSeek-OCR returned no text, falling back to Tesseract OCR")
+                return self.ocr_pdf(pdf_path)
             return text
         except Exception as e:
             print(f"❌ DeepSeek-OCR failed: {e}")
@@ -324,10 +331,19 @@ class PDFProcessor:
                 print("⚠️ Warning: Very little text extracted from student paper")
                 print(f"📝 Extracted text preview: {text[:200] if text else ''}")
                 return []
+
+            # DeepSeek-OCR grounding output: split answers by page layout
+            if has_grounding(text):
+                student_answers = segment_answers(parse_ocr_document(text))
+                if student_answers:
+                    print(f"✅ Extracted {len(student_answers)} student answers from OCR layout")
+                    return student_answers
+                print("⚠️ Layout segmentation found no answers - falling back to text patterns")
             
-            # Clean HTML/XML tags
-            clean_text = re.sub(r'<[^>]+>', ' ', text)
+            # Clean grounding tags (labels and box coordinates) and HTML/XML tags
+            clean_text = strip_grounding(text)
             clean_text = re.sub(r'-{2,}\s*Page\s*\d+\s*-{2,}', ' ', clean_text, flags=re.IGNORECASE)
+            clean_text = clean_text.replace(BLANK_PAGE_MARKER, ' ')
             clean_text = re.sub(r'\s+', ' ', clean_text)
             
             student_answers = []
@@ -9,7 +9,8 @@ except ImportError:
     TESSERACT_AVAILABLE = False
     print("⚠️ pytesseract not available - DeepSeek-OCR will be used exclusively")
 
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
+from concurrent.futures import ProcessPoolExecutor
 
 # Import poppler configuration
 try:
@@ -17,6 +18,17 @@ try:
 except ImportError:
     POPPLER_PATH = None
 
+# Import OCR settings
+try:
+    from config import Config
+    OCR_DPI = Config.OCR_DPI
+    OCR_LANGUAGE = Config.OCR_LANGUAGE
+    TESSERACT_WORKERS = Config.TESSERACT_WORKERS
+except ImportError:
+    OCR_DPI = 300
+    OCR_LANGUAGE = 'eng'
+    TESSERACT_WORKERS = None
+
 try:
     from reportlab.lib.pagesizes import letter, A4
     from reportlab.lib import colors
@@ -30,9 +42,45 @@ except ImportError:
 
 from datetime import datetime
 import os
+import math
+from page_screening import BLANK_PAGE_MARKER
+from grounding_parser import has_grounding, parse_ocr_document, segment_answers, strip_grounding
+
+
+def _poppler_kwargs():
+    """Extra pdf2image arguments for the configured poppler install"""
+    if POPPLER_PATH and os.path.exists(POPPLER_PATH):
+        return {'poppler_path': POPPLER_PATH}
+    return {}
+
+
+def _init_tesseract_worker():
+    """Keep each Tesseract process single-threaded; the pool provides the parallelism"""
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+
+
+def _tesseract_page_range(pdf_path, first_page, last_page, dpi, lang):
+    """
+    Process-pool worker: rasterize and OCR one contiguous page range
+    
+    Only this range is ever held in memory, in this worker.
+    
+    Returns:
+        List of (page_number, text) tuples
+    """
+    results = []
+    for page_number in range(first_page, last_page + 1):
+        images = convert_from_path(
+            pdf_path, dpi=dpi, first_page=page_number, last_page=page_number, **_poppler_kwargs()
+        )
+        for image in images:
+            results.append((page_number, pytesseract.image_to_string(image, lang=lang)))
+        del images
+    return results
+
 
 class PDFProcessor:
-    def __init__(self, use_deepseek=False):  # Changed to False by default for speed
+    def __init__(self, use_deepseek=False, tesseract_workers=TESSERACT_WORKERS):  # Changed to False by default for speed
         if REPORTLAB_AVAILABLE:
             self.styles = getSampleStyleSheet()
         else:
@@ -40,6 +88,7 @@ class PDFProcessor:
         
         self.use_deepseek = use_deepseek
         self.deepseek_ocr = None
+        self.tesseract_workers = tesseract_workers or os.cpu_count() or 1
         
         print("⚡ Fast PDF Processor initialized (using PyPDF2 text extraction)")
     
@@ -57,22 +106,66 @@ class PDFProcessor:
             print(f"Error extracting text from PDF: {str(e)}")
             return ""
     
+    def extract_page_texts(self, pdf_path):
+        """
+        Extract the text layer of each page separately using PyPDF2
+        
+        Returns:
+            List of page texts in page order ("" for pages without a text layer),
+            or an empty list if the PDF cannot be read
+        """
+        try:
+            with open(pdf_path, 'rb') as file:
+                pdf_reader = PyPDF2.PdfReader(file)
+                page_texts = []
+                for page in pdf_reader.pages:
+                    try:
+                        page_texts.append(page.extract_text() or "")
+                    except Exception:
+                        page_texts.append("")
+                return page_texts
+        except Exception as e:
+            print(f"Error extracting page text from PDF: {str(e)}")
+            return []
+    
     def ocr_pdf(self, pdf_path):
-        """Extract text from scanned PDF using OCR (Tesseract fallback)"""
+        """
+        Extract text from scanned PDF using OCR (Tesseract fallback)
+        
+        Pages are fanned out to a process pool; each worker rasterizes and OCRs
+        its own page range, and the text is merged back in page order.
+        """
         if not TESSERACT_AVAILABLE:
             print("❌ Tesseract OCR not available")
             return ""
         
         try:
-            # Use poppler path from config
-            if POPPLER_PATH and os.path.exists(POPPLER_PATH):
-                images = convert_from_path(pdf_path, dpi=300, poppler_path=POPPLER_PATH)
+            total_pages = int(pdfinfo_from_path(pdf_path, **_poppler_kwargs()).get("Pages", 0))
+            workers = max(1, min(self.tesseract_workers, total_pages))
+            
+            if workers == 1:
+                page_texts = _tesseract_page_range(pdf_path, 1, total_pages, OCR_DPI, OCR_LANGUAGE)
             else:
-                images = convert_from_path(pdf_path, dpi=300)
+                # Several ranges per worker so one slow page range does not idle the pool
+                range_size = max(1, math.ceil(total_pages / (workers * 2)))
+                ranges = [
+                    (first_page, min(first_page + range_size - 1, total_pages))
+                    for first_page in range(1, total_pages + 1, range_size)
+                ]
+                print(f"⚡ Tesseract OCR: {total_pages} pages on {workers} worker processes")
+                
+                page_texts = []
+                with ProcessPoolExecutor(max_workers=workers, initializer=_init_tesseract_worker) as pool:
+                    futures = [
+                        pool.submit(_tesseract_page_range, pdf_path, first, last, OCR_DPI, OCR_LANGUAGE)
+                        for first, last in ranges
+                    ]
+                    for future in futures:
+                        page_texts.extend(future.result())
+            
             text = ""
-            for i, image in enumerate(images):
-                page_text = pytesseract.image_to_string(image, lang='eng')
-                text += f"\n--- Page {i+1} ---\n{page_text}\n"
+            for page_number, page_text in sorted(page_texts):
+                text += f"\n--- Page {page_number} ---\n{page_text}\n"
             return text
         except Exception as e:
             print(f"Error performing OCR: {str(e)}")
@@ -303,10 +396,19 @@ class PDFProcessor:
                 print("⚠️ Warning: Very little text extracted from student paper")
                 print(f"📝 Extracted text: {text[:200]}")
                 return []
+
+            # DeepSeek-OCR grounding output: split answers by page layout
+            if has_grounding(text):
+                student_answers = segment_answers(parse_ocr_document(text))
+                if student_answers:
+                    print(f"✅ Extracted {len(student_answers)} student answers from OCR layout")
+                    return student_answers
+                print("⚠️ Layout segmentation found no answers - falling back to text patterns")
             
-            # Clean HTML/XML tags
-            clean_text = re.sub(r'<[^>]+>', ' ', text)
+            # Clean grounding tags (labels and box coordinates) and HTML/XML tags
+            clean_text = strip_grounding(text)
             clean_text = re.sub(r'-{2,}\s*Page\s*\d+\s*-{2,}', ' ', clean_text, flags=re.IGNORECASE)
+            clean_text = clean_text.replace(BLANK_PAGE_MARKER, ' ')
             clean_text = re.sub(r'\s+', ' ', clean_text)
             
             print(f"📝 Cleaned text length: {len(clean_text)} characters")
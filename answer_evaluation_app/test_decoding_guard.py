@@ -0,0 +1,96 @@
+"""
+Test the OCR decoding guard
+Run this to verify token budgets, repetition stopping and loop trimming
+"""
+
+import sys
+from pathlib import Path
+
+# Add the current directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+import torch
+
+from decoding_guard import RepetitionStoppingCriteria, estimate_token_budget, finish_generation
+
+EOS = 0
+
+
+def test_token_budget():
+    """Denser pages get a larger output budget"""
+    print("\n1️⃣ Testing token budget...")
+    assert estimate_token_budget(None) is None
+    sparse = estimate_token_budget({'line_count': 2}, min_tokens=512, tokens_per_line=48)
+    dense = estimate_token_budget({'line_count': 30}, min_tokens=512, tokens_per_line=48)
+    assert sparse == 608 and dense == 1952
+    print(f"   ✅ 2 lines -> {sparse} tokens, 30 lines -> {dense} tokens")
+    return True
+
+
+def test_repetition_stop_and_trim():
+    """A looping row is stopped and trimmed; a normal row keeps decoding"""
+    print("\n2️⃣ Testing repetition stop...")
+    prompt_length = 4
+    criteria = RepetitionStoppingCriteria(prompt_length, window=64, min_unique=0.5, check_every=16)
+
+    prose = list(range(100, 164))
+    loop = list(range(200, 216)) + [7, 8, 9, 10, 11] * 10
+    input_ids = torch.tensor([[1] * prompt_length + prose, [1] * prompt_length + loop[:64]])
+
+    done = criteria(input_ids, None)
+    assert done.tolist() == [False, True]
+
+    output_ids, report = finish_generation(input_ids, prompt_length, EOS, max_new_tokens=64,
+                                           repetition=criteria)
+    assert [entry['stop_reason'] for entry in report] == ["length", "repetition"]
+    # The looping row keeps its lead-in plus one copy of the phrase
+    kept = output_ids[1, prompt_length:prompt_length + report[1]['generated_tokens']].tolist()
+    assert kept == list(range(200, 216)) + [7, 8, 9, 10, 11]
+    assert (output_ids[1, prompt_length + report[1]['generated_tokens']:] == EOS).all()
+    print(f"   ✅ Loop stopped, kept {report[1]['generated_tokens']} tokens")
+    return True
+
+
+def test_repetition_with_draft_tokens():
+    """Speculative steps: skipped check points are checked, rejected drafts leave no verdict"""
+    print("\n3️⃣ Testing repetition stop with draft tokens...")
+    prompt_length = 4
+    criteria = RepetitionStoppingCriteria(prompt_length, window=64, min_unique=0.5, check_every=16)
+
+    prose = list(range(100, 120))
+    loop = [7, 8, 9, 10, 11] * 10
+    # A draft probe reaches the 64-token check point with looping tokens...
+    probe = torch.tensor([[1] * prompt_length + prose + loop[:46]])
+    assert criteria(probe, None).tolist() == [True]
+    # ...but only part of the draft is accepted: its verdict is dropped
+    accepted = torch.tensor([[1] * prompt_length + prose + loop[:38]])
+    assert criteria(accepted, None).tolist() == [False]
+    assert criteria.stopped_rows == set()
+    
+    # The next step jumps from 58 to 66 tokens and still runs the check at 64
+    jumped = torch.tensor([[1] * prompt_length + prose + loop[:46]])
+    assert criteria(jumped, None).tolist() == [True]
+    assert criteria.stopped_rows == {0}
+    print("   ✅ Draft verdict dropped, jumped check point caught")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("="*60)
+    print("Testing OCR Decoding Guard")
+    print("="*60)
+
+    results = [
+        test_token_budget(),
+        test_repetition_stop_and_trim(),
+        test_repetition_with_draft_tokens(),
+    ]
+
+    print("\n" + "="*60)
+    print("✅ All tests passed!" if all(results) else "❌ Some tests failed")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    main()
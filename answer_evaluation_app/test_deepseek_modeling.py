@@ -0,0 +1,265 @@
+"""
+Test the repository's DeepseekV2 modeling (modeling_deepseekv2.py) on a tiny random model
+Run this to verify the static KV cache, n-gram speculative decoding and the
+continuous-batching decode scheduler give exactly the output of plain greedy decoding
+"""
+
+import copy
+import sys
+import types
+from pathlib import Path
+
+# Add the current directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+import torch
+from transformers import PretrainedConfig, LogitsProcessorList, NoRepeatNGramLogitsProcessor
+
+from deepseek_ocr import load_repo_modeling
+
+PAD = 0
+
+
+class DeepseekV2Config(PretrainedConfig):
+    """Just the settings the modeling code reads, at toy sizes (the real class ships with the checkpoint)"""
+    model_type = "deepseek_v2"
+
+    def __init__(self, vocab_size=1000, hidden_size=64, intermediate_size=128, moe_intermediate_size=32,
+                 num_hidden_layers=3, num_attention_heads=4, num_key_value_heads=4, n_shared_experts=1,
+                 n_routed_experts=8, ep_size=1, routed_scaling_factor=1.0, kv_lora_rank=16, q_lora_rank=None,
+                 qk_rope_head_dim=8, v_head_dim=16, qk_nope_head_dim=16, topk_method="greedy", n_group=1,
+                 topk_group=1, num_experts_per_tok=2, moe_layer_freq=1, first_k_dense_replace=1,
+                 norm_topk_prob=False, scoring_func="softmax", aux_loss_alpha=0.001, seq_aux=True,
+                 hidden_act="silu", max_position_embeddings=256, initializer_range=0.02, rms_norm_eps=1e-6,
+                 use_cache=True, rope_theta=10000.0, rope_scaling=None, attention_bias=False,
+                 attention_dropout=0.0, use_mla=True, **kwargs):
+        for key, value in dict(locals()).items():
+            if key not in ("self", "kwargs", "__class__"):
+                setattr(self, key, value)
+        kwargs.setdefault("pad_token_id", PAD)
+        kwargs.setdefault("eos_token_id", 1)
+        kwargs.setdefault("tie_word_embeddings", False)
+        super().__init__(**kwargs)
+
+
+def load_modeling():
+    """Import modeling_deepseekv2.py next to the tiny config, as DeepSeekOCR does next to the hub's"""
+    package = types.ModuleType("tiny_deepseek_v2")
+    package.__path__ = []
+    configuration = types.ModuleType("tiny_deepseek_v2.configuration_deepseek_v2")
+    configuration.DeepseekV2Config = DeepseekV2Config
+    DeepseekV2Config.__module__ = configuration.__name__
+    sys.modules[package.__name__] = package
+    sys.modules[configuration.__name__] = configuration
+    return load_repo_modeling(DeepseekV2Config)
+
+
+modeling = load_modeling()
+
+
+def tiny_model(attn_implementation: str = "eager", **config):
+    """A seeded fp32 DeepseekV2ForCausalLM with MLA attention and MoE layers"""
+    torch.manual_seed(0)
+    return modeling.DeepseekV2ForCausalLM._from_config(
+        DeepseekV2Config(**config), attn_implementation=attn_implementation
+    ).eval()
+
+
+def left_padded_batch():
+    """Two prompts of different length, padded on the left"""
+    torch.manual_seed(1)
+    input_ids = torch.randint(2, 1000, (2, 12))
+    attention_mask = torch.ones_like(input_ids)
+    input_ids[0, :4] = PAD
+    attention_mask[0, :4] = 0
+    return input_ids, attention_mask
+
+
+def test_static_cache_matches_dynamic():
+    """Greedy decoding into DeepseekV2StaticCache gives the same tokens as the default cache"""
+    print("\n1️⃣ Testing static cache output...")
+    input_ids, attention_mask = left_padded_batch()
+    for attn_implementation in ("eager", "sdpa"):
+        model = tiny_model(attn_implementation)
+        generate = dict(attention_mask=attention_mask, max_new_tokens=20, do_sample=False, pad_token_id=PAD)
+        expected = model.generate(input_ids, **generate)
+
+        cache = modeling.DeepseekV2StaticCache(model.model, 2, 12 + 20)
+        assert torch.equal(model.generate(input_ids, past_key_values=cache, **generate), expected)
+        assert cache.get_seq_length() == 12 + 19 and cache.seen_tokens == 12 + 19
+
+        # A cache larger than the page needs leaves the output alone
+        cache = modeling.DeepseekV2StaticCache(model.model, 2, 64)
+        assert torch.equal(model.generate(input_ids, past_key_values=cache, **generate), expected)
+        assert torch.equal(model.generate(input_ids, cache_implementation="static", **generate), expected)
+        print(f"   ✅ {attn_implementation}: {expected.shape[1] - 12} tokens match the dynamic cache")
+    return True
+
+
+def test_static_cache_reuse():
+    """cache_implementation="static" keeps its buffers across calls and rebuilds them for a new batch size"""
+    print("\n2️⃣ Testing static cache reuse...")
+    input_ids, attention_mask = left_padded_batch()
+    model = tiny_model("sdpa")
+    generate = dict(max_new_tokens=16, do_sample=False, pad_token_id=PAD, cache_implementation="static")
+
+    first = model.generate(input_ids, attention_mask=attention_mask, **generate)
+    cache = model._cache
+    pointers = [t.data_ptr() for t in cache.key_cache + cache.value_cache]
+    second = model.generate(input_ids, attention_mask=attention_mask, **generate)
+    assert torch.equal(first, second)
+    assert model._cache is cache and pointers == [t.data_ptr() for t in cache.key_cache + cache.value_cache]
+
+    # reset() empties the cache for the next page
+    cache.reset()
+    assert cache.get_seq_length() == 0 and not any(t.any() for t in cache.key_cache + cache.value_cache)
+
+    single = model.generate(input_ids[1:], **generate)
+    assert model._cache is not cache and model._cache.batch_size == 1
+    assert torch.equal(single, model.generate(input_ids[1:], max_new_tokens=16, do_sample=False, pad_token_id=PAD))
+    print("   ✅ Buffers reused for batch 2, rebuilt for batch 1")
+    return True
+
+
+def test_prompt_lookup_matches_greedy():
+    """Verified n-gram drafts leave greedy output unchanged, with or without reference text"""
+    print("\n3️⃣ Testing prompt lookup decoding...")
+    torch.manual_seed(2)
+    input_ids = torch.randint(2, 1000, (1, 20))
+    for attn_implementation in ("eager", "sdpa"):
+        model = tiny_model(attn_implementation)
+        greedy = dict(max_new_tokens=40, do_sample=False, pad_token_id=PAD)
+        expected = model.generate(input_ids, **greedy)
+        new_tokens = expected.shape[1] - input_ids.shape[1]
+
+        # The expected text as reference lets most drafts through; junk adds none
+        accepted = []
+        for references in (None, [expected[0, 25:55].tolist()], [[5, 6, 7, 8]]):
+            generation_config = copy.deepcopy(model.generation_config)
+            generation_config.prompt_lookup_reference_ids = references
+            output = model.generate(input_ids, prompt_lookup_num_tokens=8, max_matching_ngram_size=3,
+                                    generation_config=generation_config, **greedy)
+            assert torch.equal(output, expected), (attn_implementation, references)
+
+            generator = model.prompt_lookup_generator
+            assert isinstance(generator, modeling.NgramCandidateGenerator)
+            stats = generator.stats()
+            # Every step keeps its accepted draft tokens plus one token of the model
+            assert stats['accepted_tokens'] + stats['steps'] == new_tokens, stats
+            assert stats['accepted_tokens'] <= stats['drafted_tokens']
+            assert abs(stats['tokens_per_step'] * stats['steps'] - new_tokens) < 1e-6
+            accepted.append(stats['accepted_tokens'])
+        assert accepted[1] > max(accepted[0], accepted[2]), accepted
+        print(f"   ✅ {attn_implementation}: same {new_tokens} tokens as greedy, "
+              f"accepted drafts without/with/junk reference: {accepted}")
+    return True
+
+
+def test_ngram_draft_stops_at_eos():
+    """Drafts follow the latest n-gram match, end before EOS and respect max_length"""
+    print("\n4️⃣ Testing n-gram drafts...")
+    reference = [5, 6, 7, 1, 8, 9]
+
+    generator = modeling.NgramCandidateGenerator(torch.tensor([1]), num_output_tokens=4,
+                                                 max_length=20, reference_ids=[reference])
+    candidates, _ = generator.get_candidates(torch.tensor([[3, 5, 6]]))
+    assert candidates.tolist() == [[3, 5, 6, 7]]
+
+    generator = modeling.NgramCandidateGenerator(None, num_output_tokens=4, max_length=20,
+                                                 reference_ids=[reference])
+    candidates, _ = generator.get_candidates(torch.tensor([[3, 5, 6]]))
+    assert candidates.tolist() == [[3, 5, 6, 7, 1, 8, 9]]
+
+    # The sequence itself is searched too, and its latest occurrence wins
+    generator = modeling.NgramCandidateGenerator(None, num_output_tokens=2, max_length=20)
+    candidates, _ = generator.get_candidates(torch.tensor([[4, 2, 3, 4, 2, 8, 9, 4, 2]]))
+    assert candidates[0, 9:].tolist() == [8, 9]
+
+    # Room for the model's own token is kept below max_length; without a match there is no draft
+    generator = modeling.NgramCandidateGenerator(None, num_output_tokens=4, max_length=6,
+                                                 reference_ids=[reference])
+    assert generator.get_candidates(torch.tensor([[3, 5, 6]]))[0].tolist() == [[3, 5, 6, 7, 1]]
+    assert generator.get_candidates(torch.tensor([[3, 5, 6, 7, 1, 4]]))[0].tolist() == [[3, 5, 6, 7, 1, 4]]
+
+    generator.update_candidate_strategy(None, None, 2)
+    generator.update_candidate_strategy(None, None, 0)
+    stats = generator.stats()
+    assert stats == {'steps': 2, 'drafted_tokens': 2, 'accepted_tokens': 2,
+                     'acceptance_rate': 1.0, 'tokens_per_step': 2.0}, stats
+    print(f"   ✅ Drafts cut at EOS and max_length: {stats}")
+    return True
+
+
+def test_decode_scheduler_matches_generate():
+    """Requests arriving mid-decode, with their own budgets, EOS and processors, decode as they would alone"""
+    print("\n5️⃣ Testing continuous-batching decode scheduler...")
+    torch.manual_seed(3)
+    prompts = [torch.randint(2, 1000, (1, length)) for length in (9, 30, 5, 17, 24, 12, 40, 8)]
+    budgets = [3, 30, 1, 25, 12, 20, 6, 16]
+    no_eos = 999999
+
+    for attn_implementation in ("eager", "sdpa"):
+        model = tiny_model(attn_implementation)
+        requests, expected = [], []
+        for i, (input_ids, budget) in enumerate(zip(prompts, budgets)):
+            greedy = dict(max_new_tokens=budget, do_sample=False, pad_token_id=PAD)
+            eos_token_id = no_eos
+            if i % 2:
+                # A token the request really produces, so it stops early on EOS
+                full = model.generate(input_ids, eos_token_id=no_eos, **greedy)
+                eos_token_id = int(full[0, input_ids.shape[1] + budget // 2])
+            no_repeat = i % 3 == 0
+            if no_repeat:
+                greedy['no_repeat_ngram_size'] = 3
+            expected.append(model.generate(input_ids, eos_token_id=eos_token_id, **greedy))
+            assert eos_token_id == no_eos or expected[-1][0, -1] == eos_token_id
+            processors = LogitsProcessorList([NoRepeatNGramLogitsProcessor(3)]) if no_repeat else None
+            requests.append((input_ids, budget, eos_token_id, processors))
+
+        scheduler = modeling.DeepseekV2DecodeScheduler(model, max_batch_size=3, max_cache_len=80)
+        # Record which slots free up and which slot moves into them
+        moves = []
+        retire = scheduler.cache.retire
+        scheduler.cache.retire = lambda slot: moves.append((slot, retire(slot))) or moves[-1][1]
+
+        outputs, waiting = {}, list(requests)
+        with torch.no_grad():
+            while waiting or scheduler.has_unfinished():
+                # Staggered arrivals: one new request every other step, or at once when idle
+                if waiting and (scheduler.steps % 2 == 0 or not scheduler.has_unfinished()):
+                    input_ids, budget, eos_token_id, processors = waiting.pop(0)
+                    scheduler.submit(input_ids, budget, eos_token_id=eos_token_id, logits_processor=processors)
+                outputs.update(scheduler.step())
+                assert scheduler.cache.active == scheduler.stats()['running'] <= 3
+
+        for request_id, reference in enumerate(expected):
+            assert torch.equal(outputs[request_id], reference), (attn_implementation, request_id)
+        assert any(slot != moved for slot, moved in moves), moves
+        stats = scheduler.stats()
+        assert stats['prefilled_sequences'] == len(requests) and stats['running'] == stats['waiting'] == 0
+        assert stats['mean_batch_size'] > 1
+        print(f"   ✅ {attn_implementation}: {len(requests)} requests match generate(), {stats}")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("="*60)
+    print("Testing DeepseekV2 Modeling")
+    print("="*60)
+
+    results = [
+        test_static_cache_matches_dynamic(),
+        test_static_cache_reuse(),
+        test_prompt_lookup_matches_greedy(),
+        test_ngram_draft_stops_at_eos(),
+        test_decode_scheduler_matches_generate(),
+    ]
+
+    print("\n" + "="*60)
+    print("✅ All tests passed!" if all(results) else "❌ Some tests failed")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    main()
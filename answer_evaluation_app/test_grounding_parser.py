@@ -0,0 +1,96 @@
+"""
+Test parsing of DeepSeek-OCR grounding output
+Run this to verify line records, tag stripping and layout-based answer segmentation
+"""
+
+import sys
+from pathlib import Path
+
+# Add the current directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from grounding_parser import parse_ocr_document, segment_answers, strip_grounding
+from page_screening import BLANK_PAGE_MARKER
+
+SAMPLE_OUTPUT = """
+--- Page 1 ---
+<|ref|>title<|/ref|><|det|>[[300, 20, 700, 60]]<|/det|>
+# Biology Test
+<|ref|>text<|/ref|><|det|>[[80, 100, 900, 160]]<|/det|>
+1. Photosynthesis converts light energy
+into chemical energy in chloroplasts.
+<|ref|>text<|/ref|><|det|>[[140, 170, 900, 200]]<|/det|>
+2. Chlorophyll absorbs red and blue light.
+<|ref|>image<|/ref|><|det|>[[100, 220, 400, 400]]<|/det|>
+
+<|ref|>text<|/ref|><|det|>[[82, 420, 900, 460]]<|/det|>
+Q2) Osmosis is movement of water across a membrane.
+
+--- Page 2 ---
+[blank page - OCR skipped]
+
+--- Page 3 ---
+<|ref|>text<|/ref|><|det|>[[90, 50, 900, 90]]<|/det|>
+Ans 3: Mitochondria release energy by respiration.
+"""
+
+
+def test_line_records():
+    """Blocks become per-line records with page, label and box"""
+    print("\n1️⃣ Testing line records...")
+    records = parse_ocr_document(SAMPLE_OUTPUT)
+
+    assert records[0] == {'page': 1, 'label': 'title', 'text': '# Biology Test', 'bbox': (300, 20, 700, 60)}
+    # The two-line block is split into two line boxes
+    assert records[1]['bbox'] == (80, 100, 900, 130)
+    assert records[2]['bbox'] == (80, 130, 900, 160)
+    assert all(r['label'] != 'image' for r in records)
+    assert all(r['text'] != BLANK_PAGE_MARKER for r in records)
+    assert records[-1]['page'] == 3
+    print(f"   ✅ {len(records)} line records")
+    return True
+
+
+def test_strip_grounding():
+    """Tags and box coordinates never reach the plain text"""
+    print("\n2️⃣ Testing tag stripping...")
+    text = strip_grounding(SAMPLE_OUTPUT)
+
+    assert "<|" not in text and "[[" not in text
+    assert "Photosynthesis converts light energy\ninto chemical energy" in text
+    print("   ✅ Plain text keeps content and line breaks")
+    return True
+
+
+def test_segment_by_layout():
+    """Indented numbered points stay inside the current answer"""
+    print("\n3️⃣ Testing layout segmentation...")
+    answers = segment_answers(parse_ocr_document(SAMPLE_OUTPUT))
+
+    assert [a['question_number'] for a in answers] == [1, 2, 3]
+    assert "Chlorophyll absorbs" in answers[0]['student_answer']
+    assert answers[1]['student_answer'] == "Osmosis is movement of water across a membrane."
+    assert answers[2]['student_answer'].startswith("Mitochondria")
+    print(f"   ✅ {len(answers)} answers segmented")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("="*60)
+    print("Testing Grounding Output Parser")
+    print("="*60)
+
+    results = [
+        test_line_records(),
+        test_strip_grounding(),
+        test_segment_by_layout(),
+    ]
+
+    print("\n" + "="*60)
+    print("✅ All tests passed!" if all(results) else "❌ Some tests failed")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    main()
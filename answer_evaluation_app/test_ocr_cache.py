@@ -0,0 +1,97 @@
+"""
+Test the content-addressed OCR result cache
+Run this to verify hits, misses, key separation and LRU eviction
+"""
+
+import os
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+# Add the current directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from PIL import Image
+
+from ocr_cache import OCRResultCache, hash_image_pixels
+
+
+def test_cache_hit_and_miss():
+    """A stored result comes back, an unknown key misses"""
+    print("\n1️⃣ Testing cache hit/miss...")
+    cache = OCRResultCache(cache_dir=tempfile.mkdtemp())
+
+    key = cache.make_key("page-hash", base_size=1024, crop_mode=True)
+    assert cache.get(key) is None
+
+    cache.put(key, "Ans 1. Photosynthesis")
+    assert cache.get(key) == "Ans 1. Photosynthesis"
+
+    stats = cache.stats()
+    assert stats['hits'] == 1 and stats['misses'] == 1
+    print(f"   ✅ {stats}")
+    return True
+
+
+def test_key_depends_on_pixels_and_params():
+    """Same pixels share a key; changed pixels or parameters do not"""
+    print("\n2️⃣ Testing cache keys...")
+    page = Image.new("RGB", (64, 48), "white")
+    same_page = page.copy()
+    other_page = page.copy()
+    other_page.putpixel((10, 10), (0, 0, 0))
+
+    assert hash_image_pixels(page) == hash_image_pixels(same_page)
+    assert hash_image_pixels(page) != hash_image_pixels(other_page)
+
+    pixels = hash_image_pixels(page)
+    base_key = OCRResultCache.make_key(pixels, base_size=1024, image_size=640, crop_mode=True)
+    assert base_key == OCRResultCache.make_key(pixels, crop_mode=True, image_size=640, base_size=1024)
+    assert base_key != OCRResultCache.make_key(pixels, base_size=640, image_size=640, crop_mode=True)
+    assert base_key != OCRResultCache.make_key(pixels, base_size=1024, image_size=640, crop_mode=False)
+    print("   ✅ Keys separate pixels and inference parameters")
+    return True
+
+
+def test_lru_eviction():
+    """Least recently used entries are evicted once over budget"""
+    print("\n3️⃣ Testing LRU eviction...")
+    cache = OCRResultCache(cache_dir=tempfile.mkdtemp(), max_mb=100 / (1024 * 1024))
+    keys = [cache.make_key(str(i)) for i in range(4)]
+
+    for key in keys[:3]:
+        cache.put(key, "x" * 30)
+        time.sleep(0.01)
+
+    # Touch the oldest entry so the second one becomes least recently used
+    time.sleep(0.01)
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[3], "x" * 30)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.stats()['size_bytes'] <= cache.max_bytes
+    print(f"   ✅ Evicted {cache.stats()['evictions']} entry, size within budget")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("="*60)
+    print("Testing OCR Result Cache")
+    print("="*60)
+
+    results = [
+        test_cache_hit_and_miss(),
+        test_key_depends_on_pixels_and_params(),
+        test_lru_eviction(),
+    ]
+
+    print("\n" + "="*60)
+    print("✅ All tests passed!" if all(results) else "❌ Some tests failed")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Test the per-page OCR fallback chain
+Run this to verify failure classification and which tiers are tried after each failure
+"""
+
+import sys
+import types
+from pathlib import Path
+
+# Add the current directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from PIL import Image
+
+import deepseek_ocr
+from deepseek_ocr import DeepSeekOCR
+
+classify = DeepSeekOCR._classify_failure
+
+
+def fallback_ocr(small=None, tesseract=None):
+    """
+    A DeepSeekOCR without a model whose lower tiers are canned callables
+
+    Each tier returns its text, or raises it if it is an exception; the tiers
+    run are listed in `ocr.tiers_run`.
+    """
+    ocr = DeepSeekOCR(use_cache=False)
+    ocr.tiers_run = []
+
+    def tier(name, outcome, decode_stop=None):
+        def run(*args):
+            ocr.tiers_run.append(name)
+            ocr.last_decode_stop = decode_stop
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+        return run
+
+    ocr.tier = tier
+    ocr._extract_at_mode = tier("deepseek_small", small)
+    ocr._tesseract_text = tier("tesseract", tesseract)
+    # The Tesseract tier is canned, so it does not need pytesseract
+    deepseek_ocr.TESSERACT_AVAILABLE = True
+    return ocr
+
+
+def test_failure_classes():
+    """Exceptions, decode stops and empty output map to their failure class"""
+    print("\n1️⃣ Testing failure classification...")
+    assert classify(MemoryError()) == "oom"
+    assert classify(RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")) == "oom"
+    assert classify(RuntimeError("[enforce fail at alloc_cpu.cpp] DefaultCPUAllocator: can't allocate memory")) == "oom"
+    assert classify(TimeoutError()) == "timeout"
+    assert classify(RuntimeError("Tesseract process timed out")) == "timeout"
+    assert classify(ValueError("bad image")) == "error"
+
+    assert classify(text="Ans 1", decode_stop="timeout") == "timeout"
+    assert classify(text="") == "empty" and classify(text=" \n\t") == "empty" and classify(text=None) == "empty"
+    # A loop trimmed by the repetition guard still leaves usable text
+    assert classify(text="Ans 1. x = 2", decode_stop="repetition") is None
+    assert classify(text="Ans 1. x = 2", decode_stop="length") is None
+    assert classify(text="", decode_stop="repetition") == "empty"
+    print("   ✅ oom, timeout, error and empty recognized; repetition-trimmed text kept")
+    return True
+
+
+def test_fallback_tiers():
+    """Each failure only moves on to the tiers TIER_RECOVERS_FROM allows"""
+    print("\n2️⃣ Testing fallback tiers...")
+    page = Image.new("RGB", (64, 64), "white")
+
+    # OOM: the small single-view mode gets a chance
+    ocr = fallback_ocr(small="small text", tesseract="tesseract text")
+    text = ocr._extract_with_fallback(page, primary=ocr.tier("deepseek", MemoryError()))
+    assert text == "small text" and ocr.tiers_run == ["deepseek", "deepseek_small"]
+    assert ocr.last_ocr_tier == {'tier': "deepseek_small", 'failures': {'deepseek': "oom"}}
+
+    # Empty output: a smaller view will not help, go straight to Tesseract
+    ocr = fallback_ocr(small="small text", tesseract="tesseract text")
+    text = ocr._extract_with_fallback(page, primary=ocr.tier("deepseek", "  "))
+    assert text == "tesseract text" and ocr.tiers_run == ["deepseek", "tesseract"]
+    assert ocr.last_ocr_tier == {'tier': "tesseract", 'failures': {'deepseek': "empty"}}
+
+    # Timeout with partial text, Tesseract empty: the partial DeepSeek text is kept
+    ocr = fallback_ocr(small="small text", tesseract="")
+    text = ocr._extract_with_fallback(page, primary=ocr.tier("deepseek", "Ans 1. The", decode_stop="timeout"))
+    assert text == "Ans 1. The" and ocr.tiers_run == ["deepseek", "tesseract"]
+    assert ocr.last_ocr_tier == {'tier': "deepseek", 'failures': {'deepseek': "timeout", 'tesseract': "empty"}}
+    assert ocr.last_decode_stop == "timeout"
+
+    # Error, then OOM at the small mode: Tesseract is the last resort
+    ocr = fallback_ocr(small=RuntimeError("CUDA out of memory"), tesseract="tesseract text")
+    text = ocr._extract_with_fallback(page, primary=ocr.tier("deepseek", ValueError("bad crop")))
+    assert text == "tesseract text" and ocr.tiers_run == ["deepseek", "deepseek_small", "tesseract"]
+    assert ocr.last_ocr_tier['failures'] == {'deepseek': "error", 'deepseek_small': "oom"}
+
+    # A tier that already failed elsewhere (batched pass) is not run again
+    ocr = fallback_ocr(small="small text", tesseract="tesseract text")
+    text = ocr._extract_with_fallback(page, failures={'deepseek': "timeout"})
+    assert text == "tesseract text" and ocr.tiers_run == ["tesseract"]
+    print("   ✅ oom/error -> small mode, timeout/empty -> Tesseract, partial text kept")
+    return True
+
+
+def test_tesseract_time_budget():
+    """Tesseract gets the tier's budget as its timeout, and no limit when the tier is unbounded"""
+    print("\n3️⃣ Testing Tesseract time budget...")
+    page = Image.new("RGB", (64, 64), "white")
+    timeouts = []
+    # Stands in for pytesseract and records the timeout it is given
+    deepseek_ocr.pytesseract = types.SimpleNamespace(
+        image_to_string=lambda image, lang=None, timeout=0: timeouts.append(timeout) or "tesseract text"
+    )
+    deepseek_ocr.TESSERACT_AVAILABLE = True
+    budgets = dict(deepseek_ocr.OCR_TIER_TIME_BUDGETS)
+    try:
+        for budget in (60, 0.4, None):
+            deepseek_ocr.OCR_TIER_TIME_BUDGETS = dict(budgets, tesseract=budget)
+            ocr = DeepSeekOCR(use_cache=False)
+            text = ocr._extract_with_fallback(page, failures={'deepseek': "timeout"})
+            assert text == "tesseract text"
+        deepseek_ocr.OCR_TIER_TIME_BUDGETS = {'deepseek': 300}
+        DeepSeekOCR(use_cache=False)._extract_with_fallback(page, failures={'deepseek': "empty"})
+    finally:
+        deepseek_ocr.OCR_TIER_TIME_BUDGETS = budgets
+    # 0 is pytesseract's "no limit"; finite budgets get at least a second
+    assert timeouts == [60, 1, 0, 0], timeouts
+    print(f"   ✅ Timeouts passed to Tesseract: {timeouts}")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("="*60)
+    print("Testing OCR Fallback Chain")
+    print("="*60)
+
+    results = [
+        test_failure_classes(),
+        test_fallback_tiers(),
+        test_tesseract_time_budget(),
+    ]
+
+    print("\n" + "="*60)
+    print("✅ All tests passed!" if all(results) else "❌ Some tests failed")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    main()
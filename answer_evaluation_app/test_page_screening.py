@@ -0,0 +1,126 @@
+"""
+Test the page pre-screening used before DeepSeek-OCR
+Run this to verify ruled blank pages are skipped, written pages are kept,
+and photographed pages are cropped to their answer region and deskewed
+"""
+
+import sys
+from pathlib import Path
+
+# Add the current directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+from PIL import Image, ImageDraw, ImageFont
+
+from page_screening import is_blank_page, crop_to_content, BLANK_PAGE_INK_RATIO
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def ruled_page():
+    """A4 page at 300 DPI with blue ruling and a red margin line"""
+    page = Image.new("RGB", (2480, 3508), (250, 250, 245))
+    draw = ImageDraw.Draw(page)
+    for y in range(300, 3400, 90):
+        draw.line([(0, y), (2480, y)], fill=(60, 60, 160), width=4)
+    draw.line([(300, 0), (300, 3508)], fill=(200, 40, 40), width=4)
+    return page
+
+
+def test_blank_pages_detected():
+    """Plain and ruled pages without writing are blank"""
+    print("\n1️⃣ Testing blank page detection...")
+    assert is_blank_page(Image.new("RGB", (2000, 2800), "white"))[0]
+    blank, stats = is_blank_page(ruled_page())
+    assert blank, stats
+    print(f"   ✅ Ruled page detected as blank: {stats}")
+    return True
+
+
+def test_written_pages_kept():
+    """Handwriting on ruled paper and the sample images are not blank"""
+    print("\n2️⃣ Testing written pages...")
+    page = ruled_page()
+    draw = ImageDraw.Draw(page)
+    for k in range(6):
+        draw.line([(400, 630 + k * 90), (1800, 610 + k * 90)], fill=(10, 10, 10), width=6)
+    blank, stats = is_blank_page(page)
+    assert not blank, stats
+
+    for name in ["math.jpeg", "image1.jpeg", "im.jpeg"]:
+        path = REPO_ROOT / name
+        if path.exists():
+            assert not is_blank_page(Image.open(path).convert("RGB"))[0], name
+    print("   ✅ Written pages kept for OCR")
+    return True
+
+
+def test_short_answer_kept():
+    """A page holding one short answer line is not blank, though its ink ratio is tiny"""
+    print("\n3️⃣ Testing single short answer...")
+    page = ruled_page()
+    ImageDraw.Draw(page).text((400, 560), "Ans 3: x = 5", fill=(10, 10, 10),
+                              font=ImageFont.load_default(size=60))
+    blank, stats = is_blank_page(page)
+    assert not blank and stats['ink_ratio'] < BLANK_PAGE_INK_RATIO, stats
+
+    # A short strip of a real answer sheet pasted on an empty page
+    path = REPO_ROOT / "math.jpeg"
+    if path.exists():
+        sample = Image.open(path).convert("RGB")
+        strip = sample.crop((0, 0, sample.width, min(120, sample.height)))
+        page = Image.new("RGB", (2480, 3508), "white")
+        page.paste(strip, (300, 600))
+        blank, strip_stats = is_blank_page(page)
+        assert not blank, strip_stats
+    print(f"   ✅ One answer line kept for OCR: {stats}")
+    return True
+
+
+def test_crop_to_answer_region():
+    """A tilted page photographed on a desk is cropped to its writing and straightened"""
+    print("\n4️⃣ Testing answer-region crop and deskew...")
+    # Light printed ruling, as on real answer sheets
+    page = Image.new("RGB", (2480, 3508), (250, 250, 245))
+    draw = ImageDraw.Draw(page)
+    for y in range(300, 3400, 90):
+        draw.line([(0, y), (2480, y)], fill=(150, 170, 210), width=4)
+    for k in range(8):
+        for x in range(600, 1800, 240):
+            draw.line([(x, 900 + k * 90), (x + 160, 880 + k * 90)], fill=(10, 10, 10), width=8)
+
+    photo = Image.new("RGB", (3200, 4200), (70, 55, 40))
+    photo.paste(page.rotate(3, expand=True, fillcolor=(70, 55, 40)), (300, 300))
+
+    cropped, info = crop_to_content(photo)
+    assert info['crop_box'] is not None and info['area_ratio'] < 0.25, info
+    assert abs(info['skew_angle'] + 3) <= 0.5, info
+    assert cropped.width < photo.width // 2 and cropped.height < photo.height // 2
+
+    # Pages without writing are left alone
+    blank, blank_info = crop_to_content(Image.new("RGB", (800, 600), "white"))
+    assert blank_info['crop_box'] is None and blank.size == (800, 600)
+    print(f"   ✅ Cropped {photo.size} -> {cropped.size}: {info}")
+    return True
+
+
+def main():
+    """Run all tests"""
+    print("="*60)
+    print("Testing Page Screening (blank pages, crop and deskew)")
+    print("="*60)
+
+    results = [
+        test_blank_pages_detected(),
+        test_written_pages_kept(),
+        test_short_answer_kept(),
+        test_crop_to_answer_region(),
+    ]
+
+    print("\n" + "="*60)
+    print("✅ All tests passed!" if all(results) else "❌ Some tests failed")
+    print("="*60 + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,9 +18,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """ PyTorch DeepSeek model and compatible with both DeepSeekV2 and DeepSeekV3"""
+import contextlib
+import csv
+import itertools
+import json
 import math
+import mmap
+import os
+import time
 import warnings
-from typing import List, Optional, Tuple, Union
+from collections import OrderedDict, deque
+from typing import Any, Dict, List, Optional, Tuple, Union
 import numpy as np
 
 import torch
@@ -32,14 +40,24 @@ from torch import nn
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 
 from transformers.activations import ACT2FN
+from transformers.generation import GenerationConfig, LogitsProcessorList
+from transformers.generation.candidate_generator import CandidateGenerator
 from transformers.cache_utils import Cache, DynamicCache
-from transformers.modeling_attn_mask_utils import _prepare_4d_causal_attention_mask
+from transformers.modeling_attn_mask_utils import (
+    _prepare_4d_causal_attention_mask,
+    _prepare_4d_causal_attention_mask_for_sdpa,
+)
 from transformers.models.llama.modeling_llama import (
     LlamaAttention
 )
 
 # Compatibility patch: define LlamaFlashAttention2 if missing
 LlamaFlashAttention2 = LlamaAttention
+try:
+    from transformers.models.llama.modeling_llama import LlamaSdpaAttention
+except ImportError:
+    # Newer transformers dispatch SDPA inside LlamaAttention itself
+    LlamaSdpaAttention = LlamaAttention
 from transformers.modeling_outputs import (
     BaseModelOutputWithPast,
     CausalLMOutputWithPast,
@@ -115,7 +133,18 @@ ALL_LAYERNORM_LAYERS.append(DeepseekV2RMSNorm)
 
 
 
+# cos/sin tables shared by every rotary embedding with the same parameters, keyed by
+# (rotary parameters..., device, dtype)
+_ROTARY_TABLES = {}
+
+
 class DeepseekV2RotaryEmbedding(nn.Module):
+    """
+    Rotary position embedding. The cos/sin tables are built once per (device, dtype) for at least
+    `max_position_embeddings` positions and shared by all layers with the same parameters, so a forward call only
+    slices them; they are rebuilt (at double the length) only if a sequence outgrows them.
+    """
+
     def __init__(self, dim, max_position_embeddings=2048, base=10000, device=None):
         super().__init__()
 
@@ -128,34 +157,46 @@ class DeepseekV2RotaryEmbedding(nn.Module):
         self.register_buffer("inv_freq", inv_freq, persistent=False)
 
         # Build here to make `torch.jit.trace` work.
-        self._set_cos_sin_cache(
+        self._rotary_tables(
             seq_len=max_position_embeddings,
             device=self.inv_freq.device,
             dtype=torch.get_default_dtype(),
         )
-        self.max_seq_len_cached = None
 
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
-        t = torch.arange(
-            self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype
-        )
+    def _rotary_params(self):
+        """Everything the tables depend on besides device, dtype and length"""
+        return (type(self).__name__, self.dim, self.max_position_embeddings, self.base)
+
+    def _compute_cos_sin(self, seq_len, device):
+        """float32 cos/sin tables for positions [0, seq_len)"""
+        t = torch.arange(seq_len, device=device, dtype=self.inv_freq.dtype)
 
         freqs = torch.outer(t, self.inv_freq.to(t.device))
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
+        return emb.cos(), emb.sin()
+
+    def _rotary_tables(self, seq_len, device, dtype):
+        """Shared (cos, sin) tables covering at least `seq_len` positions, built on first use"""
+        key = self._rotary_params() + (torch.device(device), dtype)
+        tables = _ROTARY_TABLES.get(key)
+        if tables is None or tables[0].shape[0] < seq_len:
+            length = max(seq_len, self.max_position_embeddings)
+            if tables is not None:
+                length = max(length, 2 * tables[0].shape[0])
+            cos, sin = self._compute_cos_sin(length, device)
+            tables = (cos.to(dtype), sin.to(dtype))
+            _ROTARY_TABLES[key] = tables
+        self.cos_cached, self.sin_cached = tables
+        self.max_seq_len_cached = tables[0].shape[0]
+        return tables
 
     def forward(self, x, seq_len=None):
         # x: [bs, num_attention_heads, seq_len, head_size]
-        if self.max_seq_len_cached is None or seq_len > self.max_seq_len_cached:
-            self._set_cos_sin_cache(seq_len=seq_len, device=x.device, dtype=x.dtype)
-
-        return (
-            self.cos_cached[:seq_len].to(dtype=x.dtype),
-            self.sin_cached[:seq_len].to(dtype=x.dtype),
-        )
+        cos, sin = self.cos_cached, self.sin_cached
+        if cos.device != x.device or cos.dtype != x.dtype or seq_len > cos.shape[0]:
+            cos, sin = self._rotary_tables(seq_len, x.device, x.dtype)
+        return cos[:seq_len], sin[:seq_len]
 
 
 # Copied from transformers.models.llama.modeling_llama.LlamaLinearScalingRotaryEmbedding with Llama->DeepseekV2
@@ -173,23 +214,27 @@ class DeepseekV2LinearScalingRotaryEmbedding(DeepseekV2RotaryEmbedding):
         self.scaling_factor = scaling_factor
         super().__init__(dim, max_position_embeddings, base, device)
 
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
-        t = torch.arange(
-            self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype
-        )
+    def _rotary_params(self):
+        return super()._rotary_params() + (self.scaling_factor,)
+
+    def _compute_cos_sin(self, seq_len, device):
+        t = torch.arange(seq_len, device=device, dtype=self.inv_freq.dtype)
         t = t / self.scaling_factor
 
-        freqs = torch.outer(t, self.inv_freq)
+        freqs = torch.outer(t, self.inv_freq.to(t.device))
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
+        return emb.cos(), emb.sin()
 
 
 # Copied from transformers.models.llama.modeling_llama.LlamaDynamicNTKScalingRotaryEmbedding with Llama->DeepseekV2
 class DeepseekV2DynamicNTKScalingRotaryEmbedding(DeepseekV2RotaryEmbedding):
-    """DeepseekV2RotaryEmbedding extended with Dynamic NTK scaling. Credits to the Reddit users /u/bloc97 and /u/emozilla"""
+    """
+    DeepseekV2RotaryEmbedding extended with Dynamic NTK scaling. Credits to the Reddit users /u/bloc97 and /u/emozilla
+
+    The NTK base follows the table length rather than the current sequence length, so it only changes when a
+    sequence outgrows the tables; tables up to `max_position_embeddings` are unscaled as before.
+    """
 
     def __init__(
         self,
@@ -202,9 +247,11 @@ class DeepseekV2DynamicNTKScalingRotaryEmbedding(DeepseekV2RotaryEmbedding):
         self.scaling_factor = scaling_factor
         super().__init__(dim, max_position_embeddings, base, device)
 
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
+    def _rotary_params(self):
+        return super()._rotary_params() + (self.scaling_factor,)
 
+    def _compute_cos_sin(self, seq_len, device):
+        inv_freq = self.inv_freq.to(device)
         if seq_len > self.max_position_embeddings:
             base = self.base * (
                 (self.scaling_factor * seq_len / self.max_position_embeddings)
@@ -213,17 +260,13 @@ class DeepseekV2DynamicNTKScalingRotaryEmbedding(DeepseekV2RotaryEmbedding):
             inv_freq = 1.0 / (
                 base ** (torch.arange(0, self.dim, 2).float().to(device) / self.dim)
             )
-            self.register_buffer("inv_freq", inv_freq, persistent=False)
 
-        t = torch.arange(
-            self.max_seq_len_cached, device=device, dtype=self.inv_freq.dtype
-        )
+        t = torch.arange(seq_len, device=device, dtype=inv_freq.dtype)
 
-        freqs = torch.outer(t, self.inv_freq)
+        freqs = torch.outer(t, inv_freq)
         # Different from paper, but it uses a different permutation in order to obtain the same calculation
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer("cos_cached", emb.cos().to(dtype), persistent=False)
-        self.register_buffer("sin_cached", emb.sin().to(dtype), persistent=False)
+        return emb.cos(), emb.sin()
 
 
 # Inverse dim formula to find dim based on number of rotations
@@ -286,8 +329,17 @@ class DeepseekV2YarnRotaryEmbedding(DeepseekV2RotaryEmbedding):
         self.mscale_all_dim = mscale_all_dim
         super().__init__(dim, max_position_embeddings, base, device)
 
-    def _set_cos_sin_cache(self, seq_len, device, dtype):
-        self.max_seq_len_cached = seq_len
+    def _rotary_params(self):
+        return super()._rotary_params() + (
+            self.scaling_factor,
+            self.original_max_position_embeddings,
+            self.beta_fast,
+            self.beta_slow,
+            self.mscale,
+            self.mscale_all_dim,
+        )
+
+    def _compute_cos_sin(self, seq_len, device):
         dim = self.dim
 
         freq_extra = 1.0 / (
@@ -311,7 +363,6 @@ class DeepseekV2YarnRotaryEmbedding(DeepseekV2RotaryEmbedding):
             device=device, dtype=torch.float32
         )
         inv_freq = freq_inter * (1 - inv_freq_mask) + freq_extra * inv_freq_mask
-        self.register_buffer("inv_freq", inv_freq, persistent=False)
 
         t = torch.arange(seq_len, device=device, dtype=torch.float32)
 
@@ -323,12 +374,25 @@ class DeepseekV2YarnRotaryEmbedding(DeepseekV2RotaryEmbedding):
         )
 
         emb = torch.cat((freqs, freqs), dim=-1)
-        self.register_buffer(
-            "cos_cached", (emb.cos() * _mscale).to(dtype), persistent=False
-        )
-        self.register_buffer(
-            "sin_cached", (emb.sin() * _mscale).to(dtype), persistent=False
-        )
+        return emb.cos() * _mscale, emb.sin() * _mscale
+
+
+def precompute_rotary_tables(model: nn.Module, max_length: Optional[int] = None, dtype: Optional[torch.dtype] = None):
+    """
+    Build the shared cos/sin tables of every rotary embedding in `model` on the embedding's device, so no forward
+    pass has to. `max_length` defaults to each embedding's `max_position_embeddings`, `dtype` to the first floating
+    point parameter of `model` (the dtype the queries are in). Returns the number of distinct tables.
+    """
+    if dtype is None:
+        dtype = next(p.dtype for p in model.parameters() if p.is_floating_point())
+    tables = set()
+    for module in model.modules():
+        if isinstance(module, DeepseekV2RotaryEmbedding):
+            cos, _ = module._rotary_tables(
+                max_length or module.max_position_embeddings, module.inv_freq.device, dtype
+            )
+            tables.add(id(cos))
+    return len(tables)
 
 
 # Copied from transformers.models.llama.modeling_llama.rotate_half
@@ -400,6 +464,9 @@ class DeepseekV2MLP(nn.Module):
 
 
 class MoEGate(nn.Module):
+    # DeepseekV2RoutingProfiler recording this gate's routing, if attached
+    _routing_profiler = None
+
     def __init__(self, config):
         super().__init__()
         self.config = config
@@ -499,6 +566,9 @@ class MoEGate(nn.Module):
             )
             topk_weight = scores.gather(1, topk_idx)
 
+        if self._routing_profiler is not None:
+            self._routing_profiler.record_routing(self, scores, topk_idx)
+
         ### norm gate to sum 1
         if self.top_k > 1 and self.norm_topk_prob:
             denominator = topk_weight.sum(dim=-1, keepdim=True) + 1e-20
@@ -558,11 +628,32 @@ class AddAuxiliaryLoss(torch.autograd.Function):
         return grad_output, grad_loss
 
 
+# Largest padded/real token ratio at which the padded expert bmm beats the per-expert loop
+MOE_GROUPED_MAX_PADDING = 4.0
+
+# Most token-expert pairs a compiled layer computes by gathering each pair's
+# expert weights (decode steps); larger inputs run the eager forward
+MOE_GATHER_MAX_PAIRS = 32
+
+# Grouped GEMM kernel of newer torch releases (None on older ones)
+_grouped_mm = getattr(torch, "_grouped_mm", None)
+
+
 class DeepseekV2MoE(nn.Module):
     """
     A mixed expert module containing shared experts.
     """
 
+    # Inference defaults, also picked up by modules re-classed from the hub copy of this file
+    grouped_experts = True
+    _stacked_weights = None
+    _grouped_mm_failed = False
+    _compiled_decode = None
+    # DeepseekV2ExpertOffload serving the routed experts, if they are offloaded
+    _expert_offload = None
+    # DeepseekV2RoutingProfiler timing this layer's moe_infer, if attached
+    _routing_profiler = None
+
     def __init__(self, config):
         super().__init__()
         self.config = config
@@ -604,8 +695,34 @@ class DeepseekV2MoE(nn.Module):
             self.shared_experts = DeepseekV2MLP(
                 config=config, intermediate_size=intermediate_size
             )
+        # Run the experts as grouped GEMMs at inference instead of a Python loop
+        self.grouped_experts = getattr(config, "moe_grouped_gemm", True)
 
     def forward(self, hidden_states):
+        if (
+            self._compiled_decode is not None
+            and self._routing_profiler is None
+            and not self.training
+            and hidden_states.shape[:-1].numel() * self.num_experts_per_tok <= MOE_GATHER_MAX_PAIRS
+        ):
+            return self._compiled_decode(hidden_states)
+        return self._forward(hidden_states)
+
+    def compile_decode(self, **compile_kwargs):
+        """
+        Compile this layer for decode-sized inputs with `torch.compile`.
+
+        Decode steps take the on-device expert path (see `moe_infer_on_device`),
+        so the whole layer compiles to one graph. Larger inputs (prefill) keep
+        the eager forward. Returns False if the experts cannot use that path.
+        """
+        if self.ep_size > 1 or self.stack_expert_weights() is None:
+            return False
+        compile_kwargs.setdefault("dynamic", True)
+        self._compiled_decode = torch.compile(self._forward, **compile_kwargs)
+        return True
+
+    def _forward(self, hidden_states):
         identity = hidden_states
         orig_shape = hidden_states.shape
         topk_idx, topk_weight, aux_loss = self.gate(hidden_states)
@@ -622,13 +739,20 @@ class DeepseekV2MoE(nn.Module):
             y = y.to(hidden_states.dtype).view(*orig_shape)
             y = AddAuxiliaryLoss.apply(y, aux_loss)
         else:
-            y = self.moe_infer(hidden_states, topk_idx, topk_weight).view(*orig_shape)
+            profiler = self._routing_profiler
+            with profiler.timer(self) if profiler is not None else contextlib.nullcontext():
+                y = self.moe_infer(hidden_states, topk_idx, topk_weight).view(*orig_shape)
         if self.config.n_shared_experts is not None:
             y = y + self.shared_experts(identity)
         return y
 
     @torch.no_grad()
     def moe_infer(self, x, topk_ids, topk_weight):
+        if self.grouped_experts and self.ep_size == 1:
+            final_out = self.moe_infer_on_device(x, topk_ids, topk_weight)
+            if final_out is not None:
+                return final_out
+
         cnts = topk_ids.new_zeros((topk_ids.shape[0], len(self.experts)))
         cnts.scatter_(1, topk_ids, 1)
         tokens_per_expert = cnts.sum(dim=0)
@@ -669,19 +793,11 @@ class DeepseekV2MoE(nn.Module):
             tokens_per_expert = tokens_per_expert_post_gather
         tokens_per_expert = tokens_per_expert.cpu().numpy()
 
-        outputs = []
-        start_idx = 0
-        for i, num_tokens in enumerate(tokens_per_expert):
-            end_idx = start_idx + num_tokens
-            if num_tokens == 0:
-                continue
-            expert = self.experts[i + self.ep_rank * self.experts_per_rank]
-            tokens_for_this_expert = sorted_tokens[start_idx:end_idx]
-            expert_out = expert(tokens_for_this_expert)
-            outputs.append(expert_out)
-            start_idx = end_idx
-
-        outs = torch.cat(outputs, dim=0) if len(outputs) else sorted_tokens.new_empty(0)
+        outs = None
+        if self.grouped_experts and self.ep_size == 1:
+            outs = self.experts_grouped(sorted_tokens, tokens_per_expert)
+        if outs is None:
+            outs = self.experts_loop(sorted_tokens, tokens_per_expert)
         if self.ep_size > 1:
             new_x = torch.empty_like(outs)
             new_x[gatherd_idxs] = outs
@@ -703,6 +819,518 @@ class DeepseekV2MoE(nn.Module):
         )
         return final_out
 
+    def moe_infer_on_device(self, x, topk_ids, topk_weight):
+        """
+        Expert computation that never reads routing counts on the host.
+
+        Under `torch.compile`, up to MOE_GATHER_MAX_PAIRS token-expert pairs
+        (decode steps) gather their experts' stacked weights and run as two
+        bmm calls; eagerly that gather copies the weights and is slower than
+        syncing. Otherwise `torch._grouped_mm` with device-side offsets is
+        used when torch provides it. Shapes depend only on the token count,
+        so there is no device sync and the layer compiles without graph
+        breaks. Returns None when neither path applies, leaving the
+        host-count path of `moe_infer`.
+        """
+        stacked = self.stack_expert_weights()
+        if stacked is None:
+            return None
+        gate_up, down = stacked
+        act_fn = self.experts[0].act_fn
+
+        if topk_ids.numel() <= MOE_GATHER_MAX_PAIRS and torch.compiler.is_compiling():
+            flat_ids = topk_ids.view(-1)
+            pairs = x.unsqueeze(1).expand(-1, topk_ids.shape[1], -1).reshape(-1, 1, x.shape[-1])
+            gate, up = torch.bmm(pairs, gate_up[flat_ids].transpose(1, 2)).chunk(2, dim=-1)
+            outs = torch.bmm(act_fn(gate) * up, down[flat_ids].transpose(1, 2)).squeeze(1)
+        elif _grouped_mm is not None and not self._grouped_mm_failed:
+            cnts = topk_ids.new_zeros((topk_ids.shape[0], len(self.experts)))
+            cnts.scatter_(1, topk_ids, 1)
+            offsets = cnts.sum(dim=0).cumsum(dim=0).to(torch.int32)
+            idxs = topk_ids.view(-1).argsort()
+            sorted_tokens = x[idxs // topk_ids.shape[1]]
+            try:
+                gate, up = _grouped_mm(sorted_tokens, gate_up.transpose(1, 2), offs=offsets).chunk(2, dim=-1)
+                sorted_outs = _grouped_mm(act_fn(gate) * up, down.transpose(1, 2), offs=offsets)
+            except RuntimeError:
+                # Unsupported device/dtype/alignment for the grouped kernel
+                self._grouped_mm_failed = True
+                return None
+            outs = torch.empty_like(sorted_outs)
+            outs[idxs] = sorted_outs
+        else:
+            return None
+
+        return (
+            outs.view(*topk_ids.shape, -1)
+            .type(topk_weight.dtype)
+            .mul_(topk_weight.unsqueeze(dim=-1))
+            .sum(dim=1)
+            .type(outs.dtype)
+        )
+
+    def experts_loop(self, sorted_tokens, tokens_per_expert):
+        """Run each expert on its slice of expert-sorted tokens, one call per expert."""
+        outputs = []
+        start_idx = 0
+        for i, num_tokens in enumerate(tokens_per_expert):
+            end_idx = start_idx + num_tokens
+            if num_tokens == 0:
+                continue
+            if self._expert_offload is not None:
+                expert = self._expert_offload.fetch(self, i + self.ep_rank * self.experts_per_rank)
+            else:
+                expert = self.experts[i + self.ep_rank * self.experts_per_rank]
+            tokens_for_this_expert = sorted_tokens[start_idx:end_idx]
+            expert_out = expert(tokens_for_this_expert)
+            outputs.append(expert_out)
+            start_idx = end_idx
+
+        return torch.cat(outputs, dim=0) if len(outputs) else sorted_tokens.new_empty(0)
+
+    def _grouped_experts_supported(self):
+        """Grouped GEMM needs plain, local, resident, floating-point nn.Linear experts."""
+        if self._expert_offload is not None:
+            return False
+        for expert in self.experts:
+            if expert is None or hasattr(expert, "_hf_hook"):
+                return False
+            for proj in (expert.gate_proj, expert.up_proj, expert.down_proj):
+                if type(proj) is not nn.Linear or proj.bias is not None or hasattr(proj, "_hf_hook"):
+                    return False
+                if not proj.weight.is_floating_point() or proj.weight.is_meta:
+                    return False
+        weights = [expert.gate_proj.weight for expert in self.experts]
+        return len({(w.device, w.dtype) for w in weights}) == 1
+
+    def stack_expert_weights(self):
+        """
+        Expert weights stacked as gate_up (E, 2I, H) and down (E, H, I).
+
+        The stack is built once and each expert's parameters are re-pointed to
+        views of it, so no weight is stored twice. It is rebuilt if the
+        parameters were replaced since (e.g. by `.to()` or `load_state_dict`).
+        Returns None when the experts cannot be stacked.
+        """
+        if self._stacked_weights is not None and torch.compiler.is_compiling():
+            # Built before compiling; data_ptr() checks would break the graph
+            return self._stacked_weights
+        first = self.experts[0]
+        if self._stacked_weights is not None:
+            gate_up, down = self._stacked_weights
+            if (
+                type(first.gate_proj) is nn.Linear
+                and type(first.down_proj) is nn.Linear
+                and first.gate_proj.weight.data_ptr() == gate_up[0].data_ptr()
+                and first.down_proj.weight.data_ptr() == down[0].data_ptr()
+            ):
+                return self._stacked_weights
+            self._stacked_weights = None
+
+        if not self._grouped_experts_supported():
+            return None
+
+        intermediate_size = first.intermediate_size
+        gate_up = torch.stack(
+            [torch.cat([e.gate_proj.weight.data, e.up_proj.weight.data], dim=0) for e in self.experts]
+        )
+        down = torch.stack([e.down_proj.weight.data for e in self.experts])
+        for i, expert in enumerate(self.experts):
+            expert.gate_proj.weight.data = gate_up[i, :intermediate_size]
+            expert.up_proj.weight.data = gate_up[i, intermediate_size:]
+            expert.down_proj.weight.data = down[i]
+        self._stacked_weights = (gate_up, down)
+        return self._stacked_weights
+
+    def experts_grouped(self, sorted_tokens, tokens_per_expert):
+        """
+        Run all experts as one padded bmm per projection.
+
+        Same contract as `experts_loop`: tokens are sorted by expert and the
+        outputs come back in the same order. Tokens are padded to
+        (n_experts, max_tokens, hidden) and run through `bmm` against the
+        stacked weights. Used for inputs `moe_infer_on_device` does not take
+        (torch without `_grouped_mm`). Returns None when the loop should be
+        used instead: unsupported expert weights, or padding that would cost
+        more than the loop.
+        """
+        stacked = self.stack_expert_weights()
+        if stacked is None:
+            return None
+        gate_up, down = stacked
+        act_fn = self.experts[0].act_fn
+
+        counts = np.asarray(tokens_per_expert, dtype=np.int64)
+        total = int(counts.sum())
+        if total == 0:
+            return sorted_tokens.new_empty(0)
+        device = sorted_tokens.device
+
+        max_tokens = int(counts.max())
+        if len(counts) * max_tokens > MOE_GROUPED_MAX_PADDING * total:
+            return None
+
+        # Batch row (expert) and position of every sorted token
+        slots = np.repeat(np.arange(len(counts)), counts)
+        positions = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        slots = torch.from_numpy(slots).to(device)
+        positions = torch.from_numpy(positions).to(device)
+
+        padded = sorted_tokens.new_zeros(len(counts), max_tokens, sorted_tokens.shape[-1])
+        padded[slots, positions] = sorted_tokens
+        gate, up = torch.bmm(padded, gate_up.transpose(1, 2)).chunk(2, dim=-1)
+        outs = torch.bmm(act_fn(gate) * up, down.transpose(1, 2))
+        return outs[slots, positions]
+
+
+# Safetensors dtype codes of the tensors SafetensorsMmap can map
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+_EXPERT_PROJECTIONS = ("gate_proj", "up_proj", "down_proj")
+
+
+class SafetensorsMmap:
+    """
+    Read-only `mmap` of one safetensors file.
+
+    `tensor` returns zero-copy tensors over the mapping, so their pages are read from disk the first time they are
+    touched. `release` drops a tensor's pages from the process' resident set (they stay in the page cache and are read
+    back on the next access). Tensors must not be written to.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            header_len = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(header_len))
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header.pop("__metadata__", None)
+        self._entries = header
+        self._data_start = 8 + header_len
+
+    def keys(self):
+        return self._entries.keys()
+
+    def _span(self, name: str):
+        start, end = self._entries[name]["data_offsets"]
+        return self._data_start + start, end - start
+
+    def tensor(self, name: str) -> torch.Tensor:
+        entry = self._entries[name]
+        offset, nbytes = self._span(name)
+        dtype = _SAFETENSORS_DTYPES[entry["dtype"]]
+        count = nbytes // torch.empty((), dtype=dtype).element_size()
+        with warnings.catch_warnings():
+            # The mapping is read-only and the tensors are only ever read
+            warnings.filterwarnings("ignore", message="The given buffer is not writable")
+            tensor = torch.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset)
+        return tensor.view(entry["shape"])
+
+    def release(self, name: str):
+        if not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        offset, nbytes = self._span(name)
+        start = offset - offset % mmap.PAGESIZE
+        self._mmap.madvise(mmap.MADV_DONTNEED, start, offset + nbytes - start)
+
+
+class DeepseekV2ExpertOffload:
+    """
+    Routed expert weights served from memory-mapped safetensors files, at most `max_resident_experts` of them
+    materialized at a time.
+
+    `attach` drops the routed expert weights of a model's DeepseekV2MoE layers. The first time the router sends tokens
+    to an expert, `fetch` maps its gate/up/down weights from the checkpoint: zero-copy when the checkpoint already has
+    the execution device and dtype (bf16 on CPU), a copy otherwise. Experts are kept in least-recently-used order and
+    going over budget releases the coldest one. `stats` reports hits, misses, evictions and resident expert bytes.
+
+    `weight_files` maps parameter names, as in the model's state dict, to the safetensors file holding them. Offloaded
+    layers run the per-expert loop of `moe_infer` and are for inference only.
+    """
+
+    def __init__(self, weight_files: Dict[str, str], max_resident_experts: int):
+        self.weight_files = weight_files
+        self.max_resident_experts = max(1, int(max_resident_experts))
+        self._files = {}
+        # MoE layer -> (module name, device, dtype) of its experts
+        self._layers = {}
+        # (MoE layer, expert index) -> weight bytes, least recently used first
+        self._resident = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resident_bytes = 0
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_dir: str, max_resident_experts: int):
+        """Store over the safetensors files of `checkpoint_dir` (sharded with an index, or not)."""
+        store = cls({}, max_resident_experts)
+        index_file = os.path.join(checkpoint_dir, "model.safetensors.index.json")
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                weight_map = json.load(f)["weight_map"]
+            store.weight_files = {name: os.path.join(checkpoint_dir, file) for name, file in weight_map.items()}
+        else:
+            for file in sorted(os.listdir(checkpoint_dir)):
+                if file.endswith(".safetensors"):
+                    path = os.path.join(checkpoint_dir, file)
+                    store.weight_files.update(dict.fromkeys(store._file(path).keys(), path))
+        return store
+
+    def _file(self, path: str) -> SafetensorsMmap:
+        if path not in self._files:
+            self._files[path] = SafetensorsMmap(path)
+        return self._files[path]
+
+    def attach(self, model: nn.Module, device: Optional[torch.device] = None, dtype: Optional[torch.dtype] = None):
+        """
+        Offload the routed experts of every DeepseekV2MoE layer of `model` whose weights are all in `weight_files`.
+
+        Weights already loaded are dropped and accelerate offload hooks on the experts are removed. Experts are fetched
+        to `device` in `dtype`, by default those of the layer's router weight. Returns the number of experts offloaded.
+        """
+        offloaded = 0
+        for name, module in model.named_modules():
+            if not isinstance(module, DeepseekV2MoE) or module in self._layers:
+                continue
+            experts = [expert for expert in module.experts if expert is not None]
+            names = [
+                f"{name}.experts.{i}.{proj}.weight"
+                for i, expert in enumerate(module.experts)
+                if expert is not None
+                for proj in _EXPERT_PROJECTIONS
+            ]
+            if any(n not in self.weight_files for n in names) or any(
+                type(getattr(expert, proj)) is not nn.Linear for expert in experts for proj in _EXPERT_PROJECTIONS
+            ):
+                continue
+
+            for expert in experts:
+                if hasattr(expert, "_hf_hook"):
+                    from accelerate.hooks import remove_hook_from_module
+
+                    remove_hook_from_module(expert, recurse=True)
+                for proj in _EXPERT_PROJECTIONS:
+                    linear = getattr(expert, proj)
+                    linear.weight = nn.Parameter(linear.weight.to("meta"), requires_grad=False)
+            module._stacked_weights = None
+            module._compiled_decode = None
+            module._expert_offload = self
+            self._layers[module] = (
+                name,
+                torch.device(device) if device is not None else module.gate.weight.device,
+                dtype if dtype is not None else module.gate.weight.dtype,
+            )
+            offloaded += len(experts)
+        return offloaded
+
+    def fetch(self, moe: nn.Module, index: int) -> nn.Module:
+        """Expert `index` of `moe` with its weights materialized, marked most recently used."""
+        expert = moe.experts[index]
+        key = (moe, index)
+        if key in self._resident:
+            self._resident.move_to_end(key)
+            self.hits += 1
+            return expert
+
+        self.misses += 1
+        prefix, device, dtype = self._layers[moe]
+        nbytes = 0
+        for proj in _EXPERT_PROJECTIONS:
+            name = f"{prefix}.experts.{index}.{proj}.weight"
+            mapped = self._file(self.weight_files[name])
+            weight = mapped.tensor(name)
+            if weight.device != device or weight.dtype != dtype:
+                weight = weight.to(device=device, dtype=dtype)
+                mapped.release(name)
+            getattr(expert, proj).weight = nn.Parameter(weight, requires_grad=False)
+            nbytes += weight.numel() * weight.element_size()
+        self._resident[key] = nbytes
+        self.resident_bytes += nbytes
+
+        while len(self._resident) > self.max_resident_experts:
+            self._evict(*self._resident.popitem(last=False))
+        return expert
+
+    def _evict(self, key, nbytes: int):
+        moe, index = key
+        prefix = self._layers[moe][0]
+        expert = moe.experts[index]
+        for proj in _EXPERT_PROJECTIONS:
+            linear = getattr(expert, proj)
+            linear.weight = nn.Parameter(linear.weight.to("meta"), requires_grad=False)
+            name = f"{prefix}.experts.{index}.{proj}.weight"
+            self._file(self.weight_files[name]).release(name)
+        self.resident_bytes -= nbytes
+        self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "resident_experts": len(self._resident),
+            "resident_bytes": self.resident_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class DeepseekV2RoutingProfiler:
+    """
+    Opt-in record of how a model's MoE layers route tokens and where decoder time goes.
+
+    `attach` instruments every DeepseekV2MoE layer of a model, including its MoEGate, and hooks the attention module
+    of every decoder layer. `detach` removes it all again. For each MoE layer the profiler keeps:
+    - the tokens routed to each expert;
+    - the mean entropy of the gate's per-token score distribution, in nats (log(n_routed_experts) means uniform
+      routing);
+    - the entropy of the resulting expert load;
+    - the time spent in `moe_infer`.
+    Attention time is recorded per decoder layer. Counts stay on the device until read. Each timed call synchronizes
+    the device, which slows the model slightly. Compiled decode layers run eagerly while the profiler is attached.
+
+    `summary` returns everything as a dict. `to_json` writes that dict, `to_csv` one row per (layer, expert).
+    """
+
+    def __init__(self):
+        # Instrumented module -> name of its MoE layer (gates and MoE layers) or its attention module
+        self._names = {}
+        self._hooks = []
+        # Attention module -> start of its running forward
+        self._started = {}
+        self.reset()
+
+    def reset(self):
+        """Drop everything recorded so far (instrumentation stays attached)."""
+        self.tokens_per_expert = {}
+        self.tokens = {}
+        self._entropy_sums = {}
+        self.moe_infer_seconds = {}
+        self.attention_seconds = {}
+
+    def attach(self, model: nn.Module):
+        """Instrument `model`. Returns the number of MoE layers profiled."""
+        layers = 0
+        for name, module in model.named_modules():
+            if isinstance(module, DeepseekV2MoE):
+                module._routing_profiler = self
+                module.gate._routing_profiler = self
+                self._names[module] = name
+                self._names[module.gate] = name
+                layers += 1
+            # Also matches the hub copy of the decoder layer class
+            elif type(module).__name__ == "DeepseekV2DecoderLayer":
+                attention = module.self_attn
+                self._names[attention] = f"{name}.self_attn"
+                self._hooks.append(attention.register_forward_pre_hook(self._attention_started))
+                self._hooks.append(attention.register_forward_hook(self._attention_finished))
+        return layers
+
+    def detach(self):
+        for module in self._names:
+            module.__dict__.pop("_routing_profiler", None)
+        for hook in self._hooks:
+            hook.remove()
+        self._names = {}
+        self._hooks = []
+        self._started = {}
+
+    @staticmethod
+    def _synchronize(device: torch.device):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    def record_routing(self, gate: nn.Module, scores: torch.Tensor, topk_idx: torch.Tensor):
+        """Count the experts chosen for each token and the entropy of its scores (called by MoEGate)."""
+        name = self._names[gate]
+        counts = torch.bincount(topk_idx.reshape(-1), minlength=gate.n_routed_experts)
+        probs = scores / scores.sum(dim=-1, keepdim=True).clamp_min(1e-20)
+        entropy = -(probs * probs.clamp_min(1e-20).log()).sum()
+        if name in self.tokens_per_expert:
+            self.tokens_per_expert[name] += counts
+            self._entropy_sums[name] += entropy
+        else:
+            self.tokens_per_expert[name] = counts
+            self._entropy_sums[name] = entropy
+        self.tokens[name] = self.tokens.get(name, 0) + topk_idx.shape[0]
+
+    @contextlib.contextmanager
+    def timer(self, moe: nn.Module):
+        """Time the body as `moe_infer` of `moe` (used by DeepseekV2MoE)."""
+        device = moe.gate.weight.device
+        self._synchronize(device)
+        start = time.perf_counter()
+        yield
+        self._synchronize(device)
+        name = self._names[moe]
+        self.moe_infer_seconds[name] = self.moe_infer_seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def _attention_started(self, module, args):
+        device = next(module.parameters()).device
+        self._synchronize(device)
+        self._started[module] = (device, time.perf_counter())
+
+    def _attention_finished(self, module, args, output):
+        device, start = self._started.pop(module)
+        self._synchronize(device)
+        name = self._names[module]
+        self.attention_seconds[name] = self.attention_seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def summary(self):
+        """
+        Recorded data: per MoE layer its token count, tokens per expert, mean routing entropy, load entropy, uniform
+        entropy and `moe_infer` seconds; per attention layer its seconds; and the totals of both timings.
+        """
+        layers = []
+        for name, counts in self.tokens_per_expert.items():
+            counts = counts.float().cpu()
+            load = counts / counts.sum().clamp_min(1)
+            layers.append(
+                {
+                    "layer": name,
+                    "tokens": self.tokens[name],
+                    "tokens_per_expert": counts.long().tolist(),
+                    "routing_entropy": self._entropy_sums[name].item() / max(self.tokens[name], 1),
+                    "load_entropy": -(load * load.clamp_min(1e-20).log()).sum().item(),
+                    "uniform_entropy": math.log(len(counts)),
+                    "moe_infer_seconds": self.moe_infer_seconds.get(name, 0.0),
+                }
+            )
+        return {
+            "moe_layers": layers,
+            "attention_seconds": dict(self.attention_seconds),
+            "total_moe_infer_seconds": sum(self.moe_infer_seconds.values()),
+            "total_attention_seconds": sum(self.attention_seconds.values()),
+        }
+
+    def to_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def to_csv(self, path: str):
+        columns = ["layer", "expert", "tokens", "share", "layer_tokens", "routing_entropy", "load_entropy",
+                   "moe_infer_seconds"]
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            for layer in self.summary()["moe_layers"]:
+                routed = max(sum(layer["tokens_per_expert"]), 1)
+                for expert, tokens in enumerate(layer["tokens_per_expert"]):
+                    writer.writerow([layer["layer"], expert, tokens, tokens / routed, layer["tokens"],
+                                     layer["routing_entropy"], layer["load_entropy"], layer["moe_infer_seconds"]])
+
 
 # Copied from transformers.models.llama.modeling_llama.repeat_kv
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
@@ -849,6 +1477,53 @@ class DeepseekV2Attention(nn.Module):
             .contiguous()
         )
 
+    def _absorbed_decode_attention(self, q_nope, q_pe, compressed_kv, k_pe, attention_mask=None, dropout_p=0.0):
+        """
+        Single-token attention computed in the compressed latent space.
+
+        The nope part of the query is absorbed into `kv_b_proj`, so every head attends over the cached
+        [compressed_kv, k_pe] rows directly and the heads run as the query positions of one shared key/value
+        head. `attention_mask` is None or broadcastable to (bsz, 1, 1, kv_seq_len) (additive or boolean).
+        Returns (bsz, num_heads, 1, v_head_dim).
+        """
+        kv_b_proj = self.kv_b_proj.weight.view(self.num_heads, -1, self.kv_lora_rank)
+        q_absorb = kv_b_proj[:, :self.qk_nope_head_dim, :]
+        out_absorb = kv_b_proj[:, self.qk_nope_head_dim:, :]
+
+        query_states = torch.cat([torch.matmul(q_nope, q_absorb), q_pe], dim=-1).transpose(1, 2)
+        key_states = torch.cat([compressed_kv, k_pe.squeeze(1)], dim=-1).unsqueeze(1)
+        value_states = compressed_kv.unsqueeze(1)
+        attn_output = F.scaled_dot_product_attention(
+            query_states,
+            key_states.to(query_states.dtype),
+            value_states.to(query_states.dtype),
+            attn_mask=attention_mask,
+            dropout_p=dropout_p,
+            scale=self.softmax_scale,
+        )
+        return torch.matmul(attn_output.transpose(1, 2), out_absorb.mT)
+
+    def _expand_compressed_kv(self, compressed_kv, k_pe):
+        """
+        Per-head keys and values from the cached compressed kv and rope key.
+
+        Returns key_states (bsz, num_heads, kv_seq_len, q_head_dim) and
+        value_states (bsz, num_heads, kv_seq_len, v_head_dim).
+        """
+        bsz, kv_seq_len, _ = compressed_kv.shape
+        kv = (
+            self.kv_b_proj(compressed_kv)
+            .view(bsz, kv_seq_len, self.num_heads, self.qk_nope_head_dim + self.v_head_dim)
+            .transpose(1, 2)
+        )
+        k_nope, value_states = torch.split(
+            kv, [self.qk_nope_head_dim, self.v_head_dim], dim=-1
+        )
+        key_states = torch.cat(
+            [k_nope, k_pe.expand(bsz, self.num_heads, kv_seq_len, self.qk_rope_head_dim)], dim=-1
+        )
+        return key_states, value_states
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -884,7 +1559,11 @@ class DeepseekV2Attention(nn.Module):
         k_pe = k_pe.view(bsz, q_len, 1, self.qk_rope_head_dim).transpose(1, 2)
 
         kv_seq_len = k_pe.shape[-2]
-        if past_key_value is not None:
+        static_cache = getattr(past_key_value, "is_static", False)
+        if static_cache:
+            # Attend over every preallocated slot; the ones not written yet are masked
+            kv_seq_len = past_key_value.get_max_length()
+        elif past_key_value is not None:
             if self.layer_idx is None:
                 raise ValueError(
                     f"The cache structure has changed since version v4.36. If you are using {self.__class__.__name__} "
@@ -897,11 +1576,14 @@ class DeepseekV2Attention(nn.Module):
         q_pe, k_pe = apply_rotary_pos_emb(q_pe, k_pe, cos, sin, position_ids)
 
         if past_key_value is not None:
-            cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
+            cache_kwargs = {"sin": sin, "cos": cos, "cache_position": kwargs.get("cache_position")}  # Specific to RoPE models
             compressed_kv = compressed_kv.unsqueeze(1)
             k_pe, compressed_kv = past_key_value.update(k_pe, compressed_kv, self.layer_idx, cache_kwargs)
             compressed_kv = compressed_kv.squeeze(1)
 
+        if static_cache:
+            attention_mask = past_key_value.static_attention_mask(attention_mask, q_pe.dtype)
+
         kv_b_proj = self.kv_b_proj.weight.view(self.num_heads, -1, self.kv_lora_rank)
         q_absorb = kv_b_proj[:, :self.qk_nope_head_dim, :]
         out_absorb = kv_b_proj[:, self.qk_nope_head_dim:, :]
@@ -999,50 +1681,58 @@ class DeepseekV2FlashAttention2(DeepseekV2Attention):
             q, [self.qk_nope_head_dim, self.qk_rope_head_dim], dim=-1
         )
 
-        # Flash attention requires the input to have the shape
-        # batch_size x seq_length x head_dim x hidden_dim
-        # therefore we just need to keep the original shape
         compressed_kv = self.kv_a_proj_with_mqa(hidden_states)
         compressed_kv, k_pe = torch.split(
             compressed_kv, [self.kv_lora_rank, self.qk_rope_head_dim], dim=-1
         )
+        compressed_kv = self.kv_a_layernorm(compressed_kv)
         k_pe = k_pe.view(bsz, q_len, 1, self.qk_rope_head_dim).transpose(1, 2)
-        kv = (
-            self.kv_b_proj(self.kv_a_layernorm(compressed_kv))
-            .view(bsz, q_len, self.num_heads, self.qk_nope_head_dim + self.v_head_dim)
-            .transpose(1, 2)
-        )
 
-        k_nope, value_states = torch.split(
-            kv, [self.qk_nope_head_dim, self.v_head_dim], dim=-1
-        )
-        kv_seq_len = value_states.shape[-2]
-
-        kv_seq_len = value_states.shape[-2]
-        if past_key_value is not None:
+        kv_seq_len = k_pe.shape[-2]
+        static_cache = getattr(past_key_value, "is_static", False)
+        if static_cache:
+            # Attend over every preallocated slot; the ones not written yet are masked
+            kv_seq_len = past_key_value.get_max_length()
+        elif past_key_value is not None:
             kv_seq_len += past_key_value.get_usable_length(kv_seq_len, self.layer_idx)
 
-        cos, sin = self.rotary_emb(value_states, seq_len=kv_seq_len)
+        cos, sin = self.rotary_emb(q_pe, seq_len=kv_seq_len)
         q_pe, k_pe = apply_rotary_pos_emb(q_pe, k_pe, cos, sin, position_ids)
 
-        query_states = k_pe.new_empty(bsz, self.num_heads, q_len, self.q_head_dim)
-        query_states[:, :, :, : self.qk_nope_head_dim] = q_nope
-        query_states[:, :, :, self.qk_nope_head_dim :] = q_pe
+        # The cache holds the compressed latent (kv_lora_rank + rope dims per token), as in DeepseekV2Attention
+        if past_key_value is not None:
+            cache_kwargs = {"sin": sin, "cos": cos, "cache_position": kwargs.get("cache_position")}  # Specific to RoPE models
+            compressed_kv = compressed_kv.unsqueeze(1)
+            k_pe, compressed_kv = past_key_value.update(k_pe, compressed_kv, self.layer_idx, cache_kwargs)
+            compressed_kv = compressed_kv.squeeze(1)
+
+        if q_len == 1:
+            # Decode: absorb kv_b_proj into the query instead of expanding the whole cache.
+            # The latent head dim (kv_lora_rank + rope) is beyond flash-attn, so this runs on SDPA.
+            if static_cache:
+                padding_mask = past_key_value.static_attention_mask(attention_mask, q_pe.dtype)
+            else:
+                padding_mask = None if attention_mask is None else attention_mask[:, None, None, :].bool()
+            attn_output = self._absorbed_decode_attention(
+                q_nope, q_pe, compressed_kv, k_pe, padding_mask,
+                self.attention_dropout if self.training else 0.0,
+            )
+            attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.num_heads * self.v_head_dim)
+            return self.o_proj(attn_output), None, past_key_value
+
+        if static_cache:
+            # The flash kernel only needs the slots written so far
+            kv_len = past_key_value.get_seq_length(self.layer_idx)
+            compressed_kv = compressed_kv[:, :kv_len]
+            k_pe = k_pe[:, :, :kv_len]
 
-        key_states = k_pe.new_empty(bsz, self.num_heads, q_len, self.q_head_dim)
-        key_states[:, :, :, : self.qk_nope_head_dim] = k_nope
-        key_states[:, :, :, self.qk_nope_head_dim :] = k_pe
+        # Prefill: expand the latent into per-head keys/values for the flash kernel
+        key_states, value_states = self._expand_compressed_kv(compressed_kv, k_pe)
+        query_states = torch.cat([q_nope, q_pe], dim=-1)
 
         if self.q_head_dim != self.v_head_dim:
             value_states = F.pad(value_states, [0, self.q_head_dim - self.v_head_dim])
 
-        # TODO: support compressed_kv for kv_cache (instead of key_states, value_states) in flash_attention version
-        if past_key_value is not None:
-            cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
-            key_states, value_states = past_key_value.update(
-                key_states, value_states, self.layer_idx, cache_kwargs
-            )
-
         # TODO: These transpose are quite inefficient but Flash Attention requires the layout [batch_size, sequence_length, num_heads, head_dim]. We would need to refactor the KV cache
         # to be able to avoid many of these transpose/reshape/view.
         query_states = query_states.transpose(1, 2)
@@ -1229,18 +1919,482 @@ class DeepseekV2FlashAttention2(DeepseekV2Attention):
         )
 
 
+class DeepseekV2SdpaAttention(DeepseekV2Attention):
+    """
+    DeepseekV2 attention using `torch.nn.functional.scaled_dot_product_attention`. The weights and the KV cache
+    layout (rope key + normalized compressed kv, as in `DeepseekV2Attention`) are unchanged; only the attention
+    computation runs through the fused kernel, so the attention-weights tensor is never materialized.
+
+    Decode steps (q_len == 1) stay in the compressed space: the nope part of the query is absorbed into
+    `kv_b_proj` and the heads attend as one multi-query sequence over [compressed_kv, k_pe]. Prefill expands the
+    compressed kv into per-head keys/values instead, which is cheaper for long queries.
+    """
+
+    def forward(
+        self,
+        hidden_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor] = None,
+        position_ids: Optional[torch.LongTensor] = None,
+        past_key_value: Optional[Cache] = None,
+        output_attentions: bool = False,
+        use_cache: bool = False,
+        **kwargs,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
+        if output_attentions:
+            # SDPA cannot return the attention weights
+            logger.warning_once(
+                "DeepseekV2SdpaAttention does not support `output_attentions=True`, falling back to the eager "
+                "attention implementation."
+            )
+            return super().forward(
+                hidden_states,
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_value=past_key_value,
+                output_attentions=output_attentions,
+                use_cache=use_cache,
+                **kwargs,
+            )
+
+        bsz, q_len, _ = hidden_states.size()
+
+        if self.q_lora_rank is None:
+            q = self.q_proj(hidden_states)
+        else:
+            q = self.q_b_proj(self.q_a_layernorm(self.q_a_proj(hidden_states)))
+        q = q.view(bsz, q_len, self.num_heads, self.q_head_dim).transpose(1, 2)
+        q_nope, q_pe = torch.split(
+            q, [self.qk_nope_head_dim, self.qk_rope_head_dim], dim=-1
+        )
+
+        compressed_kv = self.kv_a_proj_with_mqa(hidden_states)
+        compressed_kv, k_pe = torch.split(
+            compressed_kv, [self.kv_lora_rank, self.qk_rope_head_dim], dim=-1
+        )
+        compressed_kv = self.kv_a_layernorm(compressed_kv)
+        k_pe = k_pe.view(bsz, q_len, 1, self.qk_rope_head_dim).transpose(1, 2)
+
+        kv_seq_len = k_pe.shape[-2]
+        static_cache = getattr(past_key_value, "is_static", False)
+        if static_cache:
+            # Attend over every preallocated slot; the ones not written yet are masked
+            kv_seq_len = past_key_value.get_max_length()
+        elif past_key_value is not None:
+            if self.layer_idx is None:
+                raise ValueError(
+                    f"The cache structure has changed since version v4.36. If you are using {self.__class__.__name__} "
+                    "for auto-regressive decoding with k/v caching, please make sure to initialize the attention class "
+                    "with a layer index."
+                )
+            kv_seq_len += past_key_value.get_usable_length(kv_seq_len, self.layer_idx)
+
+        cos, sin = self.rotary_emb(q_pe, seq_len=kv_seq_len)
+        q_pe, k_pe = apply_rotary_pos_emb(q_pe, k_pe, cos, sin, position_ids)
+
+        if past_key_value is not None:
+            cache_kwargs = {"sin": sin, "cos": cos, "cache_position": kwargs.get("cache_position")}  # Specific to RoPE models
+            compressed_kv = compressed_kv.unsqueeze(1)
+            k_pe, compressed_kv = past_key_value.update(k_pe, compressed_kv, self.layer_idx, cache_kwargs)
+            compressed_kv = compressed_kv.squeeze(1)
+
+        if static_cache:
+            attention_mask = past_key_value.static_attention_mask(attention_mask, q_pe.dtype)
+
+        if attention_mask is not None and attention_mask.size() != (bsz, 1, q_len, kv_seq_len):
+            raise ValueError(
+                f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
+            )
+        dropout_p = self.attention_dropout if self.training else 0.0
+
+        if q_len == 1:
+            attn_output = self._absorbed_decode_attention(
+                q_nope, q_pe, compressed_kv, k_pe, attention_mask, dropout_p
+            )
+        else:
+            key_states, value_states = self._expand_compressed_kv(compressed_kv, k_pe)
+            query_states = torch.cat([q_nope, q_pe], dim=-1)
+            # The fused kernels want a common head dim for q/k and v
+            if self.q_head_dim != self.v_head_dim:
+                value_states = F.pad(value_states, [0, self.q_head_dim - self.v_head_dim])
+
+            # is_causal is top-left aligned, so it only matches when there is no cached prefix
+            is_causal = attention_mask is None and q_len == kv_seq_len
+            if attention_mask is None and not is_causal:
+                attention_mask = torch.ones(
+                    q_len, kv_seq_len, dtype=torch.bool, device=query_states.device
+                ).tril(diagonal=kv_seq_len - q_len)
+            attn_output = F.scaled_dot_product_attention(
+                query_states,
+                key_states,
+                value_states.to(query_states.dtype),
+                attn_mask=attention_mask,
+                dropout_p=dropout_p,
+                is_causal=is_causal,
+                scale=self.softmax_scale,
+            )
+            attn_output = attn_output[..., :self.v_head_dim]
+
+        if attn_output.size() != (bsz, self.num_heads, q_len, self.v_head_dim):
+            raise ValueError(
+                f"`attn_output` should be of size {(bsz, self.num_heads, q_len, self.v_head_dim)}, but is"
+                f" {attn_output.size()}"
+            )
+
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.num_heads * self.v_head_dim)
+        attn_output = self.o_proj(attn_output)
+
+        return attn_output, None, past_key_value
+
+
 ATTENTION_CLASSES = {
     "eager": DeepseekV2Attention,
     "flash_attention_2": DeepseekV2FlashAttention2,
+    "sdpa": DeepseekV2SdpaAttention,
 
     "mla_eager": DeepseekV2Attention,
     "mla_flash_attention_2": DeepseekV2FlashAttention2,
+    "mla_sdpa": DeepseekV2SdpaAttention,
 
     "mha_eager": LlamaAttention,
-    "mha_flash_attention_2": LlamaFlashAttention2
+    "mha_flash_attention_2": LlamaFlashAttention2,
+    "mha_sdpa": LlamaSdpaAttention,
 }
 
 
+def kv_cache_bytes_per_token(model: nn.Module, dtype: Optional[torch.dtype] = None):
+    """
+    KV cache memory one token adds, summed over the attention layers of `model`.
+
+    MLA layers cache the compressed latent (kv_lora_rank + qk_rope_head_dim values per token); multi-head layers
+    cache full per-head keys and values. `expanded_bytes_per_token` is what per-head caching of the same layers
+    would take. `dtype` defaults to the model's parameter dtype.
+    """
+    if dtype is None:
+        dtype = next(model.parameters()).dtype
+    itemsize = torch.empty((), dtype=dtype).element_size()
+
+    cached = expanded = layers = 0
+    for module in model.modules():
+        if hasattr(module, "kv_lora_rank") and hasattr(module, "q_head_dim"):
+            cached += module.kv_lora_rank + module.qk_rope_head_dim
+            expanded += module.num_heads * (module.q_head_dim + module.v_head_dim)
+        elif hasattr(module, "num_key_value_heads") and hasattr(module, "head_dim"):
+            cached += 2 * module.num_key_value_heads * module.head_dim
+            expanded += 2 * module.num_key_value_heads * module.head_dim
+        else:
+            continue
+        layers += 1
+
+    return {
+        "layers": layers,
+        "bytes_per_token": cached * itemsize,
+        "expanded_bytes_per_token": expanded * itemsize,
+    }
+
+
+class DeepseekV2StaticCache(Cache):
+    """
+    KV cache preallocated for `max_cache_len` tokens, so decoding never grows or reallocates a tensor.
+
+    Each attention layer gets a fixed (key, value) buffer pair in the layout it caches: MLA layers hold the rope key
+    (bsz, 1, max_cache_len, qk_rope_head_dim) and the compressed kv (bsz, 1, max_cache_len, kv_lora_rank), multi-head
+    layers hold per-head keys and values (bsz, num_key_value_heads, max_cache_len, head_dim). `update` writes the new
+    entries in place at `cache_position` and returns the whole buffers; attention runs over all `max_cache_len` slots
+    with `static_attention_mask` hiding the ones not written yet. Shapes therefore stay the same at every decode step.
+
+    Buffers are allocated on the device of each attention layer. `dtype` defaults to the first floating point
+    parameter of `model`.
+    """
+
+    is_static = True
+
+    def __init__(
+        self,
+        model: nn.Module,
+        batch_size: int,
+        max_cache_len: int,
+        dtype: Optional[torch.dtype] = None,
+    ):
+        super().__init__()
+        if dtype is None:
+            dtype = next(p.dtype for p in model.parameters() if p.is_floating_point())
+        self.batch_size = batch_size
+        self.max_cache_len = max_cache_len
+        self.dtype = dtype
+
+        shapes = {}
+        for module in model.modules():
+            layer_idx = getattr(module, "layer_idx", None)
+            if layer_idx is None:
+                continue
+            if hasattr(module, "kv_lora_rank") and hasattr(module, "q_head_dim"):
+                key_shape = (batch_size, 1, max_cache_len, module.qk_rope_head_dim)
+                value_shape = (batch_size, 1, max_cache_len, module.kv_lora_rank)
+            elif hasattr(module, "num_key_value_heads") and hasattr(module, "head_dim"):
+                key_shape = value_shape = (batch_size, module.num_key_value_heads, max_cache_len, module.head_dim)
+            else:
+                continue
+            device = next(module.parameters()).device
+            shapes[layer_idx] = (key_shape, value_shape, device)
+        if not shapes:
+            raise ValueError(f"{type(model).__name__} has no attention layers to preallocate a cache for")
+
+        self.key_cache: List[torch.Tensor] = []
+        self.value_cache: List[torch.Tensor] = []
+        for layer_idx in range(max(shapes) + 1):
+            key_shape, value_shape, device = shapes[layer_idx]
+            key = torch.zeros(key_shape, dtype=dtype, device=device)
+            value = torch.zeros(value_shape, dtype=dtype, device=device)
+            if not torch.compiler.is_compiling():
+                # Fixed data pointers let CUDA graphs capture the in-place updates
+                torch._dynamo.mark_static_address(key)
+                torch._dynamo.mark_static_address(value)
+            self.key_cache.append(key)
+            self.value_cache.append(value)
+
+        # Tokens written per layer, counted on the host
+        self._seq_lengths: List[int] = [0] * len(self.key_cache)
+        # Slots written by the latest update
+        self._write_position = None
+
+    def __len__(self):
+        return len(self.key_cache)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Writes `key_states`/`value_states` into the slots given by `cache_kwargs["cache_position"]` and returns the
+        full preallocated buffers of `layer_idx`. Without a cache_position the next free slots are used. The new
+        entries are expected to follow the ones already written, which is what generation does.
+        """
+        key_cache = self.key_cache[layer_idx]
+        value_cache = self.value_cache[layer_idx]
+        q_len = key_states.shape[-2]
+        start = self._seq_lengths[layer_idx]
+        if start + q_len > self.max_cache_len:
+            raise ValueError(
+                f"DeepseekV2StaticCache holds {self.max_cache_len} tokens, cannot add {q_len} to {start}"
+            )
+        cache_position = (cache_kwargs or {}).get("cache_position")
+        if cache_position is None:
+            cache_position = torch.arange(start, start + q_len, device=key_cache.device)
+        self._write_position = cache_position
+        self._seq_lengths[layer_idx] = start + q_len
+
+        position = cache_position.to(key_cache.device)
+        key_cache.index_copy_(2, position, key_states.to(key_cache.dtype))
+        value_cache.index_copy_(2, position, value_states.to(value_cache.dtype))
+        return key_cache, value_cache
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """Number of slots written so far in `layer_idx`, from the host-side count kept by `update`"""
+        return self._seq_lengths[layer_idx]
+
+    @property
+    def seen_tokens(self) -> int:
+        return self.get_seq_length()
+
+    def get_max_length(self) -> Optional[int]:
+        return self.max_cache_len
+
+    def static_attention_mask(
+        self,
+        attention_mask: Optional[torch.Tensor],
+        dtype: torch.dtype,
+        cache_position: Optional[torch.LongTensor] = None,
+    ) -> torch.Tensor:
+        """
+        Additive (bsz, 1, q_len, max_cache_len) mask over the preallocated slots.
+
+        The query at cache position p sees slot j if j <= p and `attention_mask` allows it. `attention_mask` may be
+        None, a 2D padding mask (bsz, kv_len) or a 4D additive mask over the first kv_len slots; a 4D mask that
+        already spans `max_cache_len` is returned as is. `cache_position` defaults to the slots of the current step.
+        """
+        if attention_mask is not None and attention_mask.dim() == 4 and attention_mask.shape[-1] == self.max_cache_len:
+            return attention_mask
+        if cache_position is None:
+            cache_position = self._write_position
+        slots = torch.arange(self.max_cache_len, device=cache_position.device)
+        visible = (slots[None, :] <= cache_position[:, None])[None, None]
+
+        if attention_mask is not None:
+            if attention_mask.dim() == 4:
+                allowed = attention_mask[:, :, -cache_position.shape[0]:, :] == 0
+            else:
+                allowed = attention_mask[:, None, None, :].bool()
+            allowed = allowed[..., :self.max_cache_len].to(cache_position.device)
+            padded = allowed.new_ones(allowed.shape[:-1] + (self.max_cache_len,))
+            padded[..., :allowed.shape[-1]] = allowed
+            visible = visible & padded
+
+        visible = visible.expand(self.batch_size, 1, cache_position.shape[0], self.max_cache_len)
+        return torch.zeros(visible.shape, dtype=dtype, device=visible.device).masked_fill(
+            ~visible, torch.finfo(dtype).min
+        )
+
+    def reset(self):
+        """
+        Empties the cache for a new sequence without freeing the buffers. The buffers are zeroed as well, so a
+        non-finite entry left by an earlier sequence cannot leak through the masked slots.
+        """
+        for key_cache, value_cache in zip(self.key_cache, self.value_cache):
+            key_cache.zero_()
+            value_cache.zero_()
+        self._seq_lengths = [0] * len(self.key_cache)
+        self._write_position = None
+
+
+class DeepseekV2SlotCache(DeepseekV2StaticCache):
+    """
+    Preallocated KV cache with one row ("slot") per sequence, for decoding sequences that start and finish at
+    different steps in one batch.
+
+    Buffers are laid out like `DeepseekV2StaticCache` with `batch_size` = number of slots. Each sequence keeps its own
+    length: `admit` copies a sequence's prefill cache into the first free slot, `update` writes every running sequence's
+    new token at that sequence's own position, `advance` counts the step, and `retire` frees a slot. Occupied slots are
+    kept contiguous (the last one moves into a freed slot), so a decode step runs on the first `active` rows without
+    gathering them, and attention only spans the longest running sequence.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        num_slots: int,
+        max_cache_len: int,
+        dtype: Optional[torch.dtype] = None,
+    ):
+        super().__init__(model, num_slots, max_cache_len, dtype=dtype)
+        # Tokens cached per occupied slot, on the host
+        self.lengths: List[int] = []
+        # (row indices, write positions) of the current step, per device
+        self._step_index = {}
+
+    @property
+    def num_slots(self) -> int:
+        return self.batch_size
+
+    @property
+    def active(self) -> int:
+        return len(self.lengths)
+
+    def admit(self, past_key_values) -> int:
+        """
+        Copies the cache of one prefilled sequence (a `Cache` or legacy tuple with batch size 1) into the first free
+        slot and returns the slot index.
+        """
+        if hasattr(past_key_values, "to_legacy_cache"):
+            past_key_values = past_key_values.to_legacy_cache()
+        if self.active == self.num_slots:
+            raise ValueError(f"All {self.num_slots} slots of the DeepseekV2SlotCache are occupied")
+        length = past_key_values[0][0].shape[-2]
+        if length >= self.max_cache_len:
+            raise ValueError(f"DeepseekV2SlotCache holds {self.max_cache_len} tokens per slot, cannot admit {length}")
+
+        slot = self.active
+        for layer_idx, (key_states, value_states) in enumerate(past_key_values):
+            self.key_cache[layer_idx][slot, :, :length] = key_states[0].to(self.dtype)
+            self.value_cache[layer_idx][slot, :, :length] = value_states[0].to(self.dtype)
+        self.lengths.append(length)
+        self._step_index.clear()
+        return slot
+
+    def retire(self, slot: int) -> int:
+        """
+        Frees `slot`. The last occupied slot moves into it; returns that slot's former index (`slot` itself if it
+        was the last one).
+        """
+        last = self.active - 1
+        if slot != last:
+            length = self.lengths[last]
+            for key_cache, value_cache in zip(self.key_cache, self.value_cache):
+                key_cache[slot, :, :length] = key_cache[last, :, :length]
+                value_cache[slot, :, :length] = value_cache[last, :, :length]
+            self.lengths[slot] = length
+        self.lengths.pop()
+        self._step_index.clear()
+        return last
+
+    def advance(self):
+        """Counts the token every occupied slot wrote in the step that just ran"""
+        self.lengths = [length + 1 for length in self.lengths]
+        self._step_index.clear()
+
+    def positions(self, device: Optional[torch.device] = None) -> torch.LongTensor:
+        """Position of the token each occupied slot writes next, i.e. its `position_ids` for the next step"""
+        device = self.key_cache[0].device if device is None else device
+        index = self._step_index.get(device)
+        if index is None:
+            rows = torch.arange(self.active, device=device)
+            index = self._step_index[device] = (rows, torch.tensor(self.lengths, dtype=torch.long, device=device))
+        return index[1]
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Writes one token per occupied slot at that slot's own position and returns the buffers of `layer_idx` for
+        the occupied slots, up to the longest sequence. `cache_kwargs["cache_position"]` is ignored: the positions
+        differ per slot.
+        """
+        if key_states.shape[0] != self.active or key_states.shape[-2] != 1:
+            raise ValueError(
+                f"DeepseekV2SlotCache decodes one token for each of its {self.active} sequences, got "
+                f"{key_states.shape[-2]} token(s) for {key_states.shape[0]}"
+            )
+        key_cache = self.key_cache[layer_idx]
+        value_cache = self.value_cache[layer_idx]
+        positions = self.positions(key_cache.device)
+        rows = self._step_index[key_cache.device][0]
+        key_cache[rows, :, positions] = key_states[:, :, -1].to(key_cache.dtype)
+        value_cache[rows, :, positions] = value_states[:, :, -1].to(value_cache.dtype)
+
+        width = self.get_max_length()
+        return key_cache[: self.active, :, :width], value_cache[: self.active, :, :width]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """Length of the longest sequence in the cache"""
+        return max(self.lengths, default=0)
+
+    def get_max_length(self) -> Optional[int]:
+        """Width attention runs over in the current step: the longest sequence plus the token it writes"""
+        return self.get_seq_length() + 1
+
+    def static_attention_mask(
+        self,
+        attention_mask: Optional[torch.Tensor],
+        dtype: torch.dtype,
+        cache_position: Optional[torch.LongTensor] = None,
+    ) -> torch.Tensor:
+        """
+        Additive (active, 1, 1, width) mask letting each sequence see its own cached tokens and the one it writes.
+        A 4D mask of that shape is returned as is; other masks are ignored, since the slots carry no padding.
+        """
+        width = self.get_max_length()
+        if attention_mask is not None and attention_mask.dim() == 4 and attention_mask.shape[-1] == width:
+            return attention_mask
+        device = cache_position.device if cache_position is not None else self.key_cache[0].device
+        positions = self.positions(device)
+        visible = torch.arange(width, device=device)[None, :] <= positions[:, None]
+        return torch.zeros(visible.shape, dtype=dtype, device=device).masked_fill(
+            ~visible, torch.finfo(dtype).min
+        )[:, None, None, :]
+
+    def reset(self):
+        """Frees every slot"""
+        self.lengths = []
+        self._step_index.clear()
+        self._write_position = None
+
+
 class DeepseekV2DecoderLayer(nn.Module):
     def __init__(self, config: DeepseekV2Config, layer_idx: int):
         super().__init__()
@@ -1363,7 +2517,9 @@ class DeepseekV2PreTrainedModel(PreTrainedModel):
     _no_split_modules = ["DeepseekV2DecoderLayer"]
     _skip_keys_device_placement = "past_key_values"
     _supports_flash_attn_2 = True
+    _supports_sdpa = True
     _supports_cache_class = True
+    _supports_static_cache = True
 
     def _init_weights(self, module):
         std = self.config.initializer_range
@@ -1475,6 +2631,7 @@ class DeepseekV2Model(DeepseekV2PreTrainedModel):
         )
         # print(config._attn_implementation)
         self._use_flash_attention_2 = config._attn_implementation == "flash_attention_2"
+        self._use_sdpa = config._attn_implementation == "sdpa"
         self.norm = DeepseekV2RMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
         self.gradient_checkpointing = False
@@ -1541,9 +2698,20 @@ class DeepseekV2Model(DeepseekV2PreTrainedModel):
             use_legacy_cache = not isinstance(past_key_values, Cache)
             if use_legacy_cache:
                 past_key_values = DynamicCache.from_legacy_cache(past_key_values)
-            past_key_values_length = past_key_values.get_usable_length(seq_length)
+            # With a static cache and cache_position, the step never needs the host-side cache length
+            if not (getattr(past_key_values, "is_static", False) and cache_position is not None):
+                past_key_values_length = past_key_values.get_usable_length(seq_length)
+        static_cache = use_cache and getattr(past_key_values, "is_static", False)
 
-        if position_ids is None:
+        if static_cache and cache_position is None:
+            device = input_ids.device if input_ids is not None else inputs_embeds.device
+            cache_position = torch.arange(
+                past_key_values_length, past_key_values_length + seq_length, device=device
+            )
+
+        if position_ids is None and static_cache:
+            position_ids = cache_position.unsqueeze(0)
+        elif position_ids is None:
             device = input_ids.device if input_ids is not None else inputs_embeds.device
             position_ids = torch.arange(
                 past_key_values_length,
@@ -1556,13 +2724,26 @@ class DeepseekV2Model(DeepseekV2PreTrainedModel):
         if inputs_embeds is None:
             inputs_embeds = self.embed_tokens(input_ids)
 
-        if self._use_flash_attention_2:
+        if static_cache and not self._use_flash_attention_2:
+            # 4d mask over every preallocated slot, so its shape is the same at each decode step
+            attention_mask = past_key_values.static_attention_mask(
+                attention_mask, inputs_embeds.dtype, cache_position
+            )
+        elif self._use_flash_attention_2:
             # 2d mask is passed through the layers
             attention_mask = (
                 attention_mask
                 if (attention_mask is not None and 0 in attention_mask)
                 else None
             )
+        elif getattr(self, "_use_sdpa", False) and not output_attentions:
+            # 4d mask only when needed (padding); plain causal prefill and decode get None
+            attention_mask = _prepare_4d_causal_attention_mask_for_sdpa(
+                attention_mask,
+                (batch_size, seq_length),
+                inputs_embeds,
+                past_key_values_length,
+            )
         else:
             # 4d mask is passed through the layers
             attention_mask = _prepare_4d_causal_attention_mask(
@@ -1602,6 +2783,7 @@ class DeepseekV2Model(DeepseekV2PreTrainedModel):
                     past_key_value=past_key_values,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    cache_position=cache_position,
                 )
 
             hidden_states = layer_outputs[0]
@@ -1639,6 +2821,97 @@ class DeepseekV2Model(DeepseekV2PreTrainedModel):
         )
 
 
+class NgramCandidateGenerator(CandidateGenerator):
+    """
+    Draft tokens for assisted generation by n-gram lookup (prompt lookup decoding).
+
+    The draft is what followed the most recent earlier occurrence of the sequence's last n tokens, for n from
+    `max_matching_ngram_size` down to 1. Occurrences are searched in the sequence itself and in `reference_ids`: token
+    sequences the output is expected to repeat, such as the source text a document quotes. The model verifies the whole
+    draft in one forward pass and keeps the tokens it would have produced itself, so greedy output is unchanged.
+
+    Works like transformers' `PromptLookupCandidateGenerator`, except for the reference sequences and an n-gram index
+    that is extended as tokens are accepted instead of scanning the sequence at every step. `stats` reports verification
+    steps, drafted and accepted tokens. Supports batch size 1, like assisted generation itself.
+    """
+
+    def __init__(
+        self,
+        eos_token_id: Optional[torch.Tensor] = None,
+        num_output_tokens: int = 10,
+        max_matching_ngram_size: Optional[int] = None,
+        max_length: int = 20,
+        reference_ids: Optional[List[List[int]]] = None,
+    ):
+        self.num_output_tokens = num_output_tokens
+        self.max_matching_ngram_size = max_matching_ngram_size if max_matching_ngram_size else 2
+        self.max_length = max_length
+        self.eos_token_ids = set(eos_token_id.view(-1).tolist()) if eos_token_id is not None else set()
+        if self.max_matching_ngram_size <= 0 or self.num_output_tokens <= 0:
+            raise ValueError("Invalid max_matching_ngram_size or num_output_tokens")
+
+        # n-gram -> (token list, index of the token after its latest occurrence)
+        self._index = {}
+        for reference in reference_ids or ():
+            reference = [int(token) for token in reference]
+            self._extend_index(reference, 1)
+        # The sequence so far, on the host; its n-grams are indexed once a token follows them
+        self.tokens = []
+        self.steps = 0
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+
+    def _extend_index(self, tokens: List[int], start: int):
+        for end in range(max(start, 1), len(tokens)):
+            for n in range(1, min(self.max_matching_ngram_size, end) + 1):
+                self._index[tuple(tokens[end - n : end])] = (tokens, end)
+
+    def get_candidates(self, input_ids: torch.LongTensor) -> Tuple[torch.LongTensor, Optional[torch.FloatTensor]]:
+        input_length = input_ids.shape[1]
+        # The model adds one token of its own after the draft
+        max_draft = min(self.num_output_tokens, self.max_length - input_length - 1)
+        if max_draft <= 0:
+            return input_ids, None
+
+        # Rejected draft tokens were never appended, so the host copy only ever grows
+        indexed = len(self.tokens)
+        self.tokens.extend(input_ids[0, indexed:].tolist())
+        self._extend_index(self.tokens, indexed)
+
+        draft = []
+        for n in range(min(self.max_matching_ngram_size, len(self.tokens)), 0, -1):
+            match = self._index.get(tuple(self.tokens[-n:]))
+            if match is not None:
+                source, start = match
+                draft = source[start : start + max_draft]
+                break
+        # Stop the draft at EOS, otherwise tokens after an accepted EOS would be kept too
+        for i, token in enumerate(draft):
+            if token in self.eos_token_ids:
+                draft = draft[:i]
+                break
+        if not draft:
+            return input_ids, None
+
+        self.drafted_tokens += len(draft)
+        draft = torch.tensor([draft], dtype=input_ids.dtype, device=input_ids.device)
+        return torch.cat((input_ids, draft), dim=1), None
+
+    def update_candidate_strategy(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, num_matches: int):
+        self.steps += 1
+        self.accepted_tokens += int(num_matches)
+
+    def stats(self):
+        return {
+            "steps": self.steps,
+            "drafted_tokens": self.drafted_tokens,
+            "accepted_tokens": self.accepted_tokens,
+            "acceptance_rate": self.accepted_tokens / self.drafted_tokens if self.drafted_tokens else 0.0,
+            # Every verification step yields its accepted draft tokens plus one token of the model
+            "tokens_per_step": (self.accepted_tokens + self.steps) / self.steps if self.steps else 0.0,
+        }
+
+
 class DeepseekV2ForCausalLM(DeepseekV2PreTrainedModel):
     _tied_weights_keys = ["lm_head.weight"]
 
@@ -1815,15 +3088,8 @@ class DeepseekV2ForCausalLM(DeepseekV2PreTrainedModel):
             if past_key_values:
                 position_ids = position_ids[:, -input_ids.shape[1]:]
 
-        if self.generation_config.cache_implementation == "static":
-            # generation with static cache
-            cache_position = kwargs.get("cache_position", None)
-            if cache_position is None:
-                past_length = 0
-            else:
-                past_length = cache_position[-1] + 1
-            input_ids = input_ids[:, past_length:]
-            position_ids = position_ids[:, past_length:]
+        # Static caches (DeepseekV2StaticCache) count the tokens they have seen on the host, so the slicing above
+        # applies to them too without a device sync
 
         # TODO @gante we should only keep a `cache_position` in generate, and do +=1.
         # same goes for position ids. Could also help with continued generation.
@@ -1849,6 +3115,52 @@ class DeepseekV2ForCausalLM(DeepseekV2PreTrainedModel):
         )
         return model_inputs
 
+    def _get_cache(self, cache_implementation: str, batch_size: int, max_cache_len: int, *args, **kwargs) -> Cache:
+        """
+        `generate(cache_implementation="static")` builds a `DeepseekV2StaticCache`, which matches the per-layer cache
+        layout (compressed latent for MLA layers); the cache is kept for later calls that fit in it.
+        """
+        if cache_implementation != "static":
+            return super()._get_cache(cache_implementation, batch_size, max_cache_len, *args, **kwargs)
+        cache = getattr(self, "_cache", None)
+        if (
+            not isinstance(cache, DeepseekV2StaticCache)
+            or cache.batch_size != batch_size
+            or cache.max_cache_len < max_cache_len
+        ):
+            cache = DeepseekV2StaticCache(self.model, batch_size, max_cache_len)
+            self._cache = cache
+        else:
+            cache.reset()
+        return cache
+
+    def _get_candidate_generator(
+        self,
+        generation_config: GenerationConfig,
+        input_ids: torch.LongTensor,
+        inputs_tensor: torch.Tensor,
+        assistant_model: Optional[PreTrainedModel],
+        logits_processor: LogitsProcessorList,
+        model_kwargs: Dict,
+    ) -> CandidateGenerator:
+        """
+        `generate(prompt_lookup_num_tokens=...)` drafts with `NgramCandidateGenerator`, which also searches the token
+        sequences in `generation_config.prompt_lookup_reference_ids`, if set. The generator of the last call is kept as
+        `self.prompt_lookup_generator` for its `stats`.
+        """
+        if generation_config.prompt_lookup_num_tokens is None or assistant_model is not None:
+            return super()._get_candidate_generator(
+                generation_config, input_ids, inputs_tensor, assistant_model, logits_processor, model_kwargs
+            )
+        self.prompt_lookup_generator = NgramCandidateGenerator(
+            eos_token_id=generation_config._eos_token_tensor,
+            num_output_tokens=generation_config.prompt_lookup_num_tokens,
+            max_matching_ngram_size=generation_config.max_matching_ngram_size,
+            max_length=generation_config.max_length,
+            reference_ids=getattr(generation_config, "prompt_lookup_reference_ids", None),
+        )
+        return self.prompt_lookup_generator
+
     @staticmethod
     def _reorder_cache(past_key_values, beam_idx):
         reordered_past = ()
@@ -1862,6 +3174,226 @@ class DeepseekV2ForCausalLM(DeepseekV2PreTrainedModel):
         return reordered_past
 
 
+class _ScheduledSequence:
+    """A request of `DeepseekV2DecodeScheduler`: its prompt, decoding settings and the tokens produced so far"""
+
+    def __init__(self, request_id, input_ids, max_new_tokens, eos_token_ids, logits_processor, stopping_criteria,
+                 model_kwargs):
+        self.request_id = request_id
+        self.prompt_length = input_ids.shape[1]
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = eos_token_ids
+        self.logits_processor = logits_processor
+        self.stopping_criteria = stopping_criteria
+        self.model_kwargs = model_kwargs
+        # Prompt + generated tokens on the host, allocated for the whole budget
+        self.output_ids = torch.empty((1, self.prompt_length + max_new_tokens), dtype=torch.long)
+        self.output_ids[:, : self.prompt_length] = input_ids.cpu()
+        self.length = self.prompt_length
+
+    @property
+    def generated_tokens(self) -> int:
+        return self.length - self.prompt_length
+
+    @property
+    def last_token(self) -> int:
+        return int(self.output_ids[0, self.length - 1])
+
+    def next_token(self, scores: torch.FloatTensor) -> int:
+        """Greedy choice from the (1, vocab_size) next-token scores, after the logits processors"""
+        if self.logits_processor is not None:
+            input_ids = self.output_ids[:, : self.length].to(scores.device)
+            scores = self.logits_processor(input_ids, scores.float())
+        return int(scores.argmax(dim=-1))
+
+    def append(self, token: int) -> bool:
+        """Adds `token` and returns True if the sequence is finished"""
+        self.output_ids[0, self.length] = token
+        self.length += 1
+        if token in self.eos_token_ids or self.generated_tokens >= self.max_new_tokens:
+            return True
+        if self.stopping_criteria is not None:
+            return bool(self.stopping_criteria(self.output_ids[:, : self.length], None).all())
+        return False
+
+
+class DeepseekV2DecodeScheduler:
+    """
+    Continuous (iteration-level) batching of greedy decoding for a `DeepseekV2ForCausalLM`.
+
+    Requests are submitted one sequence at a time and may arrive while others are decoding. Every `step` admits
+    waiting requests into free slots of a `DeepseekV2SlotCache` (each is prefilled on its own, with its own
+    `model_kwargs` such as image inputs, and gets its first token), then runs one batched forward pass that decodes
+    the next token of every running sequence, and retires the sequences that finished. A finished sequence frees its
+    slot for the next request at once instead of idling until the longest sequence of the batch is done, so decode
+    passes stay as full as the load allows.
+
+    Each request has its own budget, EOS tokens, logits processors and stopping criteria, called with that sequence
+    alone. The output of a request is the same as `generate(do_sample=False)` on it by itself, up to the numerics of
+    batched kernels. The scheduler is not thread-safe: one thread should submit and step.
+
+    Args:
+        model: The causal LM (prefill is a regular forward call, so wrappers that take image inputs work as well).
+        max_batch_size: Sequences decoded together (slots of the cache).
+        max_cache_len: Prompt plus output tokens one sequence may reach.
+        dtype: Cache dtype, defaults to the model's.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        max_batch_size: int = 8,
+        max_cache_len: int = 4096,
+        dtype: Optional[torch.dtype] = None,
+    ):
+        self.model = model
+        self.cache = DeepseekV2SlotCache(model, max_batch_size, max_cache_len, dtype=dtype)
+        self.device = model.get_input_embeddings().weight.device
+        self._waiting = deque()
+        # Running sequences; the one at index i occupies slot i of the cache
+        self._running: List[_ScheduledSequence] = []
+        self._request_ids = itertools.count()
+        self.steps = 0
+        self.prefilled_sequences = 0
+        self.decoded_tokens = 0
+
+    @property
+    def max_batch_size(self) -> int:
+        return self.cache.num_slots
+
+    @property
+    def max_cache_len(self) -> int:
+        return self.cache.max_cache_len
+
+    def submit(
+        self,
+        input_ids: torch.LongTensor,
+        max_new_tokens: int,
+        eos_token_id: Optional[Union[int, List[int]]] = None,
+        logits_processor: Optional[LogitsProcessorList] = None,
+        stopping_criteria=None,
+        **model_kwargs,
+    ) -> int:
+        """
+        Queues one sequence (`input_ids` of shape (1, prompt_length)) and returns its request id. `model_kwargs` are
+        passed to the prefill forward call only.
+        """
+        if input_ids.dim() != 2 or input_ids.shape[0] != 1:
+            raise ValueError(f"DeepseekV2DecodeScheduler takes one sequence per request, got shape {tuple(input_ids.shape)}")
+        if max_new_tokens < 1:
+            raise ValueError(f"max_new_tokens must be at least 1, got {max_new_tokens}")
+        # The last token is never written to the cache
+        if input_ids.shape[1] + max_new_tokens - 1 > self.max_cache_len:
+            raise ValueError(
+                f"{input_ids.shape[1]} prompt tokens + {max_new_tokens} new tokens exceed the {self.max_cache_len} "
+                "tokens of a cache slot"
+            )
+        if eos_token_id is None:
+            eos_token_id = self.model.generation_config.eos_token_id
+        if isinstance(eos_token_id, torch.Tensor):
+            eos_token_id = eos_token_id.tolist()
+        eos_token_ids = set([eos_token_id] if isinstance(eos_token_id, int) else eos_token_id or ())
+
+        request_id = next(self._request_ids)
+        self._waiting.append(
+            _ScheduledSequence(request_id, input_ids, max_new_tokens, eos_token_ids, logits_processor,
+                               stopping_criteria, model_kwargs)
+        )
+        return request_id
+
+    def has_unfinished(self) -> bool:
+        return bool(self._waiting or self._running)
+
+    def __len__(self):
+        return len(self._waiting) + len(self._running)
+
+    def _prefill(self, sequence: _ScheduledSequence) -> bool:
+        """Runs the prompt of `sequence`, picks its first token and, unless that finishes it, gives it a slot"""
+        input_ids = sequence.output_ids[:, : sequence.length].to(self.device)
+        outputs = self.model(
+            input_ids=input_ids,
+            past_key_values=DynamicCache(),
+            use_cache=True,
+            return_dict=True,
+            **sequence.model_kwargs,
+        )
+        # Image inputs are only needed for the prompt
+        sequence.model_kwargs = None
+        self.prefilled_sequences += 1
+        if sequence.append(sequence.next_token(outputs.logits[:, -1, :])):
+            return True
+        self.cache.admit(outputs.past_key_values)
+        self._running.append(sequence)
+        return False
+
+    def step(self) -> List[Tuple[int, torch.LongTensor]]:
+        """
+        Runs one scheduling iteration and returns `(request_id, output_ids)` for every sequence that finished in
+        it, `output_ids` being the prompt plus the generated tokens, shape (1, length), on the host.
+        """
+        finished = []
+        while self._waiting and len(self._running) < self.max_batch_size:
+            sequence = self._waiting.popleft()
+            if self._prefill(sequence):
+                finished.append(sequence)
+
+        running = self._running
+        if running:
+            input_ids = torch.tensor([[sequence.last_token] for sequence in running], device=self.device)
+            position_ids = self.cache.positions(self.device)[:, None]
+            logits = self.model(
+                input_ids=input_ids,
+                position_ids=position_ids,
+                past_key_values=self.cache,
+                use_cache=True,
+                return_dict=True,
+            ).logits[:, -1, :]
+            self.cache.advance()
+            self.steps += 1
+            self.decoded_tokens += len(running)
+
+            if any(sequence.logits_processor is not None for sequence in running):
+                tokens = [sequence.next_token(logits[i : i + 1]) for i, sequence in enumerate(running)]
+            else:
+                tokens = logits.argmax(dim=-1).tolist()
+            done = [slot for slot, (sequence, token) in enumerate(zip(running, tokens)) if sequence.append(token)]
+
+            # Highest slot first: the sequence moved into a freed slot is always one that keeps running
+            for slot in reversed(done):
+                finished.append(running[slot])
+                moved = self.cache.retire(slot)
+                running[slot] = running[moved]
+                running.pop()
+
+        return [(sequence.request_id, sequence.output_ids[:, : sequence.length]) for sequence in finished]
+
+    def run(self) -> Dict[int, torch.LongTensor]:
+        """Steps until every submitted sequence is finished; returns the output ids by request id"""
+        outputs = {}
+        while self.has_unfinished():
+            outputs.update(self.step())
+        return outputs
+
+    def cancel(self) -> List[int]:
+        """Drops every waiting and running sequence (e.g. after a failed step) and returns their request ids"""
+        request_ids = [sequence.request_id for sequence in list(self._waiting) + self._running]
+        self._waiting.clear()
+        self._running = []
+        self.cache.reset()
+        return request_ids
+
+    def stats(self):
+        return {
+            "steps": self.steps,
+            "prefilled_sequences": self.prefilled_sequences,
+            "decoded_tokens": self.decoded_tokens,
+            # Mean number of sequences per decode forward pass
+            "mean_batch_size": self.decoded_tokens / self.steps if self.steps else 0.0,
+            "running": len(self._running),
+            "waiting": len(self._waiting),
+        }
+
+
 @add_start_docstrings(
     """
     The DeepseekV2 Model transformer with a sequence classification head on top (linear layer).